@@ -1,23 +1,71 @@
+import atexit
+import base64
+import functools
 import os
-from datetime import datetime, timezone
+import json
+import hashlib
+import logging
+import mimetypes
+import random
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 import sys
 import subprocess
 
-import jwt  # For decoding JWTs (like Google's id_token)
+import click
 import requests
-from authlib.integrations.flask_client import OAuth
 from bson.objectid import ObjectId  # For generating unique MongoDB ObjectIDs
 from dotenv import load_dotenv
 from flask import Flask, render_template, request, redirect, url_for, session
-from flask import jsonify
+from flask import jsonify, Response, stream_with_context, g, abort, send_file
+from flask.sessions import SessionInterface, SessionMixin
 from flask_cors import CORS
-from pymongo import MongoClient  # For MongoDB connection
-from werkzeug.security import generate_password_hash, check_password_hash  # For password hashing
+from pymongo import MongoClient, ReturnDocument, UpdateOne  # For MongoDB connection
+from pymongo.errors import DuplicateKeyError
+from requests.adapters import HTTPAdapter
+from werkzeug.datastructures import CallbackDict
 from werkzeug.middleware.proxy_fix import ProxyFix # <-- Import ProxyFix
+from werkzeug.security import safe_join
+
+import assets
+import attachments
+import indexes
+import observability
+import passwords
+import purge
+import ratelimit
+import sandbox
+import scheduler
+import sqlitestore
+import transfer
+import writebehind
 
 # Load environment variables from .env file at the very beginning
 load_dotenv()
 
+# --- Logging and metrics ---
+# JSON lines on stderr. DEBUG detail is sampled; LOG_LEVEL=WARNING turns it off altogether.
+observability.configure_logging(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    debug_sample_rate=float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0")),
+    json_format=os.getenv("LOG_FORMAT", "json").lower() == "json"
+)
+log = logging.getLogger('phantom')
+
+metrics = observability.Registry()
+http_request_seconds = metrics.histogram(
+    'phantom_http_request_duration_seconds', 'Time to produce a response (headers, for streamed routes), by route.',
+    ('route', 'method', 'status')
+)
+mongo_command_seconds = metrics.histogram(
+    'phantom_mongo_command_duration_seconds', 'MongoDB command latency by collection and command.',
+    ('collection', 'command', 'outcome')
+)
+
 app = Flask(__name__,
             template_folder='templates',
             static_folder='static')
@@ -34,67 +82,376 @@ CORS(app, resources={r"/api/*": {"origins": "*"}})
 app.secret_key = os.getenv("FLASK_SECRET_KEY")
 if not app.secret_key:
     app.secret_key = "a_fallback_secret_key_for_dev_ONLY_change_in_prod_1234567890"
-    print("WARNING: FLASK_SECRET_KEY not found in .env! Using a fallback. PLEASE SET IT IN .env FOR SECURITY.")
+    log.warning("FLASK_SECRET_KEY not found in .env! Using a fallback. PLEASE SET IT IN .env FOR SECURITY.")
 
 app.config['SESSION_COOKIE_NAME'] = 'phantom-login-session'
 
-# --- Google OAuth Configuration ---
-oauth = OAuth(app)
-
-# DEBUG: Print loaded environment variables to check if they are picked up
-print(f"DEBUG: GOOGLE_CLIENT_ID loaded: {os.getenv('GOOGLE_CLIENT_ID') is not None and len(os.getenv('GOOGLE_CLIENT_ID', '')) > 5}")
-print(f"DEBUG: GOOGLE_CLIENT_SECRET loaded: {os.getenv('GOOGLE_CLIENT_SECRET') is not None and len(os.getenv('GOOGLE_CLIENT_SECRET', '')) > 5}")
-print(f"DEBUG: GEMINI_API_KEY loaded: {os.getenv('GEMINI_API_KEY') is not None and len(os.getenv('GEMINI_API_KEY', '')) > 5}")
-print(f"DEBUG: FLASK_SECRET_KEY loaded correctly: {app.secret_key is not None and len(app.secret_key) > 20 and app.secret_key != 'a_fallback_secret_key_for_dev_ONLY_change_in_prod_1234567890'}")
-
-
-google = oauth.register(
-    name='google',
-    client_id=os.getenv("GOOGLE_CLIENT_ID"),
-    client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
-    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-    userinfo_endpoint='https://openidconnect.googleapis.com/v1/userinfo',
-    client_kwargs={
-        'scope': 'openid email profile'
-    }
-)
+# Report which settings were picked up (never their values)
+log.debug("configuration loaded", extra={'fields': {
+    'google_client_id': len(os.getenv('GOOGLE_CLIENT_ID', '')) > 5,
+    'google_client_secret': len(os.getenv('GOOGLE_CLIENT_SECRET', '')) > 5,
+    'gemini_api_key': len(os.getenv('GEMINI_API_KEY', '')) > 5,
+    'flask_secret_key': len(app.secret_key) > 20 and app.secret_key != 'a_fallback_secret_key_for_dev_ONLY_change_in_prod_1234567890'
+}})
 
-# --- MongoDB Connection Setup ---
+
+# --- Google OAuth Configuration ---
+# authlib (and jwt) are imported, and the client registered, the first time someone signs in
+# with Google; authlib fetches the discovery document on that first use as well.
+google_oauth = None
+_google_oauth_lock = threading.Lock()
+
+
+def get_google_oauth():
+    global google_oauth
+    if google_oauth is None:
+        with _google_oauth_lock:
+            if google_oauth is None:
+                from authlib.integrations.flask_client import OAuth
+                google_oauth = OAuth(app).register(
+                    name='google',
+                    client_id=os.getenv("GOOGLE_CLIENT_ID"),
+                    client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
+                    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+                    userinfo_endpoint='https://openidconnect.googleapis.com/v1/userinfo',
+                    client_kwargs={
+                        'scope': 'openid email profile'
+                    }
+                )
+    return google_oauth
+
+# --- Storage: MongoDB, or embedded SQLite (sqlitestore.py) for single-node deployments ---
 MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME")
+# Shared by every request (or greenlet, under the gevent worker) in this process
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_ENSURE_INDEXES = os.getenv("MONGO_ENSURE_INDEXES", "true").lower() in ("1", "true", "yes")
+# "mongo" or "sqlite"; without MongoDB settings the app runs on a local SQLite file
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo" if MONGO_URI else "sqlite").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'phantom.db'))
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "16"))
 
 mongo_client = None
 mongo_db = None
+sqlite_db = None
 users_collection = None
 chat_sessions_collection = None
 messages_collection = None
 
-if not MONGO_URI or not MONGO_DB_NAME:
-    print("CRITICAL WARNING: MongoDB URI or DB Name not set in .env! MongoDB features will be disabled.")
+if STORAGE_BACKEND == 'sqlite':
+    # Opened lazily, per process: the first query in each worker creates its connections
+    sqlite_db = sqlitestore.SQLiteDatabase(SQLITE_PATH, pool_size=SQLITE_POOL_SIZE)
+    log.info("SQLite storage configured", extra={'fields': {'path': SQLITE_PATH}})
+    metrics.counter_callback(
+        'phantom_sqlite_events_total', 'SQLite storage connections opened and write transactions committed.',
+        lambda: {(event,): count for event, count in sqlite_db.stats.items()}, ('event',)
+    )
+elif not MONGO_URI or not MONGO_DB_NAME:
+    log.critical("MongoDB URI or DB Name not set in .env! MongoDB features will be disabled.")
 else:
     try:
-        # Use a short server selection timeout so startup doesn't hang if Mongo is unreachable
-        mongo_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        # connect=False: no sockets or monitor threads until the first operation, which happens in the
+        # serving worker (never in a preloading gunicorn master), so the client is safe across fork
+        mongo_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, maxPoolSize=MONGO_MAX_POOL_SIZE,
+                                   connect=False,
+                                   event_listeners=[observability.MongoCommandTimer(mongo_command_seconds)])
         mongo_db = mongo_client[MONGO_DB_NAME]
-        print(f"DEBUG: Successfully connected to MongoDB database: {MONGO_DB_NAME}")
-        users_collection = mongo_db['users']
-        chat_sessions_collection = mongo_db['chat_sessions']
-        messages_collection = mongo_db['messages']
+        log.info("MongoDB configured", extra={'fields': {'database': MONGO_DB_NAME}})
     except Exception as e:
-        print(f"CRITICAL ERROR: Failed to connect to MongoDB: {e}")
-        print("MongoDB features will be disabled due to connection error.")
+        log.critical(f"Failed to connect to MongoDB: {e}. MongoDB features will be disabled.")
         mongo_client = None
 
+# Whichever backend is configured; both hand out collections with the same (pymongo) API
+storage_db = mongo_db if mongo_db is not None else sqlite_db
+if storage_db is not None:
+    users_collection = storage_db['users']
+    chat_sessions_collection = storage_db['chat_sessions']
+    messages_collection = storage_db['messages']
+
+
+def prepare_database():
+    """Creates missing indexes. Idempotent; a no-op round trip per collection once they exist."""
+    try:
+        indexes.ensure_indexes(mongo_db)
+    except indexes.IndexBuildError as e:
+        log.error(f"Some MongoDB indexes could not be built: {e}")
+    except Exception as e:
+        log.warning(f"Could not ensure MongoDB indexes at startup: {e}")
+
+
+# --- Per-process startup ---
+# Work that needs the network or its own threads runs once in each serving process, on its
+# first request, instead of at import: a worker boot costs only the import, and nothing is
+# started in a gunicorn master that would not survive the fork.
+_started_pid = None
+_startup_lock = threading.Lock()
+
+
+@app.before_request
+def start_worker_services():
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    with _startup_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+        if mongo_db is not None and MONGO_ENSURE_INDEXES:
+            # In the background, so the first request doesn't wait on index builds
+            threading.Thread(target=prepare_database, name='ensure-indexes', daemon=True).start()
+        if session_purger is not None:
+            session_purger.start()
+
 
 # --- Gemini API Configuration (Backend Only) ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+# GEMINI_API_BASE can point at a local mock server for load testing (see benchmark.py)
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip('/')
+GEMINI_API_URL = f"{GEMINI_API_BASE}/v1beta/models/gemini-2.0-flash:generateContent"
+GEMINI_STREAM_API_URL = f"{GEMINI_API_BASE}/v1beta/models/gemini-2.0-flash:streamGenerateContent"
+# Streaming requests have no overall deadline; only the connect step and the gap between chunks are bounded.
+GEMINI_STREAM_CONNECT_TIMEOUT = float(os.getenv("GEMINI_STREAM_CONNECT_TIMEOUT", "5"))
+GEMINI_STREAM_READ_TIMEOUT = float(os.getenv("GEMINI_STREAM_READ_TIMEOUT", "60"))
+
+# --- Shared, connection-pooled HTTP client for the Gemini upstream ---
+# Reusing one Session keeps TCP+TLS connections to Google alive between chat turns.
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "20"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "2"))
+GEMINI_RETRY_BACKOFF = float(os.getenv("GEMINI_RETRY_BACKOFF", "0.5"))
+# The longest Retry-After a request will sleep through; longer ones fail the request straight away
+GEMINI_RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "5"))
+GEMINI_RETRY_STATUSES = {429, 503}
+GEMINI_BREAKER_FAILURE_THRESHOLD = int(os.getenv("GEMINI_BREAKER_FAILURE_THRESHOLD", "5"))
+GEMINI_BREAKER_RESET_SECONDS = float(os.getenv("GEMINI_BREAKER_RESET_SECONDS", "30"))
+
+gemini_http = None
+_gemini_http_lock = threading.Lock()
+
+
+def get_gemini_http():
+    """Creates the Session on first use, so its connection pools belong to the serving process."""
+    global gemini_http
+    if gemini_http is None:
+        with _gemini_http_lock:
+            if gemini_http is None:
+                http = requests.Session()
+                # pool_block=True caps open sockets at GEMINI_POOL_SIZE instead of opening throwaway extras
+                http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=GEMINI_POOL_SIZE, pool_block=True))
+                http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=GEMINI_POOL_SIZE, pool_block=True))
+                gemini_http = http
+    return gemini_http
+
+
+class UpstreamUnavailableError(requests.exceptions.RequestException):
+    """Raised without contacting Gemini while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker. After `failure_threshold` failures the
+    breaker opens and calls fail fast for `reset_seconds`; then a single trial
+    call is let through (half-open) to decide whether to close again.
+    """
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = 'half_open'
+                return True
+            return self.state == 'closed'
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.times_opened += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def retry_after(self):
+        return max(0, int(self.reset_seconds - (time.monotonic() - self.opened_at)) + 1)
+
+
+gemini_breaker = CircuitBreaker(GEMINI_BREAKER_FAILURE_THRESHOLD, GEMINI_BREAKER_RESET_SECONDS)
+gemini_upstream_stats = {"requests": 0, "retries": 0, "retries_abandoned": 0, "rate_limited": 0, "failures": 0,
+                         "rejected_by_breaker": 0}
+_gemini_upstream_stats_lock = threading.Lock()
+gemini_request_seconds = metrics.histogram(
+    'phantom_gemini_request_duration_seconds', 'Gemini call latency per attempt (to response headers).',
+    ('endpoint', 'status')
+)
+gemini_stream_seconds = metrics.histogram(
+    'phantom_gemini_stream_duration_seconds', 'Duration of a streamed Gemini reply, first byte to last.', ('outcome',)
+)
+gemini_tokens = metrics.counter('phantom_gemini_tokens_total', 'Tokens reported by Gemini usageMetadata.', ('type',))
+metrics.counter_callback(
+    'phantom_gemini_upstream_events_total', 'Gemini requests, retries, failures and breaker rejections.',
+    lambda: {(event,): count for event, count in gemini_upstream_snapshot().items()}, ('event',)
+)
+metrics.gauge_callback(
+    'phantom_gemini_breaker_open', '1 while the Gemini circuit breaker is open or half-open.',
+    lambda: {(): 0 if gemini_breaker.state == 'closed' else 1}
+)
+metrics.gauge_callback(
+    'phantom_gemini_pool', 'Gemini HTTP connection pool reuse.',
+    lambda: {(name,): value for name, value in gemini_pool_stats().items()}, ('stat',)
+)
+
+
+def record_gemini_usage(gemini_response):
+    """Adds a response's usageMetadata token counts to the metrics."""
+    usage = (gemini_response or {}).get('usageMetadata') or {}
+    for field, token_type in (('promptTokenCount', 'prompt'), ('candidatesTokenCount', 'candidates')):
+        if usage.get(field):
+            gemini_tokens.inc(usage[field], type=token_type)
+
+
+def count_gemini_event(event):
+    # Requests run on many threads (and greenlets), so the counts are updated under a lock
+    with _gemini_upstream_stats_lock:
+        gemini_upstream_stats[event] += 1
+
+
+def gemini_upstream_snapshot():
+    with _gemini_upstream_stats_lock:
+        return dict(gemini_upstream_stats)
+
+
+def gemini_post(url, payload, stream=False, timeout=20):
+    """
+    POSTs to Gemini through the shared pool, retrying 429/503 with jittered
+    exponential backoff (or after Retry-After, if it is within GEMINI_RETRY_MAX_DELAY)
+    and failing fast while the circuit breaker is open. Only connection errors, timeouts
+    and 5xx count against the breaker: a 429 is a quota answer from a healthy upstream.
+    Returns the final requests.Response (callers still call raise_for_status()).
+    """
+    if not gemini_breaker.allow_request():
+        count_gemini_event("rejected_by_breaker")
+        raise UpstreamUnavailableError("Gemini upstream is unavailable (circuit open).")
+
+    params = {'key': GEMINI_API_KEY}
+    if stream:
+        params['alt'] = 'sse'
+
+    endpoint = 'stream' if stream else 'generate'
+    attempt = 0
+    while True:
+        count_gemini_event("requests")
+        started = time.perf_counter()
+        try:
+            response = get_gemini_http().post(url, params=params, json=payload, stream=stream, timeout=timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            gemini_request_seconds.observe(time.perf_counter() - started, endpoint=endpoint, status='error')
+            count_gemini_event("failures")
+            gemini_breaker.record_failure()
+            raise
+        gemini_request_seconds.observe(time.perf_counter() - started, endpoint=endpoint, status=response.status_code)
+        if response.status_code == 429:
+            count_gemini_event("rate_limited")
+
+        if response.status_code in GEMINI_RETRY_STATUSES and attempt < GEMINI_MAX_RETRIES:
+            retry_after = response.headers.get('Retry-After', '')
+            delay = float(retry_after) if retry_after.isdigit() else random.uniform(0, GEMINI_RETRY_BACKOFF * (2 ** (attempt + 1)))
+            if delay <= GEMINI_RETRY_MAX_DELAY:
+                attempt += 1
+                count_gemini_event("retries")
+                response.close()
+                time.sleep(delay)
+                continue
+            # Not worth holding a worker for: the caller reports the 429/503 now
+            count_gemini_event("retries_abandoned")
+
+        if response.status_code >= 500:
+            count_gemini_event("failures")
+            gemini_breaker.record_failure()
+        else:
+            gemini_breaker.record_success()
+        return response
+
+
+def gemini_pool_stats():
+    """Connection reuse figures summed over the urllib3 pools behind gemini_http."""
+    new_connections = 0
+    pooled_requests = 0
+    for adapter in (gemini_http.adapters.values() if gemini_http is not None else ()):
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is not None:
+                new_connections += pool.num_connections
+                pooled_requests += pool.num_requests
+    hit_rate = 1 - (new_connections / pooled_requests) if pooled_requests else 0.0
+    return {"connections_opened": new_connections, "requests_sent": pooled_requests, "pool_hit_rate": round(hit_rate, 4)}
+
+
+# --- Fair dispatch of Gemini calls (see scheduler.py) ---
+# A ceiling on concurrent calls per worker, shared fairly between users, with chat ahead of summaries
+GEMINI_MAX_CONCURRENT = int(os.getenv("GEMINI_MAX_CONCURRENT", str(GEMINI_POOL_SIZE)))
+GEMINI_MAX_CONCURRENT_PER_USER = int(os.getenv("GEMINI_MAX_CONCURRENT_PER_USER", "2"))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "30"))
+# While a streamed request waits, an SSE comment is sent this often; a failed write means the client left
+GEMINI_QUEUE_KEEPALIVE_SECONDS = float(os.getenv("GEMINI_QUEUE_KEEPALIVE_SECONDS", "5"))
+
+gemini_scheduler = scheduler.FairScheduler(
+    GEMINI_MAX_CONCURRENT, GEMINI_MAX_CONCURRENT_PER_USER,
+    wait_histogram=metrics.histogram(
+        'phantom_gemini_queue_wait_seconds', 'Time Gemini calls spent queued for a slot, by outcome.',
+        ('priority', 'outcome')
+    ),
+    service_histogram=metrics.histogram(
+        'phantom_gemini_service_seconds', 'Time Gemini calls held a slot (whole stream for streamed replies).',
+        ('priority',)
+    )
+)
+gemini_coalescer = scheduler.Coalescer()
+metrics.gauge_callback(
+    'phantom_gemini_queued', 'Gemini calls waiting for a slot.',
+    lambda: {(priority,): count for priority, count in gemini_scheduler.queued().items()}, ('priority',)
+)
+metrics.gauge_callback('phantom_gemini_in_flight', 'Gemini calls holding a slot.', lambda: {(): gemini_scheduler.running()})
+metrics.counter_callback(
+    'phantom_gemini_scheduler_events_total', 'Gemini calls dispatched, expired or cancelled in the queue, and coalesced.',
+    lambda: {**{(event,): count for event, count in gemini_scheduler.stats.items()},
+             ('coalesced',): gemini_coalescer.stats["followers"]}, ('event',)
+)
+
+
+def scheduled_gemini_post(url, payload, user_id, priority='interactive', timeout=20):
+    """
+    gemini_post behind the fair scheduler. Identical payloads already in flight share
+    that call's response instead of queueing again. Raises QueueTimeoutError.
+    """
+    def call():
+        with gemini_scheduler.slot(user_id, priority, queue_timeout=GEMINI_QUEUE_TIMEOUT):
+            return gemini_post(url, payload, timeout=timeout)
+
+    fingerprint = hashlib.sha256(json.dumps([url, payload], sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+    return gemini_coalescer.run(fingerprint, call)
 
 # --- Helper to save/update user info (used by both Google and traditional login) ---
+class EmailInUseError(Exception):
+    """Raised when a Google sign-in's email already belongs to a different account."""
+
+
 def save_user_info_to_db(email, display_name, google_id=None, picture_url=None, password_hash=None):
+    """Upserts the user in a single round trip and returns the stored document (None without MongoDB)."""
     if users_collection is None:
-        print(f"--- BACKEND: User {email} info not saved (MongoDB not connected). ---")
-        return
+        log.warning("user info not saved: MongoDB not connected")
+        return None
 
     query_filter = {'email': email}
     update_data = {
@@ -110,18 +467,748 @@ def save_user_info_to_db(email, display_name, google_id=None, picture_url=None,
     elif password_hash: # For traditional login
         update_data["password_hash"] = password_hash
         update_data["picture_url"] = None # Traditional users won't have a picture_url initially
-        # Set default settings for new traditional users
-        if not users_collection.find_one(query_filter): # Only set defaults if new user
-            update_data["theme"] = "theme-dark"
-            update_data["language"] = "en-US"
-            update_data["voice"] = ""
-
-    users_collection.update_one(
-        query_filter,
-        {'$set': update_data},
-        upsert=True
+    # Default settings are only written when the upsert creates the user
+    update = {
+        '$set': update_data,
+        '$setOnInsert': {"theme": "theme-dark", "language": "en-US", "voice": ""}
+    }
+
+    try:
+        user_doc = users_collection.find_one_and_update(
+            query_filter, update, upsert=True, return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Email is unique. Accounts are never linked implicitly: any Google identity claiming the
+        # address would otherwise take over the existing account
+        log.warning("sign-in refused: email belongs to another account", extra={'fields': {'google_login': bool(google_id)}})
+        raise EmailInUseError(email)
+    log.debug("user info saved", extra={'fields': {'google_login': bool(google_id)}})
+    return user_doc
+
+
+# --- Response cache for repeated prompts ---
+# Keyed on a hash of the normalised contents sent to Gemini (instruction + history + new turn),
+# so identical conversations, such as a suggestion prompt in a fresh session, skip the upstream.
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory").lower()  # "memory", "mongo" or "off"
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+
+
+class InMemoryLRUCache:
+    """Per-process LRU cache with a TTL on every entry."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MongoResponseCache:
+    """
+    Cache shared by every worker and host, stored in a MongoDB collection.
+    Expiry is handled by a TTL index on expires_at; the in-memory tier in
+    front of it provides the LRU bound per process.
+    """
+
+    def __init__(self, collection, ttl_seconds, local_cache):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.local_cache = local_cache
+
+    def get(self, key):
+        value = self.local_cache.get(key)
+        if value is not None:
+            return value
+        doc = self.collection.find_one({'_id': key, 'expires_at': {'$gt': datetime.now(timezone.utc)}}, {'value': 1})
+        if doc is None:
+            return None
+        self.local_cache.set(key, doc['value'])
+        return doc['value']
+
+    def set(self, key, value):
+        self.local_cache.set(key, value)
+        self.collection.replace_one(
+            {'_id': key},
+            {'value': value, 'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)},
+            upsert=True
+        )
+
+    def __len__(self):
+        return len(self.local_cache)
+
+
+def _normalise_part(part):
+    if 'text' in part:
+        return {'text': re.sub(r'\s+', ' ', part['text']).strip()}
+    return part
+
+
+def response_cache_key(contents):
+    normalised = [
+        {'role': turn.get('role'), 'parts': [_normalise_part(part) for part in turn.get('parts', [])]}
+        for turn in contents
+    ]
+    encoded = json.dumps({'url': GEMINI_API_URL, 'contents': normalised}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+response_cache = None
+if RESPONSE_CACHE_BACKEND == 'memory':
+    response_cache = InMemoryLRUCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS)
+elif RESPONSE_CACHE_BACKEND == 'mongo' and mongo_db is not None:
+    response_cache = MongoResponseCache(
+        mongo_db['response_cache'],
+        RESPONSE_CACHE_TTL_SECONDS,
+        InMemoryLRUCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS)
+    )
+response_cache_stats = {"hits": 0, "misses": 0}
+metrics.counter_callback(
+    'phantom_response_cache_lookups_total', 'Gemini response cache lookups by result.',
+    lambda: {(result,): count for result, count in response_cache_stats.items()}, ('result',)
+)
+
+
+def cached_gemini_response(cache_key):
+    if response_cache is None or cache_key is None:
+        return None
+    cached = response_cache.get(cache_key)
+    response_cache_stats["hits" if cached is not None else "misses"] += 1
+    return cached
+
+
+def store_gemini_response(cache_key, gemini_response):
+    # Only cache real answers; blocked prompts and errors should be retried upstream
+    if response_cache is not None and cache_key is not None and extract_gemini_text(gemini_response).strip():
+        response_cache.set(cache_key, gemini_response)
+
+
+# --- Server-side session store ---
+# The cookie carries only an opaque session id. Session data (just the user's identity;
+# profile fields are loaded lazily, see load_user_profile) lives in a per-process LRU
+# in front of a MongoDB collection with a TTL index, so it works across gunicorn hosts.
+SERVER_SIDE_SESSIONS = os.getenv("SERVER_SIDE_SESSIONS", "true").lower() in ("1", "true", "yes")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", str(7 * 24 * 3600)))
+SESSION_LOCAL_CACHE_ENTRIES = int(os.getenv("SESSION_LOCAL_CACHE_ENTRIES", "10000"))
+# Entries in the local tier are re-read from the shared store after this long,
+# so a logout on one host is seen by the others
+SESSION_LOCAL_CACHE_SECONDS = int(os.getenv("SESSION_LOCAL_CACHE_SECONDS", "60"))
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.rotate = False
+
+    def regenerate(self):
+        """Issue a fresh session id on the next save (call on login to prevent session fixation)."""
+        self.rotate = True
+        self.modified = True
+
+
+class ServerSideSessionInterface(SessionInterface):
+
+    def __init__(self, collection, ttl_seconds, local_cache):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.local_cache = local_cache
+        self.stats = {"local_hits": 0, "store_hits": 0, "misses": 0, "writes": 0}
+
+    @staticmethod
+    def _store_key(sid):
+        # Only a hash of the id is stored, so a database dump can't be replayed as cookies
+        return hashlib.sha256(sid.encode('utf-8')).hexdigest()
+
+    def _load(self, sid):
+        data = self.local_cache.get(sid)
+        if data is not None:
+            self.stats["local_hits"] += 1
+            return data
+        if self.collection is not None:
+            doc = self.collection.find_one(
+                {'_id': self._store_key(sid), 'expires_at': {'$gt': datetime.now(timezone.utc)}}, {'data': 1}
+            )
+            if doc is not None:
+                self.stats["store_hits"] += 1
+                self.local_cache.set(sid, doc['data'])
+                return doc['data']
+        self.stats["misses"] += 1
+        return None
+
+    def _delete(self, sid):
+        self.local_cache.delete(sid)
+        if self.collection is not None:
+            self.collection.delete_one({'_id': self._store_key(sid)})
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self._load(sid)
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        cookie_name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self._delete(session.sid)
+                response.delete_cookie(cookie_name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+
+        if session.rotate and not session.new:
+            self._delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+        data = dict(session)
+        self.local_cache.set(session.sid, data)
+        if self.collection is not None:
+            self.collection.replace_one(
+                {'_id': self._store_key(session.sid)},
+                {'data': data, 'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)},
+                upsert=True
+            )
+        self.stats["writes"] += 1
+        response.set_cookie(
+            cookie_name, session.sid,
+            max_age=self.ttl_seconds,
+            httponly=self.get_cookie_httponly(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            domain=domain,
+            path=path
+        )
+
+
+if SERVER_SIDE_SESSIONS:
+    app.session_interface = ServerSideSessionInterface(
+        storage_db['web_sessions'] if storage_db is not None else None,
+        SESSION_TTL_SECONDS,
+        InMemoryLRUCache(SESSION_LOCAL_CACHE_ENTRIES, SESSION_LOCAL_CACHE_SECONDS)
+    )
+    metrics.counter_callback(
+        'phantom_session_store_events_total', 'Server-side session loads (local_hits, store_hits, misses) and writes.',
+        lambda: {(event,): count for event, count in app.session_interface.stats.items()}, ('event',)
     )
-    print(f"--- BACKEND: User {email} info saved/updated in MongoDB. ---")
+
+
+def start_user_session(user_id):
+    """Logs a user in. Only the identity goes into the session, under a fresh session id."""
+    session.clear()
+    if isinstance(session, ServerSideSession):
+        session.regenerate()
+    session['user'] = {'sub': user_id}
+    session['google_id'] = user_id # 'sub' from Google or '_id' for traditional users
+
+
+# --- Lazily loaded user profile (not kept in the session) ---
+DEFAULT_USER_PROFILE = {
+    "display_name": "Guest", "email": "", "picture_url": None,
+    "theme": "theme-dark", "language": "en-US", "voice": ""
+}
+USER_PROFILE_CACHE_ENTRIES = int(os.getenv("USER_PROFILE_CACHE_ENTRIES", "10000"))
+# Profiles are written through on update and refreshed on login; the TTL bounds how long
+# another host can serve a stale copy
+USER_PROFILE_CACHE_SECONDS = int(os.getenv("USER_PROFILE_CACHE_SECONDS", "300"))
+user_profile_cache = InMemoryLRUCache(USER_PROFILE_CACHE_ENTRIES, USER_PROFILE_CACHE_SECONDS)
+metrics.counter_callback(
+    'phantom_user_profile_cache_lookups_total', 'User profile cache lookups by result.',
+    lambda: {(result,): count for result, count in user_profile_cache.stats.items()}, ('result',)
+)
+
+
+def user_query_filter(user_id):
+    # Traditional users are keyed by their ObjectId, Google users by their 'sub'
+    return {'_id': ObjectId(user_id)} if ObjectId.is_valid(user_id) else {'google_id': user_id}
+
+
+def cache_user_profile(user_id, user_doc):
+    """Stores the profile fields of a freshly read or written user document and returns them."""
+    profile = {key: (user_doc or {}).get(key) or default for key, default in DEFAULT_USER_PROFILE.items()}
+    user_profile_cache.set(user_id, profile)
+    g.user_profile = profile
+    return profile
+
+
+def load_user_profile(user_id):
+    """Profile and settings for the logged-in user: per-request memo, then the process cache, then MongoDB."""
+    if 'user_profile' not in g:
+        profile = user_profile_cache.get(user_id)
+        if profile is not None:
+            g.user_profile = profile
+        elif users_collection is not None:
+            user_doc = users_collection.find_one(user_query_filter(user_id), {key: 1 for key in DEFAULT_USER_PROFILE})
+            # A missing user isn't cached, so the defaults aren't pinned once the document exists
+            if user_doc is not None:
+                return cache_user_profile(user_id, user_doc)
+            g.user_profile = dict(DEFAULT_USER_PROFILE)
+        else:
+            g.user_profile = dict(DEFAULT_USER_PROFILE)
+    return g.user_profile
+
+
+# --- Write-behind persistence for chat turns ---
+# Message inserts and session bumps from /api/chat are queued and written in batches off the
+# request path; see writebehind.py. Reads of a session flush its own pending writes first.
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "true").lower() in ("1", "true", "yes")
+WRITE_BEHIND_FLUSH_MS = int(os.getenv("WRITE_BEHIND_FLUSH_MS", "100"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+
+message_writer = None
+if MESSAGE_WRITE_BEHIND and messages_collection is not None:
+    message_writer = writebehind.WriteBehindWriter(
+        messages_collection,
+        chat_sessions_collection,
+        flush_interval=WRITE_BEHIND_FLUSH_MS / 1000,
+        batch_size=WRITE_BEHIND_BATCH_SIZE,
+        max_pending=WRITE_BEHIND_MAX_PENDING
+    )
+    atexit.register(message_writer.close)
+    metrics.gauge_callback('phantom_write_behind_pending_messages', 'Chat messages queued but not yet written.',
+                           lambda: {(): message_writer.pending})
+    metrics.counter_callback(
+        'phantom_write_behind_events_total', 'Write-behind messages queued/written and batch outcomes.',
+        lambda: {(event,): count for event, count in message_writer.stats.items()}, ('event',)
+    )
+
+
+def persist_message(document):
+    """Stores a chat message, through the write-behind queue when it is enabled."""
+    if message_writer is not None:
+        return message_writer.add_message(document)
+    return messages_collection.insert_one(document).inserted_id
+
+
+def flush_session_writes(session_id_obj, user_id):
+    """Read-your-writes: call before reading a session's messages."""
+    if message_writer is not None:
+        message_writer.flush_session(session_id_obj, user_id)
+
+
+def touch_chat_session(session_id_obj, user_id):
+    """
+    Bumps the session's last_updated after checking that the user owns it.
+    Returns the session's title and rolling summary, or None if not found/owned.
+    """
+    projection = {'title': 1, 'summary': 1, 'summary_until': 1}
+    if message_writer is not None:
+        session_doc = chat_sessions_collection.find_one({'_id': session_id_obj, 'user_id': user_id}, projection)
+        if session_doc:
+            message_writer.touch_session(session_id_obj, user_id, datetime.now(timezone.utc))
+        return session_doc
+    return chat_sessions_collection.find_one_and_update(
+        {'_id': session_id_obj, 'user_id': user_id},
+        {'$set': {'last_updated': datetime.now(timezone.utc)}},
+        projection=projection,
+        return_document=ReturnDocument.AFTER
+    )
+
+
+# --- Session deletion ---
+# Deleted sessions disappear at once; their messages are removed afterwards in small
+# chunks by a background purger working from the session_purges collection.
+SESSION_PURGE_CHUNK_SIZE = int(os.getenv("SESSION_PURGE_CHUNK_SIZE", "500"))
+SESSION_PURGE_PAUSE_MS = int(os.getenv("SESSION_PURGE_PAUSE_MS", "50"))
+BULK_DELETE_MAX_SESSIONS = 1000
+
+session_purger = None
+if messages_collection is not None:
+    session_purger = purge.SessionPurger(
+        messages_collection,
+        storage_db['session_purges'],
+        chunk_size=SESSION_PURGE_CHUNK_SIZE,
+        pause_seconds=SESSION_PURGE_PAUSE_MS / 1000
+    )
+    metrics.gauge_callback('phantom_session_purge_backlog', 'Deleted sessions whose messages are still to be purged.',
+                           lambda: {(): session_purger.backlog()})
+    metrics.counter_callback(
+        'phantom_session_purge_events_total', 'Session purge progress (sessions, messages, chunks, errors).',
+        lambda: {(event,): count for event, count in session_purger.stats.items()}, ('event',)
+    )
+
+
+def delete_chat_sessions(user_id, session_ids=None):
+    """
+    Deletes the given sessions (or, with None, all of the user's sessions) and queues
+    their messages for purging. Ids the user doesn't own are ignored. Returns the count deleted.
+    """
+    query_filter = {'user_id': user_id}
+    if session_ids is not None:
+        query_filter['_id'] = {'$in': session_ids}
+    owned_ids = [doc['_id'] for doc in chat_sessions_collection.find(query_filter, {'_id': 1})]
+    if not owned_ids:
+        return 0
+    # Jobs go in first, so a crash in between can't leave messages nobody will purge
+    if session_purger is not None:
+        session_purger.enqueue(user_id, owned_ids)
+    if message_writer is not None:
+        # Queued writes for these sessions would otherwise recreate their messages
+        for session_id_obj in owned_ids:
+            message_writer.discard_session(session_id_obj, user_id)
+    result = chat_sessions_collection.delete_many({'_id': {'$in': owned_ids}, 'user_id': user_id})
+    return result.deleted_count
+
+
+# --- Image attachments ---
+# Images are uploaded once to /api/attachments and referenced from messages by content hash;
+# see attachments.py. Metadata and owners live in the `attachments` collection.
+ATTACHMENT_STORAGE = os.getenv("ATTACHMENT_STORAGE", "gridfs").lower()  # "gridfs" or "disk"
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'attachments'))
+ATTACHMENT_MAX_UPLOAD_BYTES = int(os.getenv("ATTACHMENT_MAX_UPLOAD_MB", "10")) * 1024 * 1024
+ATTACHMENT_MAX_DIMENSION = int(os.getenv("ATTACHMENT_MAX_DIMENSION", "1536"))
+ATTACHMENT_JPEG_QUALITY = int(os.getenv("ATTACHMENT_JPEG_QUALITY", "85"))
+
+attachments_collection = storage_db['attachments'] if storage_db is not None else None
+attachment_blobs = None
+_attachment_blobs_lock = threading.Lock()
+
+
+def get_attachment_blobs():
+    """Opens the blob store on first use, so importing the app never creates ATTACHMENT_DIR."""
+    global attachment_blobs
+    if attachment_blobs is None:
+        with _attachment_blobs_lock:
+            if attachment_blobs is None:
+                if ATTACHMENT_STORAGE == 'disk' or mongo_db is None:  # GridFS needs MongoDB
+                    attachment_blobs = attachments.DiskBlobStore(ATTACHMENT_DIR)
+                else:
+                    attachment_blobs = attachments.GridFSBlobStore(mongo_db)
+    return attachment_blobs
+
+
+def resolve_attachment_parts(contents):
+    """Copy of `contents` with {"attachment": ...} parts replaced by inlineData for the Gemini request."""
+    resolved = []
+    for turn in contents:
+        parts = []
+        for part in turn.get('parts', []):
+            if 'attachment' in part:
+                data = get_attachment_blobs().get(part['attachment']['id'])
+                part = {'inlineData': {'mimeType': part['attachment']['mimeType'],
+                                       'data': base64.b64encode(data).decode('ascii')}}
+            parts.append(part)
+        resolved.append({**turn, 'parts': parts})
+    return resolved
+
+
+# --- Helper to persist a model reply for a chat session ---
+def save_model_message(session_id, user_id, model_response_text):
+    if messages_collection is None:
+        log.warning("model message not saved: MongoDB not connected")
+        return
+    persist_message({
+        "session_id": ObjectId(session_id), # Store as ObjectId
+        "user_id": user_id,
+        "role": "model",
+        "content": model_response_text,
+        "timestamp": datetime.now(timezone.utc),
+        "type": "text"
+    })
+    log.debug("model message saved", extra={'fields': {'session_id': str(session_id), 'chars': len(model_response_text)}})
+
+
+# --- Helper to pull the text out of a (partial) Gemini response ---
+def extract_gemini_text(gemini_response):
+    candidates = gemini_response.get('candidates') or []
+    if candidates and candidates[0].get('content') and candidates[0]['content'].get('parts'):
+        return "".join(part.get('text', '') for part in candidates[0]['content']['parts'])
+    return ""
+
+
+def sse_event(data, event=None):
+    """Formats a single Server-Sent Events frame."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+
+def stream_cached_response(gemini_response, session_id, user_id):
+    """Replays a cached answer over SSE in a single chunk and saves it like a fresh reply."""
+    model_response_text = extract_gemini_text(gemini_response)
+    save_model_message(session_id, user_id, model_response_text)
+    yield sse_event({"text": model_response_text})
+    yield sse_event({"text": model_response_text, "cached": True}, event="done")
+
+
+def stream_gemini_response(gemini_payload, session_id, user_id, cache_key=None):
+    """
+    Relays a streamGenerateContent call to the browser as SSE and saves the
+    full model message once the upstream stream has finished.
+    """
+    chunks = []
+    completed = False
+    blocked = False
+    usage_chunk = None
+    started = time.perf_counter()
+    ticket = gemini_scheduler.submit(user_id, queue_timeout=GEMINI_QUEUE_TIMEOUT)
+    try:
+        while not gemini_scheduler.wait(ticket, GEMINI_QUEUE_KEEPALIVE_SECONDS):
+            # If the client has gone, this write fails and closing the generator releases the ticket
+            yield ": queued\n\n"
+        started = time.perf_counter()
+        with gemini_post(
+            GEMINI_STREAM_API_URL,
+            gemini_payload,
+            stream=True,
+            timeout=(GEMINI_STREAM_CONNECT_TIMEOUT, GEMINI_STREAM_READ_TIMEOUT)
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                gemini_chunk = json.loads(line[len('data:'):].strip())
+                if gemini_chunk.get('usageMetadata'):
+                    usage_chunk = gemini_chunk  # Counts are cumulative; the last one wins
+                if gemini_chunk.get('promptFeedback', {}).get('blockReason'):
+                    blocked = True
+                    text = f"Sorry, your request was blocked due to: {gemini_chunk['promptFeedback']['blockReason']}."
+                else:
+                    text = extract_gemini_text(gemini_chunk)
+                if text:
+                    chunks.append(text)
+                    yield sse_event({"text": text})
+            completed = True
+    except UpstreamUnavailableError:
+        yield sse_event({"message": "Backend: Gemini API is temporarily unavailable. Please try again shortly."}, event="error")
+    except scheduler.QueueTimeoutError:
+        yield sse_event({"message": "Backend: Too many requests are waiting for Gemini. Please try again shortly."}, event="error")
+    except requests.exceptions.Timeout:
+        app.logger.error("Backend: Gemini streaming request stalled.")
+        yield sse_event({"message": "Backend: Gemini API request timed out."}, event="error")
+    except requests.exceptions.HTTPError as element:
+        status_code = element.response.status_code
+        app.logger.error(f"Backend HTTP Error calling Gemini streaming API: Status {status_code}, Message: {element.response.text}")
+        yield sse_event({"message": f"Backend: Error from Gemini API: Status {status_code}"}, event="error")
+    except requests.exceptions.RequestException as element:
+        app.logger.error(f"Backend: Error connecting to Gemini API: {element}")
+        yield sse_event({"message": f"Backend: Error connecting to Gemini API: {element}"}, event="error")
+    finally:
+        gemini_scheduler.release(ticket)
+        gemini_stream_seconds.observe(time.perf_counter() - started, outcome='completed' if completed else 'interrupted')
+        record_gemini_usage(usage_chunk)
+        # Persist whatever was produced, even if the client went away mid-stream.
+        model_response_text = "".join(chunks)
+        if model_response_text.strip():
+            save_model_message(session_id, user_id, model_response_text)
+        if completed and not blocked:
+            store_gemini_response(cache_key, {"candidates": [{"content": {"role": "model", "parts": [{"text": model_response_text}]}}]})
+    yield sse_event({"text": "".join(chunks)}, event="done")
+
+
+# --- Chat session titles ---
+DEFAULT_SESSION_TITLE = "New Chat Session"
+SESSIONS_PAGE_SIZE = int(os.getenv("SESSIONS_PAGE_SIZE", "50"))
+SESSIONS_MAX_PAGE_SIZE = 200
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+SEARCH_MAX_OFFSET = 500  # Text results are ranked, so pages are offsets; deep ones get expensive
+SEARCH_MAX_QUERY_CHARS = 200
+SEARCH_SNIPPET_CHARS = 160
+
+
+def make_session_title(first_message_content):
+    session_title = (first_message_content or 'Untitled Chat')[:40]
+    if len(first_message_content or '') > 40:
+        session_title += '...'
+    return session_title
+
+
+# --- Server-side conversation context (token-budgeted sliding window) ---
+# The client only sends the new user turn; earlier turns are rebuilt from messages_collection.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "50"))
+CONTEXT_SUMMARY_ENABLED = os.getenv("CONTEXT_SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes")
+# Older turns are folded into the rolling summary once at least this many have fallen out of the window
+CONTEXT_SUMMARY_MIN_TURNS = int(os.getenv("CONTEXT_SUMMARY_MIN_TURNS", "6"))
+# Each summary pass folds at most this many turns / characters, oldest first, so the first summary of a
+# long or imported session is built over several passes instead of one prompt over Gemini's input limit
+CONTEXT_SUMMARY_BATCH_TURNS = int(os.getenv("CONTEXT_SUMMARY_BATCH_TURNS", "40"))
+CONTEXT_SUMMARY_MAX_CHARS = int(os.getenv("CONTEXT_SUMMARY_MAX_CHARS", "32000"))
+CONTEXT_SUMMARY_MAX_PASSES = 4
+# What an image in an earlier turn costs against the budget (Gemini bills a small image as 258 tokens)
+CONTEXT_IMAGE_TOKENS = int(os.getenv("CONTEXT_IMAGE_TOKENS", "258"))
+IMAGE_PLACEHOLDER = re.compile(r'\s*\[Image Data\]\s*')
+
+_summaries_in_flight = set()
+_summaries_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    # Roughly 4 characters per token for English text; good enough for budgeting.
+    return len(text) // 4 + 1
+
+
+def stored_turn_parts(msg, attachment_types):
+    """
+    Gemini parts for a stored message: its text, plus an attachment part for each image it
+    referenced (turned into inlineData by resolve_attachment_parts). Images the user no
+    longer has are left out.
+    """
+    content = msg.get('content', '')
+    attachment_parts = [{'attachment': {'id': attachment_id, 'mimeType': attachment_types[attachment_id]}}
+                        for attachment_id in msg.get('attachments', ()) if attachment_id in attachment_types]
+    if msg.get('attachments'):
+        # The stored text stands in for the images with placeholders; the images themselves go back in
+        content = IMAGE_PLACEHOLDER.sub(' ', content).strip()
+    return ([{'text': content}] if content or not attachment_parts else []) + attachment_parts
+
+
+def build_conversation_context(session_id_obj, user_id, session_doc, token_budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Returns (contents, window_start, truncated). contents holds the rolling summary (if any)
+    followed by as many recent turns as fit in the token budget, oldest first.
+    window_start is the timestamp of the oldest turn included, and truncated tells
+    whether older turns may have been left out.
+    """
+    summary = (session_doc or {}).get('summary')
+    if summary:
+        token_budget -= estimate_tokens(summary)
+
+    recent_turns = []
+    window_start = None
+    truncated = False
+    if messages_collection is not None:
+        flush_session_writes(session_id_obj, user_id)
+        messages = list(messages_collection.find(
+            {'session_id': session_id_obj, 'user_id': user_id},
+            {'role': 1, 'content': 1, 'timestamp': 1, 'attachments': 1}
+        ).sort('timestamp', -1).limit(CONTEXT_MAX_TURNS))
+        # One lookup for every image in the window, limited to the ones the user still owns
+        attachment_ids = list({attachment_id for msg in messages for attachment_id in msg.get('attachments', ())})
+        attachment_types = {}
+        if attachment_ids and attachments_collection is not None:
+            attachment_types = {doc['_id']: doc['mime_type'] for doc in attachments_collection.find(
+                {'_id': {'$in': attachment_ids}, 'owners': user_id}, {'mime_type': 1}
+            )}
+        for msg in messages:
+            parts = stored_turn_parts(msg, attachment_types)
+            token_budget -= sum(estimate_tokens(part['text']) if 'text' in part else CONTEXT_IMAGE_TOKENS
+                                for part in parts)
+            if token_budget < 0:
+                truncated = True
+                break
+            recent_turns.append({'role': msg['role'], 'parts': parts})
+            window_start = msg.get('timestamp')
+        truncated = truncated or len(recent_turns) >= CONTEXT_MAX_TURNS
+        recent_turns.reverse()
+
+    contents = []
+    if summary:
+        contents.append({'role': 'user', 'parts': [{'text': f"Summary of the earlier conversation:\n{summary}"}]})
+    contents.extend(recent_turns)
+    return contents, window_start, truncated
+
+
+def schedule_summary_refresh(session_id_obj, user_id, window_start):
+    """Runs refresh_session_summary in the background, unless this process already is for the session."""
+    key = (session_id_obj, user_id)
+    with _summaries_lock:
+        if key in _summaries_in_flight:
+            return
+        _summaries_in_flight.add(key)
+
+    def run():
+        try:
+            refresh_session_summary(session_id_obj, user_id, window_start)
+        finally:
+            with _summaries_lock:
+                _summaries_in_flight.discard(key)
+
+    threading.Thread(target=run, name='session-summary', daemon=True).start()
+
+
+def refresh_session_summary(session_id_obj, user_id, window_start):
+    """
+    Folds turns that have slid out of the context window into the rolling summary
+    stored on the chat_sessions document, a bounded batch per pass, advancing
+    summary_until after each. Runs off the request path.
+    """
+    try:
+        for _ in range(CONTEXT_SUMMARY_MAX_PASSES):
+            session_doc = chat_sessions_collection.find_one({'_id': session_id_obj, 'user_id': user_id},
+                                                            {'summary': 1, 'summary_until': 1})
+            if not session_doc:
+                return
+            time_filter = {'$lt': window_start}
+            if session_doc.get('summary_until'):
+                time_filter['$gt'] = session_doc['summary_until']
+            dropped = list(messages_collection.find(
+                {'session_id': session_id_obj, 'user_id': user_id, 'timestamp': time_filter},
+                {'role': 1, 'content': 1, 'timestamp': 1}
+            ).sort('timestamp', 1).limit(CONTEXT_SUMMARY_BATCH_TURNS))
+            if len(dropped) < CONTEXT_SUMMARY_MIN_TURNS:
+                return
+
+            lines = []
+            used = 0
+            for msg in dropped:
+                line = f"{msg['role']}: {msg.get('content', '')[:CONTEXT_SUMMARY_MAX_CHARS]}"
+                if lines and used + len(line) > CONTEXT_SUMMARY_MAX_CHARS:
+                    break
+                lines.append(line)
+                used += len(line)
+                summary_until = msg['timestamp']
+            prompt = (
+                "Update the running summary of a conversation. Keep names, facts, decisions and open questions. "
+                "Reply with the summary only, under 200 words.\n\n"
+                f"Current summary:\n{session_doc.get('summary') or '(none)'}\n\nNew turns:\n" + "\n".join(lines)
+            )
+            response = scheduled_gemini_post(GEMINI_API_URL, {"contents": [{"role": "user", "parts": [{"text": prompt}]}]},
+                                             user_id, priority='background', timeout=30)
+            response.raise_for_status()
+            summary_response = response.json()
+            record_gemini_usage(summary_response)
+            summary = extract_gemini_text(summary_response).strip()
+            if not summary:
+                return
+            chat_sessions_collection.update_one(
+                {'_id': session_id_obj, 'user_id': user_id},
+                {'$set': {'summary': summary, 'summary_until': summary_until}}
+            )
+    except Exception as element:
+        app.logger.error(f"Failed to refresh summary for session {session_id_obj}: {element}", exc_info=True)
 
 
 # --- Flask Routes ---
@@ -159,63 +1246,161 @@ def dashboard():
         return redirect(url_for('login')) 
     
     # If a user exists, show the dashboard
+    profile = load_user_profile(session['google_id'])
     return render_template('dashboard.html', 
-                           user_display_name=session.get('user_display_name', 'Guest'),
-                           user_email=session.get('user_email', ''),
-                           user_picture_url=session.get('user_picture'),
-                           user_theme=session.get('user_theme', 'theme-dark'),
-                           user_language=session.get('user_language', 'en-US'),
-                           user_voice=session.get('user_voice', '')
+                           user_display_name=profile['display_name'],
+                           user_email=profile['email'],
+                           user_picture_url=profile['picture_url'],
+                           user_theme=profile['theme'],
+                           user_language=profile['language'],
+                           user_voice=profile['voice']
                            )
 
 @app.route('/login/google')
 def login_google():
     redirect_uri = url_for('authorize', _external=True) # This line is key
-    return google.authorize_redirect(redirect_uri)
+    return get_google_oauth().authorize_redirect(redirect_uri)
 
 @app.route('/authorize')
 def authorize():
     try:
-        token = google.authorize_access_token()
+        token = get_google_oauth().authorize_access_token()
         
         if not token or 'id_token' not in token:
             app.logger.error(f"Google Authorization failed: No id_token in response: {token}")
             return render_template('login.html', error_message="Authorization failed: No ID token from Google.")
         
+        import jwt  # Only needed here; see get_google_oauth
         userinfo = jwt.decode(token['id_token'], options={"verify_signature": False}) 
 
-        # Store Google user info in session
-        session['user'] = userinfo
-        session['user_email'] = userinfo.get('email')
-        session['user_display_name'] = userinfo.get('name') or userinfo.get('email', '').split('@')[0]
-        session['google_id'] = userinfo.get('sub') # Google's unique user ID
-        session['user_picture'] = userinfo.get('picture')
-
-        # Save/update user info in DB
-        save_user_info_to_db(
-            email=session['user_email'],
-            display_name=session['user_display_name'],
-            google_id=session['google_id'],
-            picture_url=session['user_picture']
+        google_id = userinfo.get('sub') # Google's unique user ID
+
+        # Save/update user info in DB; profile and settings are loaded from there when needed
+        user_doc = save_user_info_to_db(
+            email=userinfo.get('email'),
+            display_name=userinfo.get('name') or userinfo.get('email', '').split('@')[0],
+            google_id=google_id,
+            picture_url=userinfo.get('picture')
         )
-        
-        # Load user settings from DB for Google users
-        user_doc = users_collection.find_one({'google_id': session['google_id']})
-        if user_doc:
-            session['user_theme'] = user_doc.get('theme', 'theme-dark')
-            session['user_language'] = user_doc.get('language', 'en-US')
-            session['user_voice'] = user_doc.get('voice', '')
-        else: # Set defaults if new user (should be handled by save_user_info_to_db, but for safety)
-            session['user_theme'] = 'theme-dark'
-            session['user_language'] = 'en-US'
-            session['user_voice'] = ''
 
+        start_user_session(google_id)
+        # Refresh the cached profile from the upserted document rather than reading it again
+        if user_doc is not None:
+            cache_user_profile(google_id, user_doc)
+        else:
+            user_profile_cache.delete(google_id)
 
         return redirect(url_for('dashboard'))
+    except EmailInUseError:
+        return render_template('login.html', error_message="An account with this email already exists. "
+                                                           "Sign in with your password instead."), 409
     except Exception as element:
         app.logger.error(f"Google Authorization final step failed: {str(element)}", exc_info=True)
         return render_template('login.html', error_message=f"Login failed: {str(element)}")
 
+# --- Password hashing and login throttling ---
+# Hashing runs on a small process pool so a login storm can't tie up every request worker;
+# once PASSWORD_HASH_MAX_QUEUE checks are in flight further ones get a 503 straight away.
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")  # any werkzeug method string
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "32"))
+LOGIN_THROTTLE_WINDOW_SECONDS = int(os.getenv("LOGIN_THROTTLE_WINDOW_SECONDS", "300"))
+LOGIN_MAX_ATTEMPTS_PER_IP = int(os.getenv("LOGIN_MAX_ATTEMPTS_PER_IP", "30"))
+LOGIN_MAX_FAILURES_PER_ACCOUNT = int(os.getenv("LOGIN_MAX_FAILURES_PER_ACCOUNT", "5"))
+
+password_hasher = None
+_password_hasher_lock = threading.Lock()
+# Every login/registration attempt counts against the IP; only failed logins count against the account
+ip_attempt_throttle = passwords.AttemptThrottle(LOGIN_MAX_ATTEMPTS_PER_IP, LOGIN_THROTTLE_WINDOW_SECONDS)
+account_failure_throttle = passwords.AttemptThrottle(LOGIN_MAX_FAILURES_PER_ACCOUNT, LOGIN_THROTTLE_WINDOW_SECONDS)
+metrics.gauge_callback('phantom_password_hash_in_flight', 'Password hash/verify jobs running or queued.',
+                       lambda: {(): password_hasher.queue_depth if password_hasher is not None else 0})
+metrics.counter_callback(
+    'phantom_password_hash_events_total', 'Password hashes, verifications and busy rejections.',
+    lambda: {(event,): count for event, count in (password_hasher.stats if password_hasher is not None else {}).items()},
+    ('event',)
+)
+
+
+def get_password_hasher():
+    """Creates the hashing pool on first use, so its processes belong to the serving worker."""
+    global password_hasher
+    if password_hasher is None:
+        with _password_hasher_lock:
+            if password_hasher is None:
+                password_hasher = passwords.PasswordHasher(
+                    PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS, max_queue=PASSWORD_HASH_MAX_QUEUE
+                )
+    return password_hasher
+
+
+def throttled_response(retry_after):
+    return jsonify({"error": "Too many attempts. Please wait before trying again."}), 429, {'Retry-After': str(retry_after)}
+
+
+def hasher_busy_response():
+    return jsonify({"error": "The server is busy. Please try again shortly."}), 503, {'Retry-After': '2'}
+
+
+# --- Per-user rate limits on the expensive routes ---
+# Each user gets a token bucket (sustained rate + burst) and a cap on in-flight requests per
+# route group; see ratelimit.py. "memory" limits per worker process, "mongo" shares them
+# across workers and hosts through the rate_limits collection.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()  # "memory", "mongo" or "off"
+RATE_LIMITS = {
+    'chat': ratelimit.Limit(
+        rate_per_minute=float(os.getenv("CHAT_RATE_PER_MINUTE", "20")),
+        burst=int(os.getenv("CHAT_BURST", "10")),
+        max_concurrent=int(os.getenv("CHAT_MAX_CONCURRENT", "3"))
+    ),
+    'run_code': ratelimit.Limit(
+        rate_per_minute=float(os.getenv("RUN_CODE_RATE_PER_MINUTE", "30")),
+        burst=int(os.getenv("RUN_CODE_BURST", "10")),
+        max_concurrent=int(os.getenv("RUN_CODE_MAX_CONCURRENT", "2"))
+    ),
+}
+
+rate_limiter = None
+if RATE_LIMIT_BACKEND == 'mongo' and mongo_db is not None:
+    rate_limiter = ratelimit.MongoLimiter(mongo_db['rate_limits'])
+elif RATE_LIMIT_BACKEND != 'off':
+    rate_limiter = ratelimit.InMemoryLimiter()
+if rate_limiter is not None:
+    metrics.counter_callback(
+        'phantom_rate_limit_events_total', 'Limited requests allowed, and rejected by rate or by concurrency.',
+        lambda: {(event,): count for event, count in rate_limiter.stats.items()}, ('event',)
+    )
+
+
+def rate_limited(group):
+    """
+    Applies RATE_LIMITS[group] to the signed-in user, answering 429 + Retry-After when it's
+    exceeded. The concurrency slot is held until the response (streamed ones included) is closed.
+    Anonymous requests pass through, so the route's own session check answers them.
+    """
+    limit = RATE_LIMITS[group]
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            user_id = session.get('google_id')
+            if rate_limiter is None or not user_id:
+                return view(*args, **kwargs)
+            slot, retry_after = rate_limiter.acquire(f'{group}:{user_id}', limit)
+            if slot is None:
+                return jsonify({"error": "Too many requests. Please slow down and try again shortly."}), 429, \
+                    {'Retry-After': str(retry_after)}
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                rate_limiter.release(slot)
+                raise
+            response.call_on_close(lambda: rate_limiter.release(slot))
+            return response
+        return wrapper
+    return decorator
+
+
 # --- NEW: API for Traditional User Registration ---
 @app.route('/api/register', methods=['POST'])
 def register_user():
@@ -230,14 +1415,22 @@ def register_user():
     if not display_name or not username or not password:
         return jsonify({"error": "Missing display name, username, or password."}), 400
 
+    retry_after = ip_attempt_throttle.retry_after(request.remote_addr)
+    if retry_after:
+        return throttled_response(retry_after)
+    ip_attempt_throttle.record(request.remote_addr)
+
     if users_collection.find_one({'email': username}):
         return jsonify({"error": "User with this email/username already exists."}), 409
 
-    hashed_password = generate_password_hash(password)
+    try:
+        hashed_password = get_password_hasher().hash(password)
+    except passwords.HasherBusyError:
+        return hasher_busy_response()
 
     try:
         user_id = str(ObjectId()) # Generate a unique ID for traditional users
-        users_collection.insert_one({
+        user_doc = {
             "_id": ObjectId(user_id), # Store as ObjectId
             "email": username,
             "display_name": display_name,
@@ -248,18 +1441,16 @@ def register_user():
             "theme": "theme-dark", # Default settings
             "language": "en-US",
             "voice": ""
-        })
+        }
+        users_collection.insert_one(user_doc)
         # Log in the user immediately after registration
-        session['user'] = {'email': username, 'name': display_name, 'sub': user_id}
-        session['user_email'] = username
-        session['user_display_name'] = display_name
-        session['google_id'] = user_id # Use this for consistency in session management
-        session['user_picture'] = None
-        session['user_theme'] = 'theme-dark'
-        session['user_language'] = 'en-US'
-        session['user_voice'] = ''
+        start_user_session(user_id)
+        cache_user_profile(user_id, user_doc)
 
         return jsonify({"message": "Registration successful", "user_id": user_id}), 201
+    except DuplicateKeyError:
+        # Registered concurrently by another request since the check above
+        return jsonify({"error": "User with this email/username already exists."}), 409
     except Exception as element:
         app.logger.error(f"Error during registration: {element}", exc_info=True)
         return jsonify({"error": "Registration failed due to server error."}), 500
@@ -277,29 +1468,48 @@ def login_user():
     if not username or not password:
         return jsonify({"error": "Missing username or password."}), 400
 
-    user = users_collection.find_one({'email': username})
+    # Throttle before touching the database or the hashing pool. The account is counted under
+    # exactly the name it is looked up by, so every spelling that reaches an account shares one budget
+    account_key = username
+    retry_after = max(ip_attempt_throttle.retry_after(request.remote_addr),
+                      account_failure_throttle.retry_after(account_key))
+    if retry_after:
+        return throttled_response(retry_after)
+    ip_attempt_throttle.record(request.remote_addr)
 
-    if user and check_password_hash(user['password_hash'], password):
+    user = users_collection.find_one({'email': account_key})
+
+    try:
+        # Unknown users and Google-only accounts (no hash) are checked against a dummy hash,
+        # so a failed login takes as long whether or not the account exists
+        password_ok = get_password_hasher().verify(user.get('password_hash') if user else None, password)
+    except passwords.HasherBusyError:
+        return hasher_busy_response()
+
+    if password_ok:
         # Determine the user_id to use in session (ObjectId for traditional, google_id for Google)
         session_user_id = str(user['_id']) if '_id' in user else user.get('google_id')
-
+        account_failure_throttle.reset(account_key)
+
+        login_update = {'last_login': datetime.now(timezone.utc)}
+        if get_password_hasher().needs_rehash(user['password_hash']):
+            # Upgrade hashes made with an older or cheaper KDF while the plain password is at hand
+            try:
+                login_update['password_hash'] = get_password_hasher().hash(password)
+            except passwords.HasherBusyError:
+                pass # Try again on a later login
         # Update last login time
         users_collection.update_one(
-            {'$or': [{'_id': user.get('_id')}, {'google_id': user.get('google_id')}]},
-            {'$set': {'last_login': datetime.now(timezone.utc)}}
+            {'_id': user['_id']},
+            {'$set': login_update}
         )
-        # Set session variables
-        session['user'] = {'email': user['email'], 'name': user['display_name'], 'sub': session_user_id}
-        session['user_email'] = user['email']
-        session['user_display_name'] = user['display_name']
-        session['google_id'] = session_user_id # Use this for consistency
-        session['user_picture'] = user.get('picture_url')
-        session['user_theme'] = user.get('theme', 'theme-dark')
-        session['user_language'] = user.get('language', 'en-US')
-        session['user_voice'] = user.get('voice', '')
+        start_user_session(session_user_id)
+        # The document just read is current, so the dashboard doesn't need to read it again
+        cache_user_profile(session_user_id, user)
 
         return jsonify({"message": "Login successful"}), 200
     else:
+        account_failure_throttle.record(account_key)
         return jsonify({"error": "Invalid username or password."}), 401
 
 # --- NEW: API for updating user profile and settings ---
@@ -313,7 +1523,7 @@ def update_profile():
     
     try:
         # Construct query filter to find the user, handling both ObjectId and string google_id
-        query_filter = {'_id': ObjectId(user_id)} if ObjectId.is_valid(user_id) else {'google_id': user_id}
+        query_filter = user_query_filter(user_id)
 
         update_fields = {}
         if 'displayName' in data:
@@ -330,32 +1540,30 @@ def update_profile():
         if not update_fields:
             return jsonify({"error": "No fields to update."}), 400
 
-        users_collection.update_one(
+        updated_user = users_collection.find_one_and_update(
             query_filter,
-            {'$set': update_fields}
+            {'$set': update_fields},
+            projection={key: 1 for key in DEFAULT_USER_PROFILE},
+            return_document=ReturnDocument.AFTER
         )
-        
-        # Refresh session with new data
-        updated_user = users_collection.find_one(query_filter)
-        if updated_user:
-            session['user_display_name'] = updated_user.get('display_name')
-            session['user_email'] = updated_user.get('email')
-            session['user_picture'] = updated_user.get('picture_url')
-            session['user_theme'] = updated_user.get('theme', 'theme-dark')
-            session['user_language'] = updated_user.get('language', 'en-US')
-            session['user_voice'] = updated_user.get('voice', '')
-
+        if updated_user is None:
+            user_profile_cache.delete(user_id)
+            return jsonify({"error": "User not found."}), 404
+        # Write-through, so the next page load sees the new settings without a read
+        cache_user_profile(user_id, updated_user)
         return jsonify({
             "message": "Profile updated successfully",
             "user": {
-                "displayName": session['user_display_name'],
-                "email": session['user_email'],
-                "pictureUrl": session['user_picture'],
-                "theme": session['user_theme'],
-                "language": session['user_language'],
-                "voice": session['user_voice']
+                "displayName": updated_user.get('display_name'),
+                "email": updated_user.get('email'),
+                "pictureUrl": updated_user.get('picture_url'),
+                "theme": updated_user.get('theme', 'theme-dark'),
+                "language": updated_user.get('language', 'en-US'),
+                "voice": updated_user.get('voice', '')
             }
         }), 200
+    except DuplicateKeyError:
+        return jsonify({"error": "That email is already used by another account."}), 409
     except Exception as element:
         app.logger.error(f"Error updating profile for user {user_id}: {element}", exc_info=True)
         return jsonify({"error": "Failed to update profile."}), 500
@@ -368,30 +1576,46 @@ def get_all_sessions():
 
     user_id = session['google_id'] # Use google_id or _id for traditional users
     try:
+        limit = min(max(int(request.args.get('limit', SESSIONS_PAGE_SIZE)), 1), SESSIONS_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer."}), 400
+
+    # Keyset pagination on (last_updated, _id): the cursor is the last row of the previous page
+    query_filter = {'user_id': user_id}
+    page_cursor = request.args.get('cursor')
+    if page_cursor:
+        try:
+            cursor_time, cursor_id = page_cursor.rsplit('|', 1)
+            cursor_time = datetime.fromisoformat(cursor_time)
+            cursor_id = ObjectId(cursor_id)
+        except Exception:
+            return jsonify({"error": "Invalid cursor."}), 400
+        query_filter['$or'] = [
+            {'last_updated': {'$lt': cursor_time}},
+            {'last_updated': cursor_time, '_id': {'$lt': cursor_id}}
+        ]
+
+    try:
+        # Titles are stored when the first message is saved, so this is a single projected query
         sessions_cursor = chat_sessions_collection.find(
-            {'user_id': user_id}
-        ).sort('last_updated', -1)  # Sort by the most recent update first
-        
+            query_filter,
+            {'title': 1, 'last_updated': 1, 'created_at': 1}
+        ).sort([('last_updated', -1), ('_id', -1)]).limit(limit + 1)  # Most recent first; one extra row tells us if there is another page
+
         all_sessions = []
+        next_cursor = None
         for s in sessions_cursor:
-            session_title = s.get('title', 'New Chat Session')
-            # If the title is still default, try to get it from the first message
-            if session_title == "New Chat Session": # Original default title
-                first_message = messages_collection.find_one({'session_id': s['_id'], 'role': 'user'})
-                if first_message:
-                    session_title = first_message.get('content', 'Untitled Chat')[:40]
-                    if len(first_message.get('content', '')) > 40:
-                        session_title += '...'
-                    # Update the title in the DB to avoid re-calculating next time
-                    chat_sessions_collection.update_one({'_id': s['_id']}, {'$set': {'title': session_title}})
-            
+            if len(all_sessions) == limit:
+                last = all_sessions[-1]
+                next_cursor = f"{last['last_updated']}|{last['session_id']}"
+                break
             all_sessions.append({
                 "session_id": str(s['_id']),
-                "title": session_title,
+                "title": s.get('title', DEFAULT_SESSION_TITLE),
                 "last_updated": s.get('last_updated', s['created_at']).isoformat()
             })
         
-        return jsonify({"sessions": all_sessions}), 200
+        return jsonify({"sessions": all_sessions, "next_cursor": next_cursor}), 200
     except Exception as element:
         app.logger.error(f"Error fetching all sessions for user {user_id}: {element}", exc_info=True)
         return jsonify({"error": "Failed to load chat history."}), 500
@@ -410,20 +1634,18 @@ def new_chat_session_api():
         "user_id": user_id,
         "created_at": datetime.now(timezone.utc),
         "last_updated": datetime.now(timezone.utc),
-        "title": "New Chat Session" # Default title
+        "title": DEFAULT_SESSION_TITLE # Replaced by the first user message in chat_api
     }
     chat_sessions_collection.insert_one(chat_session_data)
-    print(f"DEBUG: New chat session created in DB: {new_session_id}")
-
-    # Optionally, set this as the current session in Flask session
-    session['current_chat_session_id'] = new_session_id
+    log.debug("chat session created", extra={'fields': {'session_id': new_session_id}})
 
     return jsonify({"message": "New chat session created", "session_id": new_session_id}), 200
 
 # --- MODIFIED: Backend API Endpoint for Chat Proxy ---
 @app.route('/api/chat', methods=['POST'])
+@rate_limited('chat')
 def chat_api():
-    if not session.get('user') or mongo_db is None:
+    if not session.get('user') or storage_db is None:
         return jsonify({"error": "Unauthorized or MongoDB not connected."}), 401
 
     if not GEMINI_API_KEY:
@@ -432,35 +1654,62 @@ def chat_api():
 
     user_id = session['google_id']
     try:
-        client_payload = request.json
+        client_payload = request.get_json(silent=True)
+        if not isinstance(client_payload, dict):
+            return jsonify({"error": {"message": "Expected a JSON object."}}), 400
         # Ensure session_id is always provided by the client for existing sessions
         current_session_id = client_payload.get('session_id')
         if not current_session_id:
             return jsonify({"error": {"message": "session_id is required in the payload."}}), 400
 
-        # Update the session's last_updated time
-        chat_sessions_collection.update_one(
-            {'_id': ObjectId(current_session_id)}, # Convert to ObjectId for a query
-            {'$set': {'last_updated': datetime.now(timezone.utc)}},
-            upsert=False
-        )
-
-        # Clean the messages for the Gemini API, removing any extra keys like 'timestamp'
-        messages_for_gemini = [
-            {'role': msg['role'], 'parts': msg['parts']}
-            for msg in client_payload.get('contents', [])
-        ]
+        try:
+            session_id_obj = ObjectId(current_session_id)
+        except Exception:
+            return jsonify({"error": {"message": "Invalid session_id."}}), 400
+
+        # Update the session's last_updated time; this also checks ownership and fetches the rolling summary
+        session_doc = touch_chat_session(session_id_obj, user_id)
+        if not session_doc:
+            return jsonify({"error": {"message": "Session not found or not authorized."}}), 404
+
+        # The client sends only the new user turn. Older clients that still send the whole
+        # history in `contents` are handled by taking its last entry.
+        new_turn = client_payload.get('message')
+        if not new_turn:
+            legacy_contents = client_payload.get('contents') or []
+            if isinstance(legacy_contents, dict):
+                legacy_contents = [legacy_contents]
+            new_turn = legacy_contents[-1] if legacy_contents else None
+        # Old or buggy clients may send a bare string or list here; anything but {"parts": [{...}, ...]} is refused
+        parts = new_turn.get('parts') if isinstance(new_turn, dict) else None
+        if not parts or not isinstance(parts, list) or not all(isinstance(part, dict) for part in parts):
+            return jsonify({"error": {"message": "A user message is required."}}), 400
+
+        # Clean the message for the Gemini API, removing any extra keys like 'timestamp'
+        messages_for_gemini = [{'role': 'user', 'parts': parts}]
 
         language_name = client_payload.get('language_name', 'English').strip()
         if not language_name:
             language_name = 'English'
 
         new_user_message_content = ""
+        attachment_ids = []
         # Process image data if present and extract user message text
         if messages_for_gemini and messages_for_gemini[-1]['role'] == 'user':
-            for part in messages_for_gemini[-1]['parts']:
+            for index, part in enumerate(messages_for_gemini[-1]['parts']):
                 if 'text' in part:
                     new_user_message_content += part['text'] + " "
+                elif 'attachment' in part:
+                    # Uploaded earlier via /api/attachments; only the owner may reference it
+                    attachment_id = str((part['attachment'] or {}).get('id', ''))
+                    attachment_doc = None
+                    if attachments_collection is not None:
+                        attachment_doc = attachments_collection.find_one({'_id': attachment_id, 'owners': user_id}, {'mime_type': 1})
+                    if not attachment_doc:
+                        return jsonify({"error": {"message": "Attachment not found."}}), 400
+                    messages_for_gemini[-1]['parts'][index] = {'attachment': {'id': attachment_id, 'mimeType': attachment_doc['mime_type']}}
+                    attachment_ids.append(attachment_id)
+                    new_user_message_content += "[Image Data] "
                 elif 'inlineData' in part and 'data' in part['inlineData']:
                     mime_type = part['inlineData']['mimeType']
                     data = part['inlineData']['data']
@@ -473,18 +1722,35 @@ def chat_api():
                     new_user_message_content += "[Image Data] " # Indicate image data
 
 
+        # Rebuild earlier turns server-side before the new message is stored
+        history_contents, window_start, truncated = build_conversation_context(session_id_obj, user_id, session_doc)
+
         if new_user_message_content.strip() and messages_collection is not None: 
-            messages_collection.insert_one({
-                "session_id": ObjectId(current_session_id), # Store as ObjectId
+            user_message = {
+                "session_id": session_id_obj,
                 "user_id": user_id,
                 "role": "user",
                 "content": new_user_message_content.strip(),
                 "timestamp": datetime.now(timezone.utc),
                 "type": "text" # Assuming text for now, can be 'image' if image content is stored differently
-            })
-            print(f"DEBUG: Saved user message to DB: {new_user_message_content.strip()}")
+            }
+            if attachment_ids:
+                user_message["attachments"] = attachment_ids
+            persist_message(user_message)
+            # Lengths only: message contents don't belong in the logs
+            log.debug("user message saved", extra={'fields': {'session_id': current_session_id, 'chars': len(new_user_message_content.strip())}})
+            # Title the session once, from its first user message, so listing sessions never has to look it up
+            if session_doc.get('title', DEFAULT_SESSION_TITLE) == DEFAULT_SESSION_TITLE:
+                title_update = {'$set': {'title': make_session_title(new_user_message_content.strip())}}
+                if message_writer is not None:
+                    message_writer.update_session(session_id_obj, user_id, {'title': DEFAULT_SESSION_TITLE}, title_update)
+                else:
+                    chat_sessions_collection.update_one(
+                        {'_id': session_id_obj, 'title': DEFAULT_SESSION_TITLE},
+                        title_update
+                    )
         elif new_user_message_content.strip():
-            print("DEBUG: messages_collection not available, user message not saved to DB.")
+            log.warning("user message not saved: MongoDB not connected")
 
         instruction_text = f"""
 You are Phantom_2.o, an advanced AI assistant created and trained by Nagesh Gaikwad.
@@ -499,21 +1765,45 @@ Response Guidelines:
 """
         
         final_contents = [{"role": "user", "parts": [{"text": instruction_text}]}]
+        final_contents.extend(history_contents)
         final_contents.extend(messages_for_gemini)
 
+        # Turns are sliding out of the window: fold them into the rolling summary in the background
+        if CONTEXT_SUMMARY_ENABLED and truncated and window_start is not None:
+            schedule_summary_refresh(session_id_obj, user_id, window_start)
 
-        gemini_payload = {
-            "contents": final_contents
-        }
 
-        response = requests.post(
-            f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-            json=gemini_payload,
-            timeout=20
-        )
-        response.raise_for_status()
+        # Keyed on attachment ids rather than image bytes, so a hit never loads the image
+        cache_key = response_cache_key(final_contents) if response_cache is not None else None
+        cached_response = cached_gemini_response(cache_key)
 
-        gemini_response = response.json()
+        gemini_payload = None
+        if cached_response is None:
+            gemini_payload = {
+                "contents": resolve_attachment_parts(final_contents)
+            }
+
+        # Streaming mode: relay tokens as they arrive instead of waiting for the whole answer
+        if client_payload.get('stream'):
+            if cached_response is not None:
+                stream = stream_cached_response(cached_response, current_session_id, user_id)
+            else:
+                stream = stream_gemini_response(gemini_payload, current_session_id, user_id, cache_key)
+            return Response(
+                stream_with_context(stream),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
+        if cached_response is not None:
+            gemini_response = cached_response
+        else:
+            response = scheduled_gemini_post(GEMINI_API_URL, gemini_payload, user_id, timeout=20)
+            response.raise_for_status()
+
+            gemini_response = response.json()
+            record_gemini_usage(gemini_response)
+            store_gemini_response(cache_key, gemini_response)
         model_response_text = "Error: Could not get a response."
         if gemini_response.get('candidates') and gemini_response['candidates'][0].get('content') and gemini_response['candidates'][0]['content'].get('parts'):
             model_response_text = gemini_response['candidates'][0]['content']['parts'][0]['text']
@@ -523,22 +1813,18 @@ Response Guidelines:
             model_response_text = f"Gemini API Error: {gemini_response['error']['message']}"
         
 
-        if model_response_text.strip() and model_response_text != "Error: Could not get a response." and messages_collection is not None:
-            messages_collection.insert_one({
-                "session_id": ObjectId(current_session_id), # Store as ObjectId
-                "user_id": user_id,
-                "role": "model",
-                "content": model_response_text,
-                "timestamp": datetime.now(timezone.utc),
-                "type": "text"
-            })
-            print(f"DEBUG: Saved AI message to DB for session {current_session_id}: {model_response_text[:50]}...")
-        elif model_response_text.strip():
-            print("DEBUG: messages_collection not available, AI message not saved to DB.")
+        if model_response_text.strip() and model_response_text != "Error: Could not get a response.":
+            save_model_message(current_session_id, user_id, model_response_text)
 
 
         return jsonify(gemini_response), 200
 
+    except UpstreamUnavailableError:
+        return jsonify({"error": {"message": "Backend: Gemini API is temporarily unavailable. Please try again shortly."}}), 503, \
+            {'Retry-After': str(gemini_breaker.retry_after())}
+    except scheduler.QueueTimeoutError:
+        return jsonify({"error": {"message": "Backend: Too many requests are waiting for Gemini. Please try again shortly."}}), 503, \
+            {'Retry-After': '5'}
     except requests.exceptions.Timeout:
         app.logger.error("Backend: Gemini API request timed out (20 seconds).")
         return jsonify({"error": {"message": "Backend: Gemini API request timed out."}}), 504
@@ -556,48 +1842,217 @@ Response Guidelines:
         app.logger.error(f"Backend: An unexpected server error occurred: {element}", exc_info=True)
         return jsonify({"error": {"message": f"Backend: An unexpected error occurred: {str(element)}"}}), 500
 
+# --- Per-route latency and the Prometheus scrape endpoint ---
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        # The rule (e.g. /api/history/<session_id>) rather than the path, to keep label cardinality bounded
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        http_request_seconds.observe(time.perf_counter() - started, route=route, method=request.method,
+                                     status=response.status_code)
+    return response
+
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # If set, scrapers must send "Authorization: Bearer <token>"
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if METRICS_TOKEN and not secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"error": "Unauthorized."}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# --- NEW: Upstream client metrics (pool reuse, retries, circuit breaker) ---
+@app.route('/api/upstream_metrics', methods=['GET'])
+def upstream_metrics():
+    lookups = response_cache_stats["hits"] + response_cache_stats["misses"]
+    return jsonify({
+        "gemini": {
+            **gemini_upstream_snapshot(),
+            **gemini_pool_stats(),
+            "pool_size": GEMINI_POOL_SIZE,
+            "breaker_state": gemini_breaker.state,
+            "breaker_times_opened": gemini_breaker.times_opened,
+            "breaker_consecutive_failures": gemini_breaker.consecutive_failures
+        },
+        "scheduler": {
+            **gemini_scheduler.stats,
+            "coalesced": gemini_coalescer.stats["followers"],
+            "queued": gemini_scheduler.queued(),
+            "in_flight": gemini_scheduler.running(),
+            "max_concurrent": GEMINI_MAX_CONCURRENT,
+            "max_concurrent_per_user": GEMINI_MAX_CONCURRENT_PER_USER
+        },
+        "response_cache": {
+            **response_cache_stats,
+            "backend": RESPONSE_CACHE_BACKEND if response_cache is not None else "off",
+            "entries": len(response_cache) if response_cache is not None else 0,
+            "hit_rate": round(response_cache_stats["hits"] / lookups, 4) if lookups else 0.0
+        }
+    }), 200
+
 # --- NEW: API for loading chat history for a session ---
 @app.route('/api/history/<session_id>', methods=['GET'])
 def get_session_history(session_id):
-    if not session.get('user') or mongo_db is None:
+    if not session.get('user') or storage_db is None:
         return jsonify({"error": "Unauthorized or MongoDB not connected."}), 401
     
     user_id = session['google_id']
+    try:
+        limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer."}), 400
+
     try:
         # Ensure the session_id is a valid ObjectId if coming from a traditional user
         session_id_obj = ObjectId(session_id) if ObjectId.is_valid(session_id) else session_id
         # Check if the user owns this session before fetching messages
-        session_exists = chat_sessions_collection.find_one({'_id': session_id_obj, 'user_id': user_id})
+        session_exists = chat_sessions_collection.find_one({'_id': session_id_obj, 'user_id': user_id}, {'_id': 1})
         if not session_exists:
             return jsonify({"error": "Session not found or not authorized."}), 404
 
         if messages_collection is not None:
+            flush_session_writes(session_id_obj, user_id)
+            query_filter = {'session_id': session_id_obj, 'user_id': user_id}
+            newest_first = True  # Default and `before` pages walk backwards from the anchor
+
+            # Keyset pagination on (timestamp, _id), anchored on a message id the client already has
+            anchor_id = request.args.get('before') or request.args.get('after')
+            if anchor_id:
+                if not ObjectId.is_valid(anchor_id):
+                    return jsonify({"error": "Invalid message id."}), 400
+                anchor = messages_collection.find_one({**query_filter, '_id': ObjectId(anchor_id)}, {'timestamp': 1})
+                if not anchor:
+                    return jsonify({"error": "Message not found in this session."}), 404
+                op = '$lt' if request.args.get('before') else '$gt'
+                query_filter['$or'] = [
+                    {'timestamp': {op: anchor['timestamp']}},
+                    {'timestamp': anchor['timestamp'], '_id': {op: anchor['_id']}}
+                ]
+                newest_first = op == '$lt'
+            elif request.args.get('since'):
+                # Only messages newer than what the client already rendered
+                try:
+                    since = datetime.fromisoformat(request.args['since'].replace('Z', '+00:00'))
+                except ValueError:
+                    return jsonify({"error": "since must be an ISO 8601 timestamp."}), 400
+                query_filter['timestamp'] = {'$gt': since}
+                newest_first = False
+
+            sort_direction = -1 if newest_first else 1
             messages_cursor = messages_collection.find(
-                {'session_id': session_id_obj, 'user_id': user_id}
-            ).sort('timestamp', 1)
-            
+                query_filter,
+                {'role': 1, 'content': 1, 'timestamp': 1}
+            ).sort([('timestamp', sort_direction), ('_id', sort_direction)]).limit(limit + 1)
+
             formatted_messages = []
+            has_more = False
             for msg in messages_cursor:
+                if len(formatted_messages) == limit:
+                    has_more = True
+                    break
                 formatted_msg = {
                     "role": msg['role'],
                     "parts": [{"text": msg['content']}],
-                    "db_id": str(msg['_id'])
+                    "db_id": str(msg['_id']),
+                    "timestamp": msg['timestamp'].replace(tzinfo=timezone.utc).isoformat() if msg.get('timestamp') else None
                 }
                 formatted_messages.append(formatted_msg)
+            if newest_first:
+                formatted_messages.reverse()  # Always return oldest first
             
-            return jsonify({"history": formatted_messages}), 200
+            return jsonify({"history": formatted_messages, "has_more": has_more}), 200
         else:
-            print("DEBUG: messages_collection not available, cannot fetch history.")
+            log.warning("history unavailable: MongoDB not connected")
             return jsonify({"history": []}), 200
     except Exception as element:
         app.logger.error(f"Error fetching chat history for session {session_id}: {element}", exc_info=True)
         return jsonify({"error": "Failed to load history for this session."}), 500
 
+# --- Full-text search over the user's messages ---
+def search_snippet(content, terms, width=SEARCH_SNIPPET_CHARS):
+    """Up to `width` characters of `content` centred on the earliest occurrence of any of `terms`."""
+    if len(content) <= width:
+        return content
+    lowered = content.lower()
+    positions = [position for position in (lowered.find(term) for term in terms) if position >= 0]
+    start = max(0, min(positions) - width // 3) if positions else 0
+    end = min(len(content), start + width)
+    start = max(0, end - width)
+    return ('…' if start else '') + content[start:end].strip() + ('…' if end < len(content) else '')
+
+
+@app.route('/api/search', methods=['GET'])
+def search_messages():
+    """
+    Ranked matches for ?q= across the user's messages, served by the (user_id, content) text
+    index. Supports "quoted phrases" and -excluded words; pages with ?offset= and ?limit=.
+    """
+    if not session.get('user') or messages_collection is None:
+        return jsonify({"error": "Unauthorized or MongoDB not connected."}), 401
+
+    user_id = session['google_id']
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"error": "q is required."}), 400
+    if len(query) > SEARCH_MAX_QUERY_CHARS:
+        return jsonify({"error": f"q must be at most {SEARCH_MAX_QUERY_CHARS} characters."}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers."}), 400
+    if offset > SEARCH_MAX_OFFSET:
+        return jsonify({"error": f"offset must be at most {SEARCH_MAX_OFFSET}; refine the search instead."}), 400
+
+    try:
+        query_filter = {'user_id': user_id, '$text': {'$search': query}}
+        # Deleted sessions lose their messages in the background; keep those out of the results
+        purging = [doc['_id'] for doc in storage_db['session_purges'].find({'user_id': user_id}, {'_id': 1})]
+        if purging:
+            query_filter['session_id'] = {'$nin': purging}
+        hits = list(messages_collection.find(
+            query_filter,
+            {'session_id': 1, 'role': 1, 'content': 1, 'timestamp': 1, 'score': {'$meta': 'textScore'}}
+        ).sort([('score', {'$meta': 'textScore'}), ('timestamp', -1)]).skip(offset).limit(limit + 1))
+
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+        titles = {doc['_id']: doc.get('title', DEFAULT_SESSION_TITLE) for doc in chat_sessions_collection.find(
+            {'_id': {'$in': list({hit['session_id'] for hit in hits})}, 'user_id': user_id}, {'title': 1}
+        )}
+        # Words to centre snippets on; excluded (-word) terms never appear in a match
+        terms = [term.lower() for term in re.findall(r'(?<![-\w])\w+', query)]
+        results = [{
+            "session_id": str(hit['session_id']),
+            "session_title": titles[hit['session_id']],
+            "message_id": str(hit['_id']),
+            "role": hit['role'],
+            "timestamp": hit['timestamp'].replace(tzinfo=timezone.utc).isoformat() if hit.get('timestamp') else None,
+            "score": round(hit['score'], 4),
+            "snippet": search_snippet(hit.get('content', ''), terms)
+        } for hit in hits if hit['session_id'] in titles]  # Sessions deleted since the purge check
+
+        return jsonify({
+            "results": results,
+            "next_offset": offset + limit if has_more else None
+        }), 200
+    except Exception as element:
+        app.logger.error(f"Error searching messages for user {user_id}: {element}", exc_info=True)
+        return jsonify({"error": "Search failed."}), 500
+
 # --- NEW: API for updating/deleting a chat session ---
 # noinspection PyBroadException
 @app.route('/api/session/<session_id>', methods=['PUT', 'DELETE'])
 def manage_session(session_id):
-    if not session.get('user') or mongo_db is None:
+    if not session.get('user') or storage_db is None:
         return jsonify({"error": "Unauthorized or MongoDB not connected."}), 401
     
     user_id = session['google_id']
@@ -614,10 +2069,8 @@ def manage_session(session_id):
     # --- HANDLE DELETION ---
     if request.method == 'DELETE':
         try:
-            # Delete the session itself
-            chat_sessions_collection.delete_one({'_id': session_id_obj, 'user_id': user_id})
-            # Delete all messages associated with the session
-            messages_collection.delete_many({'session_id': session_id_obj, 'user_id': user_id})
+            # The session goes now; its messages are purged in the background
+            delete_chat_sessions(user_id, [session_id_obj])
             return jsonify({"message": "Session and associated messages deleted successfully."}), 200
         except Exception as element:
             app.logger.error(f"Error deleting session {session_id} for user {user_id}: {element}", exc_info=True)
@@ -644,6 +2097,185 @@ def manage_session(session_id):
     return jsonify({"error": "Method not allowed."}), 405
 
 
+# --- NEW: Image attachment upload (multipart) and download ---
+@app.route('/api/attachments', methods=['POST'])
+def upload_attachment():
+    if not session.get('user') or attachments_collection is None:
+        return jsonify({"error": "Unauthorized or MongoDB not connected."}), 401
+    # Refuse oversized bodies before the multipart parser spools them
+    if request.content_length and request.content_length > ATTACHMENT_MAX_UPLOAD_BYTES + 64 * 1024:
+        return jsonify({"error": f"Image exceeds the {ATTACHMENT_MAX_UPLOAD_BYTES // (1024 * 1024)}MB upload limit."}), 413
+
+    user_id = session['google_id']
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({"error": "No file uploaded (expected form field 'file')."}), 400
+
+    try:
+        attachment_id, data = attachments.read_upload(upload.stream, ATTACHMENT_MAX_UPLOAD_BYTES)
+    except attachments.AttachmentTooLargeError as element:
+        return jsonify({"error": str(element)}), 413
+    except attachments.AttachmentError as element:
+        return jsonify({"error": str(element)}), 400
+
+    projection = {'mime_type': 1, 'bytes': 1, 'width': 1, 'height': 1}
+    # Seen before (from anyone): just record this user as an owner
+    attachment_doc = attachments_collection.find_one_and_update(
+        {'_id': attachment_id}, {'$addToSet': {'owners': user_id}},
+        projection=projection, return_document=ReturnDocument.AFTER
+    )
+    status = 200
+    if attachment_doc is None:
+        try:
+            data, mime_type, width, height = attachments.normalise_image(
+                data, ATTACHMENT_MAX_DIMENSION, ATTACHMENT_JPEG_QUALITY
+            )
+        except attachments.AttachmentError as element:
+            return jsonify({"error": str(element)}), 400
+        get_attachment_blobs().put(attachment_id, data)
+        try:
+            attachment_doc = attachments_collection.find_one_and_update(
+                {'_id': attachment_id},
+                {
+                    '$setOnInsert': {'mime_type': mime_type, 'bytes': len(data), 'width': width, 'height': height,
+                                     'created_at': datetime.now(timezone.utc)},
+                    '$addToSet': {'owners': user_id}
+                },
+                projection=projection, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The same image was uploaded concurrently; its metadata is in place now
+            attachment_doc = attachments_collection.find_one_and_update(
+                {'_id': attachment_id}, {'$addToSet': {'owners': user_id}},
+                projection=projection, return_document=ReturnDocument.AFTER
+            )
+        status = 201
+
+    return jsonify({
+        "attachment_id": attachment_id,
+        "mime_type": attachment_doc['mime_type'],
+        "bytes": attachment_doc['bytes'],
+        "width": attachment_doc.get('width'),
+        "height": attachment_doc.get('height')
+    }), status
+
+
+@app.route('/api/attachments/<attachment_id>', methods=['GET'])
+def get_attachment(attachment_id):
+    if not session.get('user') or attachments_collection is None:
+        return jsonify({"error": "Unauthorized or MongoDB not connected."}), 401
+    attachment_doc = attachments_collection.find_one({'_id': attachment_id, 'owners': session['google_id']}, {'mime_type': 1})
+    if not attachment_doc:
+        return jsonify({"error": "Attachment not found."}), 404
+    # Content-addressed, so the bytes behind an id never change
+    return Response(get_attachment_blobs().get(attachment_id), mimetype=attachment_doc['mime_type'],
+                    headers={'Cache-Control': 'private, max-age=31536000, immutable'})
+
+
+# --- NEW: API for deleting several (or all) chat sessions at once ---
+@app.route('/api/sessions/delete', methods=['POST'])
+def bulk_delete_sessions():
+    if not session.get('user') or storage_db is None:
+        return jsonify({"error": "Unauthorized or MongoDB not connected."}), 401
+
+    user_id = session['google_id']
+    data = request.json or {}
+    if data.get('all') is True:
+        session_ids = None
+    else:
+        raw_ids = data.get('session_ids')
+        if not isinstance(raw_ids, list) or not raw_ids:
+            return jsonify({"error": "Provide session_ids (a non-empty list) or all: true."}), 400
+        if len(raw_ids) > BULK_DELETE_MAX_SESSIONS:
+            return jsonify({"error": f"At most {BULK_DELETE_MAX_SESSIONS} sessions can be deleted per request."}), 400
+        if not all(isinstance(raw_id, str) and ObjectId.is_valid(raw_id) for raw_id in raw_ids):
+            return jsonify({"error": "Invalid session ID format."}), 400
+        session_ids = [ObjectId(raw_id) for raw_id in raw_ids]
+
+    try:
+        deleted = delete_chat_sessions(user_id, session_ids)
+    except Exception as element:
+        app.logger.error(f"Error bulk-deleting sessions for user {user_id}: {element}", exc_info=True)
+        return jsonify({"error": "Failed to delete sessions."}), 500
+    # Sessions are gone; their messages are still being purged
+    return jsonify({"message": "Sessions deleted.", "deleted": deleted}), 202
+
+
+# --- NEW: Background purge progress ---
+@app.route('/api/purge_metrics', methods=['GET'])
+def purge_metrics():
+    if session_purger is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({
+        "enabled": True,
+        **session_purger.stats,
+        "backlog_sessions": session_purger.backlog(),
+        "chunk_size": SESSION_PURGE_CHUNK_SIZE
+    }), 200
+
+
+# --- Conversation export (NDJSON, streamed) and import ---
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+
+
+@app.route('/api/export', methods=['GET'])
+@app.route('/api/export/<session_id>', methods=['GET'])
+def export_sessions(session_id=None):
+    """
+    Streams all of the user's sessions (or one) as NDJSON, gzipped unless ?gzip=0.
+    Read from cursors and written in chunks, so memory stays flat however large the history.
+    """
+    if not session.get('user') or storage_db is None:
+        return jsonify({"error": "Unauthorized or MongoDB not connected."}), 401
+
+    user_id = session['google_id']
+    session_ids = None
+    if session_id is not None:
+        if not ObjectId.is_valid(session_id):
+            return jsonify({"error": "Invalid session ID format."}), 400
+        if not chat_sessions_collection.find_one({'_id': ObjectId(session_id), 'user_id': user_id}, {'_id': 1}):
+            return jsonify({"error": "Session not found or not authorized."}), 404
+        session_ids = [ObjectId(session_id)]
+
+    compress = request.args.get('gzip', '1') != '0'
+    records = transfer.export_records(
+        chat_sessions_collection, messages_collection, user_id, session_ids,
+        before_session=lambda session_id_obj: flush_session_writes(session_id_obj, user_id)
+    )
+    filename = f"phantom-export-{session_id or 'all'}-{datetime.now(timezone.utc):%Y%m%d}.ndjson" + ('.gz' if compress else '')
+    return Response(stream_with_context(transfer.encode_ndjson(records, compress=compress)),
+                    mimetype='application/gzip' if compress else 'application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                             'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/import', methods=['POST'])
+def import_sessions():
+    """
+    Imports an export file sent as the raw request body (NDJSON, plain or gzip). Sessions and
+    messages get new ids; lines that don't parse are skipped and reported.
+    """
+    if not session.get('user') or storage_db is None:
+        return jsonify({"error": "Unauthorized or MongoDB not connected."}), 401
+
+    importer = transfer.ConversationImporter(
+        chat_sessions_collection, messages_collection, session['google_id'],
+        attachments_collection=attachments_collection, batch_size=IMPORT_BATCH_SIZE
+    )
+    try:
+        stats = importer.run(transfer.open_upload(request.stream, request.headers.get('Content-Encoding')))
+    except (transfer.ImportFormatError, OSError, EOFError) as element:
+        # OSError/EOFError: a corrupt or truncated gzip body. Batches already written are kept.
+        return jsonify({"error": f"Import stopped: {element}", **importer.stats, "errors": importer.errors}), 400
+    except Exception as element:
+        app.logger.error(f"Error importing sessions for user {session['google_id']}: {element}", exc_info=True)
+        return jsonify({"error": "Import failed.", **importer.stats, "errors": importer.errors}), 500
+
+    if not stats["sessions"] and importer.errors:
+        return jsonify({"error": "Nothing could be imported.", **stats, "errors": importer.errors}), 400
+    return jsonify({"message": "Import complete.", **stats, "errors": importer.errors}), 200
+
+
 # --- NEW: Subscription Integration (Sketch) ---
 @app.route('/api/create_payment_session', methods=['POST'])
 def create_payment_session():
@@ -677,18 +2309,111 @@ def stripe_webhook():
     #     users_collection.update_one({'_id': ObjectId(user_id)}, {'$set': {'plan': 'Premium'}})
     return jsonify({"status": "success"}), 200
 
+# --- Code runner: pre-warmed sandbox pool (POSIX) with a plain subprocess fallback ---
+RUN_CODE_TIMEOUT = int(os.getenv("RUN_CODE_TIMEOUT", "10"))
+RUN_CODE_USE_POOL = os.getenv("RUN_CODE_USE_POOL", "true").lower() in ("1", "true", "yes") and os.name == 'posix'
+RUN_CODE_POOL_SIZE = int(os.getenv("RUN_CODE_POOL_SIZE", "4"))
+RUN_CODE_MAX_QUEUE = int(os.getenv("RUN_CODE_MAX_QUEUE", "16"))
+RUN_CODE_JOBS_PER_WORKER = int(os.getenv("RUN_CODE_JOBS_PER_WORKER", "50"))
+RUN_CODE_MEMORY_MB = int(os.getenv("RUN_CODE_MEMORY_MB", "256"))
+RUN_CODE_MAX_OUTPUT_BYTES = int(os.getenv("RUN_CODE_MAX_OUTPUT_BYTES", str(64 * 1024)))
+# Jobs run as this user when the app runs as root (a name or uid; never root)
+RUN_CODE_USER = os.getenv("RUN_CODE_USER", "nobody")
+
+sandbox_pool = None
+sandbox_pool_error = None  # Why the pool couldn't start; it is not retried in this process
+_sandbox_pool_lock = threading.Lock()
+
+run_code_seconds = metrics.histogram(
+    'phantom_run_code_duration_seconds', 'Code runner wall time per execution.', ('mode', 'outcome')
+)
+metrics.gauge_callback(
+    'phantom_run_code_queue_depth', 'Requests waiting for a sandbox worker.',
+    lambda: {(): sandbox_pool.queue_depth if sandbox_pool is not None else 0}
+)
+metrics.counter_callback(
+    'phantom_run_code_pool_events_total', 'Sandbox pool jobs, rejections, timeouts and worker recycles.',
+    lambda: {(event,): count for event, count in (sandbox_pool.stats if sandbox_pool is not None else {}).items()}, ('event',)
+)
+
+
+def run_code_outcome(result):
+    if result.get('timed_out'):
+        return 'timeout'
+    if result.get('truncated'):
+        return 'truncated'
+    return 'ok' if result.get('exit_code') == 0 else 'error'
+
+
+def get_sandbox_pool():
+    """
+    Creates the pool on first use, so workers are forked by the serving process rather than at import.
+    Raises SandboxUnavailableError if jobs can't be isolated on this host; code is then never run.
+    """
+    global sandbox_pool, sandbox_pool_error
+    if sandbox_pool is None:
+        with _sandbox_pool_lock:
+            if sandbox_pool_error is not None:
+                raise sandbox_pool_error
+            if sandbox_pool is None:
+                try:
+                    sandbox_pool = sandbox.SandboxPool(
+                        size=RUN_CODE_POOL_SIZE,
+                        max_jobs_per_worker=RUN_CODE_JOBS_PER_WORKER,
+                        max_queue=RUN_CODE_MAX_QUEUE,
+                        cpu_seconds=RUN_CODE_TIMEOUT,
+                        memory_mb=RUN_CODE_MEMORY_MB,
+                        max_output_bytes=RUN_CODE_MAX_OUTPUT_BYTES,
+                        run_as=RUN_CODE_USER
+                    )
+                except sandbox.SandboxUnavailableError as error:
+                    log.critical(f"Code runner disabled: {error}")
+                    sandbox_pool_error = error
+                    raise
+    return sandbox_pool
+
+
+def code_runner_unavailable_response():
+    return jsonify({'error': 'The code runner is unavailable on this server.'}), 503
+
+
 # region: Gemini API Integration
 @app.route('/api/run_code', methods=['POST'])
+@rate_limited('run_code')
 def run_code():
     """
     Executes Python code in a sandboxed environment.
     """
+    if not session.get('user'):
+        return jsonify({'error': 'Unauthorized.'}), 401
+
     data = request.get_json()
     code = data.get('code')
 
     if not code:
         return jsonify({'error': 'No code provided'}), 400
 
+    started = time.perf_counter()
+    if RUN_CODE_USE_POOL:
+        try:
+            result = get_sandbox_pool().run(code, timeout=RUN_CODE_TIMEOUT)
+            run_code_seconds.observe(time.perf_counter() - started, mode='pool', outcome=run_code_outcome(result))
+        except sandbox.SandboxBusyError as element:
+            run_code_seconds.observe(time.perf_counter() - started, mode='pool', outcome='busy')
+            return jsonify({'error': f'Code runner is busy: {element} Please try again shortly.'}), 503, {'Retry-After': '2'}
+        except sandbox.SandboxUnavailableError:
+            return code_runner_unavailable_response()
+        except Exception as e:
+            app.logger.error(f"Sandbox execution failed: {e}", exc_info=True)
+            return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
+
+        if result['timed_out']:
+            return jsonify({'error': f'Execution timed out after {RUN_CODE_TIMEOUT} seconds.',
+                            'stdout': result['stdout'], 'stderr': result['stderr']}), 408
+        if result['truncated']:
+            result['stderr'] += f"\n[Output truncated at {RUN_CODE_MAX_OUTPUT_BYTES} bytes]"
+        return jsonify({'stdout': result['stdout'], 'stderr': result['stderr']})
+
     try:
         # Execute the code using a Python subprocess
         # This is safer than exec() as it runs in a separate process
@@ -696,19 +2421,95 @@ def run_code():
             [sys.executable, '-c', code],
             capture_output=True,
             text=True,
-            timeout=10  # 10-second timeout for safety
+            timeout=RUN_CODE_TIMEOUT,  # Timeout for safety
+            env=sandbox.sandbox_env()  # None of the app's secrets
         )
-        
+        run_code_seconds.observe(time.perf_counter() - started, mode='subprocess',
+                                 outcome='ok' if process.returncode == 0 else 'error')
+
         stdout = process.stdout
         stderr = process.stderr
 
         return jsonify({'stdout': stdout, 'stderr': stderr})
 
     except subprocess.TimeoutExpired:
-        return jsonify({'error': 'Execution timed out after 10 seconds.'}), 408
+        run_code_seconds.observe(time.perf_counter() - started, mode='subprocess', outcome='timeout')
+        return jsonify({'error': f'Execution timed out after {RUN_CODE_TIMEOUT} seconds.'}), 408
     except Exception as e:
         return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
 
+# --- NEW: Streaming code runner (stdout/stderr pushed as Server-Sent Events) ---
+@app.route('/api/run_code/stream', methods=['POST'])
+@rate_limited('run_code')
+def run_code_stream():
+    if not session.get('user'):
+        return jsonify({'error': 'Unauthorized.'}), 401
+
+    data = request.get_json()
+    code = data.get('code')
+
+    if not code:
+        return jsonify({'error': 'No code provided'}), 400
+
+    started = time.perf_counter()
+    mode = 'pool' if RUN_CODE_USE_POOL else 'subprocess'
+    if RUN_CODE_USE_POOL:
+        try:
+            # Claims a worker before the response starts, so a full queue is still a plain 503
+            messages = get_sandbox_pool().stream(code, timeout=RUN_CODE_TIMEOUT)
+        except sandbox.SandboxBusyError as element:
+            run_code_seconds.observe(time.perf_counter() - started, mode=mode, outcome='busy')
+            return jsonify({'error': f'Code runner is busy: {element} Please try again shortly.'}), 503, {'Retry-After': '2'}
+        except sandbox.SandboxUnavailableError:
+            return code_runner_unavailable_response()
+    else:
+        messages = run_code_unpooled(code)
+
+    def generate():
+        try:
+            for message in messages:
+                if 'stream' in message:
+                    yield sse_event({'text': message['data']}, event=message['stream'])
+                    continue
+                run_code_seconds.observe(time.perf_counter() - started, mode=mode, outcome=run_code_outcome(message))
+                exit_info = {'exit_code': message.get('exit_code'), 'timed_out': message.get('timed_out', False),
+                             'truncated': message.get('truncated', False)}
+                if exit_info['timed_out']:
+                    exit_info['message'] = f'Execution timed out after {RUN_CODE_TIMEOUT} seconds.'
+                elif exit_info['truncated']:
+                    exit_info['message'] = f'Output truncated at {RUN_CODE_MAX_OUTPUT_BYTES} bytes.'
+                yield sse_event(exit_info, event='exit')
+        except Exception as e:
+            app.logger.error(f"Streaming code execution failed: {e}", exc_info=True)
+            yield sse_event({'message': f'An unexpected error occurred: {str(e)}'}, event='error')
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    if isinstance(messages, sandbox.StreamingJob):
+        # Returns the worker even if the body is never iterated (client gone before the first chunk)
+        response.call_on_close(messages.close)
+    return response
+
+
+def run_code_unpooled(code):
+    """Fallback for hosts without the sandbox pool: runs to completion, then yields the pool's message shapes."""
+    try:
+        process = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=RUN_CODE_TIMEOUT,
+                                 env=sandbox.sandbox_env())
+    except subprocess.TimeoutExpired as element:
+        partial_stdout = element.stdout.decode('utf-8', 'replace') if isinstance(element.stdout, bytes) else element.stdout
+        if partial_stdout:
+            yield {'stream': 'stdout', 'data': partial_stdout[:RUN_CODE_MAX_OUTPUT_BYTES]}
+        yield {'done': True, 'exit_code': None, 'timed_out': True}
+        return
+    output = process.stdout + process.stderr
+    if process.stdout:
+        yield {'stream': 'stdout', 'data': process.stdout[:RUN_CODE_MAX_OUTPUT_BYTES]}
+    if process.stderr and len(process.stdout) < RUN_CODE_MAX_OUTPUT_BYTES:
+        yield {'stream': 'stderr', 'data': process.stderr[:RUN_CODE_MAX_OUTPUT_BYTES - len(process.stdout)]}
+    yield {'done': True, 'exit_code': process.returncode, 'timed_out': False,
+           'truncated': len(output) > RUN_CODE_MAX_OUTPUT_BYTES}
+
 @app.route('/dev_intelligence')
 def dev_intelligence():
     return render_template('dev_intelligence.html')
@@ -729,11 +2530,140 @@ def security_layer():
 def dev_os():
     return render_template('dev_os.html')
 
+# --- Static assets: fingerprinted names, precompressed variants, long-lived caching (see assets.py) ---
+STATIC_MAX_AGE_SECONDS = int(os.getenv("STATIC_MAX_AGE_SECONDS", "300"))  # For files served under their original name
+IMMUTABLE_MAX_AGE_SECONDS = 365 * 24 * 3600
+static_manifest = assets.load_manifest(app.static_folder)
+fingerprinted_static_files = frozenset(static_manifest.values())
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # url_for('static', filename='css/style.css') -> /static/build/css/style.<hash>.css once assets are built
+    if endpoint == 'static' and values.get('filename') in static_manifest:
+        values['filename'] = static_manifest[values['filename']]
+
+
+def serve_static(filename):
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    fingerprinted = filename in fingerprinted_static_files
+    encoding = None
+    if fingerprinted:
+        path, encoding = assets.precompressed_variant(path, request.accept_encodings)
+    # send_file handles If-None-Match/If-Modified-Since and Range (the hero video seeks with it),
+    # and hands the file to the server's wsgi.file_wrapper, which gunicorn sends with sendfile()
+    response = send_file(
+        path, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream', conditional=True,
+        max_age=IMMUTABLE_MAX_AGE_SECONDS if fingerprinted else STATIC_MAX_AGE_SECONDS
+    )
+    if fingerprinted:
+        response.cache_control.immutable = True
+        response.vary.add('Accept-Encoding')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    return response
+
+
+app.view_functions['static'] = serve_static
+
+
+@app.cli.command('build-assets')
+@click.option('--clean', is_flag=True, help="Remove hashed files from earlier builds first.")
+def build_assets_command(clean):
+    """Writes fingerprinted, precompressed copies of static/ and their manifest (run at deploy build time)."""
+    manifest = assets.build(app.static_folder, clean=clean)
+    print(f"{len(manifest)} assets in {assets.BUILD_DIR}/{assets.MANIFEST_NAME}"
+          + ("" if assets.brotli is not None else " (brotli not installed: gzip variants only)"))
+
+
+# --- Index management ---
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    """Creates the indexes declared in indexes.py, or the SQLite tables and indexes (idempotent)."""
+    if storage_db is None:
+        raise SystemExit("MongoDB not connected.")
+    failure = None
+    if sqlite_db is not None:
+        created = sqlite_db.ensure_schema()
+    else:
+        try:
+            created = indexes.ensure_indexes(mongo_db)
+        except indexes.IndexBuildError as error:
+            created, failure = error.created, error
+    for collection_name, names in created.items():
+        print(f"{collection_name}: {', '.join(names)}")
+    if failure is not None:
+        raise SystemExit(f"Not built: {failure}")
+
+
+@app.cli.command('duplicate-emails')
+def duplicate_emails_command():
+    """Lists emails held by more than one user; the unique email index is skipped until they are resolved."""
+    if mongo_db is None:
+        raise SystemExit("MongoDB not connected.")
+    duplicates = indexes.find_duplicate_emails(mongo_db, limit=10000)
+    for duplicate in duplicates:
+        print(f"{duplicate['_id']}: {', '.join(str(user_id) for user_id in duplicate['ids'])}")
+    print(f"{len(duplicates)} emails belong to more than one user.")
+
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """Explains every route query and exits non-zero if any of them is a collection scan."""
+    if storage_db is None:
+        raise SystemExit("MongoDB not connected.")
+    if sqlite_db is not None:
+        scans = sqlitestore.find_full_scans(sqlite_db, indexes.route_queries())
+    else:
+        scans = indexes.find_collection_scans(mongo_db)
+    if scans:
+        raise SystemExit(f"COLLSCAN in: {', '.join(scans)}")
+    print("All route queries are served by an index.")
+
+
+# --- One-off maintenance: title sessions created before titles were stored on first message ---
+@app.cli.command('backfill-session-titles')
+def backfill_session_titles():
+    """Sets stored titles on untitled sessions from their first user message."""
+    if chat_sessions_collection is None or messages_collection is None:
+        print("MongoDB not connected; nothing to backfill.")
+        return
+
+    batch_size = 500
+    updated = 0
+    last_id = None
+    while True:
+        batch_filter = {'title': DEFAULT_SESSION_TITLE}
+        if last_id is not None:
+            batch_filter['_id'] = {'$gt': last_id}
+        session_ids = [s['_id'] for s in chat_sessions_collection.find(batch_filter, {'_id': 1}).sort('_id', 1).limit(batch_size)]
+        if not session_ids:
+            break
+        last_id = session_ids[-1]
+
+        # First user message of every session in the batch, in one aggregation
+        first_messages = messages_collection.aggregate([
+            {'$match': {'session_id': {'$in': session_ids}, 'role': 'user'}},
+            {'$sort': {'timestamp': 1}},
+            {'$group': {'_id': '$session_id', 'content': {'$first': '$content'}}}
+        ])
+        operations = [
+            UpdateOne({'_id': m['_id'], 'title': DEFAULT_SESSION_TITLE}, {'$set': {'title': make_session_title(m.get('content'))}})
+            for m in first_messages
+        ]
+        if operations:
+            updated += chat_sessions_collection.bulk_write(operations, ordered=False).modified_count
+
+    print(f"Backfilled titles for {updated} chat sessions.")
+
+
 # --- Start the Flask server ---
 if __name__ == '__main__':
     print("\n--- Starting Flask Backend Server ---")
     print("Ensure you have activated your Python virtual environment.")
     print("Ensure you have set FLASK_SECRET_KEY, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, and GEMINI_API_KEY in your .env file.")
-    print("Also ensure MONGO_URI and MONGO_DB_NAME are set in .env if using MongoDB.")
+    print("Also ensure MONGO_URI and MONGO_DB_NAME are set in .env if using MongoDB (otherwise data goes to SQLITE_PATH).")
     print("This server will run on http://127.0.0.1:5000\n")
     app.run(debug=True, port=5000)
\ No newline at end of file
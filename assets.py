@@ -0,0 +1,118 @@
+"""
+Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies every file under static/ to static/build/ with a
+content hash in its name (css/style.css -> css/style.3f2a9c1b07de.css) and,
+for text types, writes .gz (and .br, when the `brotli` package is installed)
+variants next to it. A manifest maps each original name to its hashed one.
+
+app.py loads the manifest at import and rewrites url_for('static', ...) to
+the hashed names, so templates stay unchanged. A hashed name never changes
+content, so it is served with a one-year immutable Cache-Control and browsers
+stop revalidating it; a new deploy changes the name instead. Without a
+manifest (no build run) static files are served as before.
+
+Old hashed files are kept on rebuild so pages rendered by a previous deploy
+still find their assets; `--clean` removes them.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only gzip variants are written
+    brotli = None
+
+BUILD_DIR = 'build'
+MANIFEST_NAME = 'manifest.json'
+HASH_LENGTH = 12
+COMPRESSIBLE_EXTENSIONS = frozenset(('.css', '.js', '.mjs', '.map', '.json', '.svg', '.html', '.txt', '.xml', '.ico'))
+# A variant has to save at least this fraction of the original to be worth serving
+MIN_SAVING = 0.1
+# Preference order when a client accepts several
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def _write_atomic(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def _compressed_variants(data):
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+    return {suffix: body for suffix, body in variants.items() if len(body) <= len(data) * (1 - MIN_SAVING)}
+
+
+def source_files(static_dir):
+    """Relative paths (with '/' separators) of every static file outside the build directory."""
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir and BUILD_DIR in dirs:
+            dirs.remove(BUILD_DIR)
+        dirs.sort()
+        for name in sorted(files):
+            if not name.startswith('.'):
+                yield os.path.relpath(os.path.join(root, name), static_dir).replace(os.sep, '/')
+
+
+def build(static_dir, clean=False):
+    """Writes hashed copies, compressed variants and the manifest. Returns the manifest."""
+    build_dir = os.path.join(static_dir, BUILD_DIR)
+    if clean and os.path.isdir(build_dir):
+        shutil.rmtree(build_dir)
+    manifest = {}
+    for name in source_files(static_dir):
+        source_path = os.path.join(static_dir, name)
+        stem, extension = os.path.splitext(name)
+        hashed_name = f'{stem}.{_file_hash(source_path)}{extension}'
+        target_path = os.path.join(build_dir, hashed_name)
+        manifest[name] = f'{BUILD_DIR}/{hashed_name}'
+        if os.path.exists(target_path):
+            continue  # Same name, same content
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        with open(source_path, 'rb') as source:
+            data = source.read()
+        if extension.lower() in COMPRESSIBLE_EXTENSIONS:
+            for suffix, body in _compressed_variants(data).items():
+                _write_atomic(target_path + suffix, body)
+        # The plain file last: its presence is what marks the entry as built
+        _write_atomic(target_path, data)
+    os.makedirs(build_dir, exist_ok=True)
+    _write_atomic(os.path.join(build_dir, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def load_manifest(static_dir):
+    """The manifest from the last build ({original name: hashed name}), or {} if there hasn't been one."""
+    try:
+        with open(os.path.join(static_dir, BUILD_DIR, MANIFEST_NAME), encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+
+
+def precompressed_variant(path, accept_encodings):
+    """(variant path, content encoding) for the best stored variant the client accepts, or (path, None)."""
+    for encoding, suffix in ENCODINGS:
+        if accept_encodings[encoding] and os.path.isfile(path + suffix):
+            return path + suffix, encoding
+    return path, None
@@ -0,0 +1,150 @@
+"""
+Image attachments for chat messages.
+
+Images are uploaded once through /api/attachments (multipart) instead of as
+base64 inside every /api/chat body. Each upload is keyed by the sha256 of the
+uploaded bytes, so re-uploading the same image is a metadata lookup and the
+blob is stored once no matter how many users or messages reference it.
+Messages then carry {"attachment": {"id": ...}} parts that app.py resolves to
+inlineData only when a request actually goes to Gemini.
+
+When Pillow is installed, images are downscaled to `max_dimension` and
+recompressed before they are stored; without it they are stored as uploaded
+(after checking that they really are one of the accepted image types).
+Blobs live on local disk or in GridFS; metadata and ownership are kept by the
+caller (app.py stores them in the `attachments` collection).
+"""
+import hashlib
+import io
+import os
+import tempfile
+
+import gridfs
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Optional: without Pillow images are stored as uploaded
+    Image = None
+
+CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentError(Exception):
+    """Raised for uploads that aren't an accepted image."""
+
+
+class AttachmentTooLargeError(AttachmentError):
+    """Raised when an upload exceeds the size limit."""
+
+
+def sniff_image_type(head):
+    """MIME type from an image's leading bytes, or None if it isn't JPEG, PNG, GIF or WebP."""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def read_upload(stream, max_bytes):
+    """Reads an uploaded file in chunks, hashing as it goes. Returns (sha256 hex, bytes)."""
+    digest = hashlib.sha256()
+    buffer = io.BytesIO()
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if buffer.tell() + len(chunk) > max_bytes:
+            raise AttachmentTooLargeError(f"Image exceeds the {max_bytes // (1024 * 1024)}MB upload limit.")
+        digest.update(chunk)
+        buffer.write(chunk)
+    if not buffer.tell():
+        raise AttachmentError("The uploaded file is empty.")
+    return digest.hexdigest(), buffer.getvalue()
+
+
+def normalise_image(data, max_dimension=1536, quality=85):
+    """
+    Returns (data, mime_type, width, height). Downscales and recompresses with Pillow
+    when it is available; width and height are None without it.
+    """
+    mime_type = sniff_image_type(data[:16])
+    if mime_type is None:
+        raise AttachmentError("Only JPEG, PNG, GIF and WebP images are accepted.")
+    if Image is None:
+        return data, mime_type, None, None
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image)
+            original_size = image.size
+            image.thumbnail((max_dimension, max_dimension))
+            output = io.BytesIO()
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # Keep transparency; PNG is lossless so only the resize saves space here
+                image.save(output, format='PNG', optimize=True)
+                mime_type = 'image/png'
+            else:
+                image.convert('RGB').save(output, format='JPEG', quality=quality, optimize=True)
+                mime_type = 'image/jpeg'
+            width, height = image.size
+    except (OSError, Image.DecompressionBombError) as error:
+        raise AttachmentError(f"Could not read the image: {error}")
+    # Recompressing an image that didn't need resizing can make it bigger; keep the original then
+    if (width, height) == original_size and output.tell() >= len(data):
+        return data, sniff_image_type(data[:16]), width, height
+    return output.getvalue(), mime_type, width, height
+
+
+class DiskBlobStore:
+    """Blobs as files under `directory`, sharded by the first two hex digits of the key."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a concurrent reader never sees a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as blob:
+            return blob.read()
+
+
+class GridFSBlobStore:
+    """Blobs in GridFS (the `attachment_blobs` bucket), with the key as the file id."""
+
+    def __init__(self, db):
+        self.fs = gridfs.GridFS(db, collection='attachment_blobs')
+
+    def exists(self, key):
+        return self.fs.exists(key)
+
+    def put(self, key, data):
+        try:
+            self.fs.put(data, _id=key)
+        except gridfs.errors.FileExists:
+            pass  # Same key, same content
+
+    def get(self, key):
+        return self.fs.get(key).read()
@@ -0,0 +1,874 @@
+"""
+Load benchmark for the Phantom_2.o backend.
+
+Start the mock Gemini upstream, point the app at it and drive concurrent chats:
+
+    python benchmark.py mock-gemini --port 8089 --latency 2.0
+    GEMINI_API_BASE=http://127.0.0.1:8089 GEMINI_API_KEY=bench gunicorn -c gunicorn.conf.py app:app
+    python benchmark.py chat --base-url http://127.0.0.1:5000 --concurrency 16 --requests 64
+
+With a 2s upstream latency and sync workers, chat throughput is capped at
+`workers / 2s`. With the gevent worker it should scale with --concurrency
+instead, which is what the "speedup_vs_worker_bound" figure in the report shows.
+
+The chat and run-code scenarios drive one user, so start the server with
+RATE_LIMIT_BACKEND=off for them. The fairness scenario is the one that
+exercises the per-user limits: run it against the same server with the limits
+on and off and compare the normal users' latency.
+
+    python benchmark.py fairness --users 8 --flood-concurrency 32
+
+The suite scenario is self-contained: it starts the mock upstream (with
+configurable latency and streaming pace), boots the app against MongoDB, the
+embedded SQLite backend or an in-memory mongomock stand-in, seeds users, sessions and messages, drives a
+weighted mix of login, all_sessions, history, search, chat (plain and
+streamed) and run_code at fixed concurrency, and prints p50/p95/p99 and throughput per
+route as JSON. Given a baseline report it exits non-zero on regressions:
+
+    python benchmark.py suite --mongo mongodb://127.0.0.1:27017 --output bench.json
+    python benchmark.py suite --mongo mongodb://127.0.0.1:27017 --baseline bench.json
+
+--mongo memory needs mongomock and serves from a single threaded process, so
+its numbers only compare with other in-memory runs. --mongo sqlite seeds a
+SQLite file in the temp directory and serves it with gunicorn like MongoDB, so
+the two backends can be compared with the same workload:
+
+    python benchmark.py suite --mongo sqlite --baseline bench.json
+
+The startup scenario measures cold start: app.py import time, time until a
+freshly launched server accepts connections and answers, and cold versus warm
+latency of the first requests (use --preload to boot gunicorn with PRELOAD_APP).
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from bson.objectid import ObjectId
+
+
+# --- Mock Gemini upstream ---
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    latency = 1.0
+    stream_chunk_delay = 0.0
+    error_rate = 0.0
+    received_bytes = []
+    reply_text = "This is a canned reply from the mock Gemini server."
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # Upstream payload sizes seen so far, so scenarios can check what the app forwards
+        if self.path != '/_stats':
+            self.send_error(404)
+            return
+        body = json.dumps({"request_bytes": self.received_bytes[-1000:]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.received_bytes.append(length)
+        time.sleep(self.latency)
+
+        # Simulate an overloaded upstream to exercise retries and the circuit breaker
+        if random.random() < self.error_rate:
+            self.send_response(random.choice([429, 503]))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if ':streamGenerateContent' in self.path:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            for word in self.reply_text.split(' '):
+                chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": word + " "}]}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\r\n\r\n".encode())
+                self.wfile.flush()
+                time.sleep(self.stream_chunk_delay)
+            return
+
+        body = json.dumps({
+            "candidates": [{"content": {"role": "model", "parts": [{"text": self.reply_text}]}}]
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_mock_gemini(port=0, latency=1.0, error_rate=0.0, stream_chunk_delay=0.0):
+    """Starts the mock upstream on a background thread and returns the server."""
+    handler = type('ConfiguredMockGeminiHandler', (MockGeminiHandler,), {
+        'latency': latency, 'error_rate': error_rate, 'stream_chunk_delay': stream_chunk_delay, 'received_bytes': []
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- Client helpers ---
+def new_logged_in_client(base_url):
+    """Registers a throwaway user and returns a requests.Session carrying its cookie."""
+    client = requests.Session()
+    username = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+    response = client.post(f"{base_url}/api/register", json={
+        "displayName": "Bench User", "username": username, "password": "bench-password"
+    })
+    response.raise_for_status()
+    return client
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 1) if latencies else 0.0,
+    }
+
+
+# --- Scenarios ---
+def run_chat_benchmark(base_url, concurrency, total_requests, workers, upstream_latency):
+    client = new_logged_in_client(base_url)
+    session_id = client.post(f"{base_url}/api/new_chat_session").json()['session_id']
+    cookies = client.cookies.get_dict()
+
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one_chat(i):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            response = requests.post(f"{base_url}/api/chat", cookies=cookies, timeout=120, json={
+                "session_id": session_id,
+                "contents": [{"role": "user", "parts": [{"text": f"benchmark message {i}"}]}]
+            })
+            ok = response.status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        with lock:
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_chat, range(total_requests)))
+    elapsed = time.perf_counter() - started
+
+    report = summarize(latencies, errors, elapsed)
+    # Throughput a pool of sync workers could reach at this upstream latency
+    worker_bound_rps = workers / upstream_latency if upstream_latency else 0.0
+    report.update({
+        "route": "/api/chat",
+        "concurrency": concurrency,
+        "workers": workers,
+        "worker_bound_rps": round(worker_bound_rps, 3),
+        "speedup_vs_worker_bound": round(report["throughput_rps"] / worker_bound_rps, 2) if worker_bound_rps else None,
+    })
+    return report
+
+
+def run_context_growth_benchmark(base_url, turns, mock_url=None):
+    """
+    Sends `turns` sequential messages in one session and records, per turn, the
+    client request size, latency and (if mock_url is given) the upstream payload size.
+    With server-side context assembly these should stay flat as the session grows.
+    """
+    client = new_logged_in_client(base_url)
+    session_id = client.post(f"{base_url}/api/new_chat_session").json()['session_id']
+
+    series = []
+    for turn in range(turns):
+        body = json.dumps({
+            "session_id": session_id,
+            "message": {"role": "user", "parts": [{"text": f"Turn {turn}: tell me something new about benchmarking."}]}
+        })
+        started = time.perf_counter()
+        response = client.post(f"{base_url}/api/chat", data=body, headers={'Content-Type': 'application/json'}, timeout=120)
+        latency = time.perf_counter() - started
+        point = {"turn": turn, "status": response.status_code,
+                 "request_bytes": len(body), "latency_ms": round(latency * 1000, 1)}
+        if mock_url:
+            point["upstream_bytes"] = requests.get(f"{mock_url}/_stats").json()["request_bytes"][-1]
+        series.append(point)
+
+    return {"route": "/api/chat", "scenario": "context-growth", "turns": series}
+
+
+def run_code_benchmark(base_url, concurrency, total_requests, code="print(1 + 1)"):
+    """Latency of trivial /api/run_code executions, mostly a measure of sandbox start-up cost."""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    client = new_logged_in_client(base_url)
+
+    def one_run(_):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            ok = client.post(f"{base_url}/api/run_code", json={"code": code}, timeout=30).status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        with lock:
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_run, range(total_requests)))
+    report = summarize(latencies, errors, time.perf_counter() - started)
+    report.update({"route": "/api/run_code", "concurrency": concurrency})
+    return report
+
+
+def run_fairness_benchmark(base_url, users, requests_per_user, think_time, flood_concurrency):
+    """
+    One client floods /api/chat with `flood_concurrency` parallel requests while `users`
+    normal users each send `requests_per_user` chats `think_time` seconds apart.
+    Reports the normal users' latency and how much of the flood was answered with 429.
+    """
+    normal_clients = [new_logged_in_client(base_url) for _ in range(users)]
+    flooder = new_logged_in_client(base_url)
+
+    def new_session(client):
+        return client.post(f"{base_url}/api/new_chat_session").json()['session_id']
+
+    def chat(client, session_id):
+        # Unique text so the response cache can't answer for the upstream
+        return client.post(f"{base_url}/api/chat", timeout=120, json={
+            "session_id": session_id,
+            "message": {"role": "user", "parts": [{"text": f"fairness check {uuid.uuid4().hex}"}]}
+        })
+
+    latencies = []
+    errors = 0
+    flood = {"sent": 0, "ok": 0, "throttled": 0, "errors": 0}
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def normal_user(client):
+        nonlocal errors
+        session_id = new_session(client)
+        for _ in range(requests_per_user):
+            started = time.perf_counter()
+            try:
+                ok = chat(client, session_id).status_code == 200
+            except requests.exceptions.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+            time.sleep(think_time)
+
+    def flood_loop(_):
+        session_id = new_session(flooder)
+        while not done.is_set():
+            try:
+                status = chat(flooder, session_id).status_code
+                outcome = "ok" if status == 200 else "throttled" if status == 429 else "errors"
+            except requests.exceptions.RequestException:
+                outcome = "errors"
+            with lock:
+                flood["sent"] += 1
+                flood[outcome] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=flood_concurrency) as flood_pool:
+        for i in range(flood_concurrency):
+            flood_pool.submit(flood_loop, i)
+        with ThreadPoolExecutor(max_workers=users) as user_pool:
+            list(user_pool.map(normal_user, normal_clients))
+        done.set()
+    elapsed = time.perf_counter() - started
+
+    report = summarize(latencies, errors, elapsed)
+    report.update({"route": "/api/chat", "scenario": "fairness", "normal_users": users,
+                   "flood_concurrency": flood_concurrency, "flood": flood})
+    return report
+
+
+def run_session_benchmark(total_requests):
+    """
+    In-process comparison of the old signed-cookie session (full Google userinfo plus
+    profile fields) against the server-side store holding only the user's identity.
+    Reports cookie size and mean per-request time on a route that only checks the session.
+    """
+    import app as phantom
+    from flask.sessions import SecureCookieSessionInterface
+
+    legacy_session = {
+        'user': {
+            'iss': 'https://accounts.google.com', 'azp': 'x' * 72, 'aud': 'x' * 72, 'sub': '1' * 21,
+            'email': 'bench.user@example.com', 'email_verified': True, 'at_hash': 'x' * 22,
+            'name': 'Bench User', 'picture': 'https://lh3.googleusercontent.com/a/' + 'x' * 80,
+            'given_name': 'Bench', 'family_name': 'User', 'iat': 1700000000, 'exp': 1700003600
+        },
+        'user_email': 'bench.user@example.com', 'user_display_name': 'Bench User', 'google_id': '1' * 21,
+        'user_picture': 'https://lh3.googleusercontent.com/a/' + 'x' * 80,
+        'user_theme': 'theme-dark', 'user_language': 'en-US', 'user_voice': 'Google US English'
+    }
+    minimal_session = {'user': {'sub': '1' * 21}, 'google_id': '1' * 21}
+    server_interface = phantom.app.session_interface
+    if not isinstance(server_interface, phantom.ServerSideSessionInterface):
+        server_interface = phantom.ServerSideSessionInterface(
+            None, phantom.SESSION_TTL_SECONDS, phantom.InMemoryLRUCache(1000, phantom.SESSION_LOCAL_CACHE_SECONDS)
+        )
+
+    report = {"scenario": "session-overhead", "requests": total_requests}
+    original_interface = phantom.app.session_interface
+    try:
+        for label, interface, data in (('cookie', SecureCookieSessionInterface(), legacy_session),
+                                       ('server_side', server_interface, minimal_session)):
+            phantom.app.session_interface = interface
+            client = phantom.app.test_client()
+            with client.session_transaction() as bench_session:
+                bench_session.update(data)
+            cookie = client.get_cookie(phantom.app.config['SESSION_COOKIE_NAME'])
+
+            started = time.perf_counter()
+            for _ in range(total_requests):
+                client.post('/api/create_payment_session')
+            elapsed = time.perf_counter() - started
+            report[label] = {
+                "cookie_bytes": len(cookie.value) if cookie else 0,
+                "mean_request_us": round(elapsed / total_requests * 1e6, 1)
+            }
+    finally:
+        phantom.app.session_interface = original_interface
+    return report
+
+
+# --- Suite: the app booted against the mock upstream and a seeded database ---
+SEED_EMAIL_DOMAIN = 'seed.bench'
+SEED_PASSWORD = 'bench-password'
+
+DEFAULT_MIX = {'login': 1, 'all_sessions': 4, 'history': 4, 'search': 2, 'chat': 2, 'chat_stream': 1, 'run_code': 1}
+# Seeded messages mention a few of these, so searches for them have hits spread across sessions
+SEARCH_WORDS = ('gradient', 'kubernetes', 'sourdough', 'marathon', 'telescope', 'mortgage', 'haiku', 'compiler',
+                'espresso', 'glacier', 'violin', 'tensor', 'origami', 'volcano', 'budget', 'recursion')
+
+
+def seed_email(index):
+    return f"user{index}@{SEED_EMAIL_DOMAIN}"
+
+
+def seed_database(db, users, sessions_per_user, messages_per_session, password_hash):
+    """
+    Replaces any earlier seed data with `users` users (all with SEED_PASSWORD), each owning
+    `sessions_per_user` sessions of `messages_per_session` alternating user/model messages.
+    """
+    seed_filter = {'email': {'$regex': rf'@{SEED_EMAIL_DOMAIN.replace(".", "[.]")}$'}}
+    old_ids = [str(doc['_id']) for doc in db['users'].find(seed_filter, {'_id': 1})]
+    if old_ids:
+        db['chat_sessions'].delete_many({'user_id': {'$in': old_ids}})
+        db['messages'].delete_many({'user_id': {'$in': old_ids}})
+        db['users'].delete_many(seed_filter)
+
+    now = datetime.now(timezone.utc)
+    for index in range(users):
+        user_id = ObjectId()
+        db['users'].insert_one({
+            '_id': user_id, 'email': seed_email(index), 'display_name': f"Seed User {index}",
+            'password_hash': password_hash, 'picture_url': None, 'last_login': now,
+            'theme': 'theme-dark', 'language': 'en-US', 'voice': ''
+        })
+        sessions, messages = [], []
+        for session_index in range(sessions_per_user):
+            session_id = ObjectId()
+            started = now - timedelta(days=session_index, minutes=messages_per_session)
+            sessions.append({'_id': session_id, 'user_id': str(user_id), 'title': f"Seeded conversation {session_index}",
+                             'created_at': started, 'last_updated': started + timedelta(minutes=messages_per_session)})
+            for turn in range(messages_per_session):
+                role = 'user' if turn % 2 == 0 else 'model'
+                messages.append({'session_id': session_id, 'user_id': str(user_id), 'role': role, 'type': 'text',
+                                 'content': f"Seeded {role} message {turn} on {' and '.join(random.sample(SEARCH_WORDS, 2))}. "
+                                            + "Lorem ipsum dolor sit amet. " * 8,
+                                 'timestamp': started + timedelta(minutes=turn)})
+        if sessions:
+            db['chat_sessions'].insert_many(sessions)
+        if messages:
+            db['messages'].insert_many(messages)
+    return [seed_email(index) for index in range(users)]
+
+
+def install_mongomock():
+    """
+    Swaps pymongo.MongoClient for mongomock's in-memory client (app.py must not be imported yet).
+    mongomock's bulk_write doesn't accept the operation objects of current pymongo, so ops are
+    applied one at a time. Good enough to exercise the routes, not to measure the database.
+    """
+    import mongomock
+    import pymongo
+
+    def bulk_write(collection, requests_list, ordered=True, **kwargs):
+        from pymongo.results import BulkWriteResult
+        counts = {'nInserted': 0, 'nMatched': 0, 'nModified': 0, 'nUpserted': 0, 'nRemoved': 0, 'upserted': []}
+        for operation in requests_list:
+            name = type(operation).__name__
+            if name == 'InsertOne':
+                collection.insert_one(operation._doc)
+                counts['nInserted'] += 1
+            elif name in ('UpdateOne', 'UpdateMany'):
+                update = collection.update_one if name == 'UpdateOne' else collection.update_many
+                result = update(operation._filter, operation._doc, upsert=operation._upsert)
+                counts['nMatched'] += result.matched_count
+                counts['nModified'] += result.modified_count
+                counts['nUpserted'] += 1 if result.upserted_id is not None else 0
+            elif name in ('DeleteOne', 'DeleteMany'):
+                delete = collection.delete_one if name == 'DeleteOne' else collection.delete_many
+                counts['nRemoved'] += delete(operation._filter).deleted_count
+        return BulkWriteResult(counts, True)
+
+    mongomock.Collection.bulk_write = bulk_write
+    pymongo.MongoClient = mongomock.MongoClient
+
+
+def serve_in_memory(port, users, sessions_per_user, messages_per_session):
+    """Runs app.py on a mongomock database seeded in-process (single process, threaded)."""
+    install_mongomock()
+    import app as phantom
+    from werkzeug.security import generate_password_hash
+
+    seed_database(phantom.mongo_db, users, sessions_per_user, messages_per_session,
+                  generate_password_hash(SEED_PASSWORD, method=phantom.PASSWORD_HASH_METHOD))
+    # Exit normally on terminate(), so the password hashing pool's processes are shut down too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    phantom.app.run(host='127.0.0.1', port=port, threaded=True, use_reloader=False)
+
+
+def app_server_env(port, mongo, db_name, workers, mock_url, extra_env=None):
+    env = dict(os.environ, GEMINI_API_BASE=mock_url, GEMINI_API_KEY='bench', FLASK_SECRET_KEY=uuid.uuid4().hex,
+               PORT=str(port), WEB_CONCURRENCY=str(workers), LOG_LEVEL='WARNING',
+               # The suite drives many requests per user from one address; the limits are measured by `fairness`
+               RATE_LIMIT_BACKEND='off', LOGIN_MAX_ATTEMPTS_PER_IP='1000000', LOGIN_MAX_FAILURES_PER_ACCOUNT='1000000')
+    if mongo == 'memory':
+        # mongomock ignores partial index filters, so the users indexes would reject the seed data
+        env.update(MONGO_URI='mongodb://in-memory', MONGO_DB_NAME=db_name, MONGO_ENSURE_INDEXES='false', ATTACHMENT_STORAGE='disk',
+                   ATTACHMENT_DIR=tempfile.mkdtemp(prefix='phantom-bench-'))
+    elif mongo == 'sqlite':
+        env.update(STORAGE_BACKEND='sqlite', SQLITE_PATH=os.path.join(tempfile.gettempdir(), f'{db_name}.sqlite3'),
+                   ATTACHMENT_STORAGE='disk', ATTACHMENT_DIR=tempfile.mkdtemp(prefix='phantom-bench-'))
+    else:
+        env.update(MONGO_URI=mongo, MONGO_DB_NAME=db_name)
+    env.update(extra_env or {})
+    return env
+
+
+def start_app_server(port, mongo, db_name, workers, mock_url, users, sessions_per_user, messages_per_session,
+                     extra_env=None):
+    """
+    Boots the app on `port` against the mock upstream and returns the process. mongo is
+    'memory' (mongomock, see serve_in_memory), 'sqlite' or a MongoDB URI; the last two are
+    seeded from here and served by gunicorn with the repo's gunicorn.conf.py.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = app_server_env(port, mongo, db_name, workers, mock_url, extra_env)
+    if mongo == 'memory':
+        command = [sys.executable, os.path.abspath(__file__), 'serve-memory', '--port', str(port),
+                   '--users', str(users), '--sessions-per-user', str(sessions_per_user),
+                   '--messages-per-session', str(messages_per_session)]
+    elif mongo == 'sqlite':
+        import sqlitestore
+        from werkzeug.security import generate_password_hash
+        method = env.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+        db = sqlitestore.SQLiteDatabase(env['SQLITE_PATH'])
+        seed_database(db, users, sessions_per_user, messages_per_session,
+                      generate_password_hash(SEED_PASSWORD, method=method))
+        db.close()
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app']
+    else:
+        import pymongo
+        from werkzeug.security import generate_password_hash
+        method = env.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+        import indexes
+        with pymongo.MongoClient(mongo) as client:
+            seed_database(client[db_name], users, sessions_per_user, messages_per_session,
+                          generate_password_hash(SEED_PASSWORD, method=method))
+            # Built before the load starts; the app would otherwise build them while being measured
+            indexes.ensure_indexes(client[db_name])
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app']
+    return subprocess.Popen(command, cwd=here, env=env)
+
+
+def wait_until_ready(base_url, process, timeout=60, poll_seconds=0.2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App server exited during startup with status {process.returncode}")
+        try:
+            requests.get(f"{base_url}/login", timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(poll_seconds)
+    raise RuntimeError(f"App server did not answer within {timeout}s")
+
+
+def wait_until_listening(port, process, timeout=60):
+    """Waits for the port to accept connections, without sending the server a request."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App server exited during startup with status {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.01)
+    raise RuntimeError(f"App server did not listen within {timeout}s")
+
+
+def login_client(base_url, email):
+    client = requests.Session()
+    client.post(f"{base_url}/api/login", json={"username": email, "password": SEED_PASSWORD}).raise_for_status()
+    return client
+
+
+def run_mixed_workload(base_url, emails, concurrency, duration, mix):
+    """
+    `concurrency` workers, each signed in as a seeded user, issue requests picked at random
+    (weighted by `mix`) for `duration` seconds. Returns per-route and overall summaries.
+    """
+    operations, weights = zip(*[(name, weight) for name, weight in mix.items() if weight > 0])
+    clients = []
+    for index in range(concurrency):
+        email = emails[index % len(emails)]
+        client = login_client(base_url, email)
+        session_ids = [item['session_id'] for item in client.get(f"{base_url}/api/all_sessions").json()['sessions']]
+        clients.append((email, client, session_ids))
+
+    def chat_body(session_ids, stream):
+        return {"session_id": random.choice(session_ids), "stream": stream,
+                "message": {"role": "user", "parts": [{"text": f"mixed workload {uuid.uuid4().hex}"}]}}
+
+    def perform(operation, email, client, session_ids):
+        if operation == 'login':
+            return requests.post(f"{base_url}/api/login", json={"username": email, "password": SEED_PASSWORD}, timeout=30)
+        if operation == 'all_sessions':
+            return client.get(f"{base_url}/api/all_sessions", timeout=30)
+        if operation == 'history':
+            return client.get(f"{base_url}/api/history/{random.choice(session_ids)}", timeout=30)
+        if operation == 'search':
+            return client.get(f"{base_url}/api/search", params={"q": random.choice(SEARCH_WORDS)}, timeout=30)
+        if operation == 'run_code':
+            return client.post(f"{base_url}/api/run_code", json={"code": "print(sum(range(1000)))"}, timeout=30)
+        response = client.post(f"{base_url}/api/chat", json=chat_body(session_ids, operation == 'chat_stream'),
+                               stream=operation == 'chat_stream', timeout=120)
+        # A streamed reply counts as done once the last event has arrived
+        for _ in response.iter_content(chunk_size=None):
+            pass
+        return response
+
+    samples = {name: [] for name in operations}
+    failures = {name: 0 for name in operations}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(state):
+        email, client, session_ids = state
+        while time.monotonic() < deadline:
+            operation = random.choices(operations, weights)[0]
+            started = time.perf_counter()
+            try:
+                ok = perform(operation, email, client, session_ids).status_code == 200
+            except requests.exceptions.RequestException:
+                ok = False
+            latency = time.perf_counter() - started
+            with lock:
+                if ok:
+                    samples[operation].append(latency)
+                else:
+                    failures[operation] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, clients))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "routes": {name: summarize(samples[name], failures[name], elapsed) for name in operations},
+        "overall": summarize([value for values in samples.values() for value in values], sum(failures.values()), elapsed),
+    }
+
+
+def find_regressions(report, baseline, tolerance):
+    """Routes whose p95/p99 grew, or whose throughput or success rate fell, by more than `tolerance`."""
+    regressions = []
+    for name, current in report["routes"].items():
+        previous = baseline.get("routes", {}).get(name)
+        if not previous:
+            continue
+        for metric in ("p95_ms", "p99_ms"):
+            if previous[metric] and current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {previous[metric]} -> {current[metric]}")
+        if previous["throughput_rps"] and current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput_rps {previous['throughput_rps']} -> {current['throughput_rps']}")
+        previous_errors = previous["errors"] / previous["requests"] if previous["requests"] else 0.0
+        current_errors = current["errors"] / current["requests"] if current["requests"] else 0.0
+        if current_errors > previous_errors + tolerance / 10:
+            regressions.append(f"{name}: error rate {previous_errors:.3f} -> {current_errors:.3f}")
+    return regressions
+
+
+def parse_mix(text):
+    """'chat=2,history=4' -> {'chat': 2.0, 'history': 4.0}; unknown operations are rejected."""
+    mix = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        name, _, weight = item.partition('=')
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown operation '{name}' (choose from {', '.join(DEFAULT_MIX)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def run_suite(args):
+    mock = start_mock_gemini(0, args.upstream_latency, 0.0, args.stream_chunk_delay)
+    mock_url = f"http://127.0.0.1:{mock.server_address[1]}"
+    base_url = f"http://127.0.0.1:{args.port}"
+    server = start_app_server(args.port, args.mongo, args.db_name, args.workers, mock_url,
+                              args.users, args.sessions_per_user, args.messages_per_session)
+    mix = dict(args.mix)
+    if args.mongo == 'memory':
+        mix.pop('search', None)  # mongomock has no $text
+    try:
+        wait_until_ready(base_url, server)
+        results = run_mixed_workload(base_url, [seed_email(index) for index in range(args.users)],
+                                     args.concurrency, args.duration, mix)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        mock.shutdown()
+
+    report = {
+        "scenario": "suite",
+        "config": {key: getattr(args, key) for key in (
+            'mongo', 'workers', 'concurrency', 'duration', 'upstream_latency', 'stream_chunk_delay',
+            'users', 'sessions_per_user', 'messages_per_session')},
+        "mix": mix,
+        **results,
+    }
+    report["config"]["mongo"] = storage_label(args.mongo)  # Don't write credentials into the report
+    return report
+
+
+def storage_label(mongo):
+    return mongo if mongo in ('memory', 'sqlite') else 'mongodb'
+
+
+IMPORT_TIMER = "import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)"
+
+
+def run_startup_benchmark(mongo, db_name, workers, runs, port, preload):
+    """
+    Cold start. Reports the time to import app.py in a fresh interpreter, and per boot the
+    time from launch until the port accepts connections and until the first response, plus
+    the latency of the first (cold) and second (warm) request to a page, /api/login and
+    /api/all_sessions. With --mongo memory the boot also seeds one user in-process.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    mock = start_mock_gemini(0, 0.0)
+    mock_url = f"http://127.0.0.1:{mock.server_address[1]}"
+    base_url = f"http://127.0.0.1:{port}"
+    extra_env = {'PRELOAD_APP': 'true' if preload else 'false'}
+
+    import_env = app_server_env(port, mongo, db_name, workers, mock_url, extra_env)
+    import_times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', IMPORT_TIMER], cwd=here, env=import_env,
+                                capture_output=True, text=True, check=True).stdout
+        import_times.append(float(output.strip().splitlines()[-1]))
+
+    boots = []
+    try:
+        for _ in range(runs):
+            server = start_app_server(port, mongo, db_name, workers, mock_url, 1, 1, 2, extra_env)
+            launched = time.perf_counter()
+            try:
+                wait_until_listening(port, server)
+                boot = {"listening_s": round(time.perf_counter() - launched, 3)}
+                client = requests.Session()
+                for label, send in (
+                    ('page', lambda: client.get(f"{base_url}/login", timeout=60)),
+                    ('login', lambda: client.post(f"{base_url}/api/login", timeout=60,
+                                                  json={"username": seed_email(0), "password": SEED_PASSWORD})),
+                    ('all_sessions', lambda: client.get(f"{base_url}/api/all_sessions", timeout=60)),
+                ):
+                    for attempt in ('first', 'warm'):
+                        started = time.perf_counter()
+                        send().raise_for_status()
+                        boot[f"{label}_{attempt}_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                        if label == 'page' and attempt == 'first':
+                            boot["first_response_s"] = round(time.perf_counter() - launched, 3)
+                boots.append(boot)
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+    finally:
+        mock.shutdown()
+
+    return {
+        "scenario": "startup", "mongo": storage_label(mongo),
+        "workers": workers, "preload": preload,
+        "import_s": {"median": round(statistics.median(import_times), 3), "max": round(max(import_times), 3)},
+        "boots": boots,
+        "median": {key: statistics.median(boot[key] for boot in boots) for key in boots[0]} if boots else {},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Phantom_2.o load benchmark")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    mock_parser = subparsers.add_parser('mock-gemini', help="Run the mock Gemini upstream in the foreground")
+    mock_parser.add_argument('--port', type=int, default=8089)
+    mock_parser.add_argument('--latency', type=float, default=1.0, help="Seconds before the mock replies")
+    mock_parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of calls answered with 429/503")
+    mock_parser.add_argument('--stream-chunk-delay', type=float, default=0.0, help="Seconds between streamed chunks")
+
+    chat_parser = subparsers.add_parser('chat', help="Drive concurrent /api/chat requests")
+    chat_parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    chat_parser.add_argument('--concurrency', type=int, default=16)
+    chat_parser.add_argument('--requests', type=int, default=64)
+    chat_parser.add_argument('--workers', type=int, default=2, help="Gunicorn worker count of the target server")
+    chat_parser.add_argument('--upstream-latency', type=float, default=1.0, help="Latency the mock Gemini was started with")
+
+    context_parser = subparsers.add_parser('context', help="Measure payload size and latency as one session grows")
+    context_parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    context_parser.add_argument('--turns', type=int, default=60)
+    context_parser.add_argument('--mock-url', default=None, help="Mock Gemini URL, to also record upstream payload sizes")
+
+    run_code_parser = subparsers.add_parser('run-code', help="Drive trivial /api/run_code executions")
+    run_code_parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    run_code_parser.add_argument('--concurrency', type=int, default=4)
+    run_code_parser.add_argument('--requests', type=int, default=200)
+
+    fairness_parser = subparsers.add_parser('fairness', help="Normal users' chat latency while one client floods")
+    fairness_parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    fairness_parser.add_argument('--users', type=int, default=8)
+    fairness_parser.add_argument('--requests-per-user', type=int, default=10)
+    fairness_parser.add_argument('--think-time', type=float, default=1.0, help="Seconds between a normal user's messages")
+    fairness_parser.add_argument('--flood-concurrency', type=int, default=32)
+
+    suite_parser = subparsers.add_parser(
+        'suite', help="Boot the app against the mock upstream and a seeded database, then drive a mixed workload")
+    suite_parser.add_argument('--mongo', default='memory', help="'memory' (mongomock), 'sqlite' or a MongoDB URI to seed and use")
+    suite_parser.add_argument('--db-name', default='phantom_bench')
+    suite_parser.add_argument('--port', type=int, default=5055)
+    suite_parser.add_argument('--workers', type=int, default=2, help="Gunicorn workers (ignored with --mongo memory)")
+    suite_parser.add_argument('--upstream-latency', type=float, default=0.5)
+    suite_parser.add_argument('--stream-chunk-delay', type=float, default=0.02)
+    suite_parser.add_argument('--users', type=int, default=20)
+    suite_parser.add_argument('--sessions-per-user', type=int, default=30)
+    suite_parser.add_argument('--messages-per-session', type=int, default=40)
+    suite_parser.add_argument('--concurrency', type=int, default=16)
+    suite_parser.add_argument('--duration', type=float, default=30.0, help="Seconds of load")
+    suite_parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                              help="Operation weights, e.g. 'chat=2,history=4' (default: %(default)s)")
+    suite_parser.add_argument('--output', help="Also write the JSON report to this file")
+    suite_parser.add_argument('--baseline', help="Earlier report to compare against; exits 1 on regressions")
+    suite_parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed relative change vs the baseline")
+
+    startup_parser = subparsers.add_parser('startup', help="Measure import time, worker boot and first-request latency")
+    startup_parser.add_argument('--mongo', default='memory', help="'memory' (mongomock), 'sqlite' or a MongoDB URI")
+    startup_parser.add_argument('--db-name', default='phantom_bench')
+    startup_parser.add_argument('--port', type=int, default=5056)
+    startup_parser.add_argument('--workers', type=int, default=1, help="Gunicorn workers (ignored with --mongo memory)")
+    startup_parser.add_argument('--runs', type=int, default=5)
+    startup_parser.add_argument('--preload', action='store_true', help="Boot gunicorn with PRELOAD_APP=true")
+
+    serve_parser = subparsers.add_parser('serve-memory', help="Run the app on a seeded in-memory database (used by suite)")
+    serve_parser.add_argument('--port', type=int, default=5055)
+    serve_parser.add_argument('--users', type=int, default=20)
+    serve_parser.add_argument('--sessions-per-user', type=int, default=30)
+    serve_parser.add_argument('--messages-per-session', type=int, default=40)
+
+    session_parser = subparsers.add_parser('session', help="Compare cookie and server-side session overhead in-process")
+    session_parser.add_argument('--requests', type=int, default=2000)
+
+    args = parser.parse_args()
+    if args.command == 'mock-gemini':
+        server = start_mock_gemini(args.port, args.latency, args.error_rate, args.stream_chunk_delay)
+        print(f"Mock Gemini listening on http://127.0.0.1:{server.server_address[1]} (latency {args.latency}s)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.command == 'chat':
+        report = run_chat_benchmark(args.base_url, args.concurrency, args.requests, args.workers, args.upstream_latency)
+        print(json.dumps(report, indent=2))
+    elif args.command == 'run-code':
+        report = run_code_benchmark(args.base_url, args.concurrency, args.requests)
+        print(json.dumps(report, indent=2))
+    elif args.command == 'fairness':
+        report = run_fairness_benchmark(args.base_url, args.users, args.requests_per_user, args.think_time,
+                                        args.flood_concurrency)
+        print(json.dumps(report, indent=2))
+    elif args.command == 'suite':
+        report = run_suite(args)
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                report["regressions"] = find_regressions(report, json.load(baseline_file), args.tolerance)
+        print(json.dumps(report, indent=2))
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(report, output_file, indent=2)
+        if report.get("regressions"):
+            sys.exit(1)
+    elif args.command == 'startup':
+        report = run_startup_benchmark(args.mongo, args.db_name, args.workers, args.runs, args.port, args.preload)
+        print(json.dumps(report, indent=2))
+    elif args.command == 'serve-memory':
+        serve_in_memory(args.port, args.users, args.sessions_per_user, args.messages_per_session)
+    elif args.command == 'session':
+        print(json.dumps(run_session_benchmark(args.requests), indent=2))
+    elif args.command == 'context':
+        report = run_context_growth_benchmark(args.base_url, args.turns, args.mock_url)
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
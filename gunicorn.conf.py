@@ -0,0 +1,56 @@
+# --- Gunicorn configuration for Phantom_2.o ---
+# Loaded by the Procfile (`gunicorn -c gunicorn.conf.py app:app`).
+# Every value can be overridden through environment variables on the host.
+import os
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+
+# --- Worker class ---
+# /api/chat spends almost all of its time waiting on Gemini and MongoDB. With the
+# default sync worker each of those waits pins a whole process, so a few slow chats
+# starve the dashboard, login and history routes. The gevent worker monkey-patches
+# sockets before app.py is imported, which makes requests, pymongo and subprocess
+# cooperative: one process then serves up to `worker_connections` requests at once.
+# gevent is an optional dependency (`pip install gevent`). Without it the default
+# falls back to sync workers and says so loudly at startup; an explicit
+# WORKER_CLASS=gevent refuses to start instead. Set WORKER_CLASS=sync to opt out.
+try:
+    import gevent  # noqa: F401
+    _gevent_available = True
+except ImportError:
+    _gevent_available = False
+
+worker_class = os.getenv("WORKER_CLASS", "gevent" if _gevent_available else "sync")
+if worker_class == "gevent" and not _gevent_available:
+    raise RuntimeError("WORKER_CLASS=gevent but gevent is not installed; install it or set WORKER_CLASS=sync")
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "200"))
+
+# Streamed chat replies can legitimately stay open for a while.
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("WORKER_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("WORKER_KEEPALIVE", "5"))
+
+# app.py creates MongoDB, Gemini and OAuth clients and starts its threads on first
+# use, so importing it in the master and forking (PRELOAD_APP=true) is safe: workers
+# then boot without re-importing anything. The gevent worker must patch the standard
+# library before app.py is imported, so it always imports the app per worker.
+preload_app = os.getenv("PRELOAD_APP", "false").lower() in ("1", "true", "yes") and worker_class != "gevent"
+
+
+def on_starting(server):
+    if not _gevent_available and "WORKER_CLASS" not in os.environ:
+        server.log.warning(
+            "gevent is not installed: running %d sync workers, so each can serve only one request at a time "
+            "and slow chats will block other routes. Install gevent, or set WORKER_CLASS=sync to silence this.",
+            workers
+        )
+
+
+def worker_exit(server, worker):
+    # Write out chat messages still queued in the write-behind buffer before the worker goes away
+    app_module = sys.modules.get("app")
+    writer = getattr(app_module, "message_writer", None)
+    if writer is not None:
+        writer.close()
@@ -0,0 +1,157 @@
+"""
+MongoDB index set for Phantom_2.o.
+
+Every query shape app.py issues against the users, chat_sessions, messages
+and session_purges collections is listed in route_queries(), and INDEXES
+declares the index that serves it, along with the TTL indexes that expire
+sessions, cached responses and rate-limit state. ensure_indexes() is idempotent
+and runs in the background once per worker (see app.py) or via
+`flask ensure-indexes`; `flask check-indexes` explains every route query and
+fails if any of them falls back to a collection scan.
+
+Databases from before the unique email index may hold several users with one
+email. Those are reported (`flask duplicate-emails`) rather than merged, and
+the email index is skipped until they are resolved; every other index is
+still built.
+"""
+from datetime import datetime, timezone
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import PyMongoError
+
+
+INDEXES = {
+    'users': [
+        IndexModel([('email', ASCENDING)], name='email_unique', unique=True),
+        # Traditional users are stored with google_id: None, so only real Google ids are unique
+        IndexModel([('google_id', ASCENDING)], name='google_id_unique', unique=True,
+                   partialFilterExpression={'google_id': {'$gt': ''}}),
+    ],
+    'chat_sessions': [
+        # /api/all_sessions: find({'user_id'}).sort(last_updated -1, _id -1), keyset paginated
+        IndexModel([('user_id', ASCENDING), ('last_updated', DESCENDING), ('_id', DESCENDING)],
+                   name='user_last_updated'),
+    ],
+    'messages': [
+        # /api/history, context assembly and session deletion all filter on (session_id, user_id)
+        # and read in timestamp order (forwards or backwards)
+        IndexModel([('session_id', ASCENDING), ('user_id', ASCENDING), ('timestamp', ASCENDING), ('_id', ASCENDING)],
+                   name='session_user_timestamp_id'),
+        # /api/search: $text over one user's messages. The user_id prefix means a search only reads
+        # that user's index entries; no stemming or stop words, since chats are in many languages.
+        IndexModel([('user_id', ASCENDING), ('content', TEXT)], name='user_content_text', default_language='none'),
+    ],
+    'session_purges': [
+        # purge.SessionPurger claims the oldest unleased job
+        IndexModel([('claimed_until', ASCENDING), ('requested_at', ASCENDING)], name='claimable'),
+        # /api/search leaves out messages of the user's deleted sessions that are still waiting to be purged
+        IndexModel([('user_id', ASCENDING)], name='user'),
+    ],
+    # Documents carry their own expiry time. Default index names, as created by earlier versions of app.py
+    'web_sessions': [IndexModel([('expires_at', ASCENDING)], expireAfterSeconds=0)],
+    'response_cache': [IndexModel([('expires_at', ASCENDING)], expireAfterSeconds=0)],
+    'rate_limits': [IndexModel([('expires_at', ASCENDING)], expireAfterSeconds=0)],
+}
+
+
+class IndexBuildError(Exception):
+    """Raised by ensure_indexes after trying every collection, if any of them failed."""
+
+    def __init__(self, failures, created):
+        super().__init__("; ".join(f"{name}: {error}" for name, error in failures.items()))
+        self.failures = failures
+        self.created = created
+
+
+def find_duplicate_emails(db, limit=100):
+    """Emails held by more than one user, as [{'_id': email, 'ids': [...], 'count': n}]."""
+    return list(db['users'].aggregate([
+        {'$match': {'email': {'$type': 'string'}}},
+        {'$group': {'_id': '$email', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$limit': limit},
+    ]))
+
+
+def ensure_indexes(db):
+    """
+    Creates any missing indexes, one collection at a time so that one failing doesn't leave
+    the rest unindexed. Returns {collection: [index names]}; raises IndexBuildError if any failed.
+    """
+    created = {}
+    failures = {}
+    for collection_name, models in INDEXES.items():
+        if collection_name == 'users':
+            duplicates = find_duplicate_emails(db, limit=1)
+            if duplicates:
+                models = [model for model in models if model.document['name'] != 'email_unique']
+                failures[collection_name] = (f"email_unique skipped, {duplicates[0]['_id']!r} and maybe others belong "
+                                             f"to several users (see `flask duplicate-emails`)")
+        try:
+            created[collection_name] = db[collection_name].create_indexes(models)
+        except PyMongoError as error:
+            failures[collection_name] = str(error)
+    if failures:
+        raise IndexBuildError(failures, created)
+    return created
+
+
+def route_queries():
+    """(name, explain command) for each query shape used by the routes."""
+    user_id, session_id = 'sample-user-id', ObjectId()
+    return [
+        ('users by email', {'find': 'users', 'filter': {'email': 'someone@example.com'}, 'limit': 1}),
+        ('users by google_id', {'find': 'users', 'filter': {'google_id': '1234567890'}, 'limit': 1}),
+        ('sessions for user', {
+            'find': 'chat_sessions', 'filter': {'user_id': user_id},
+            'sort': {'last_updated': -1, '_id': -1}, 'limit': 51
+        }),
+        ('history page for session', {
+            'find': 'messages', 'filter': {'session_id': session_id, 'user_id': user_id},
+            'sort': {'timestamp': -1, '_id': -1}, 'limit': 51
+        }),
+        ('recent turns for context', {
+            'find': 'messages', 'filter': {'session_id': session_id, 'user_id': user_id},
+            'sort': {'timestamp': -1}, 'limit': 50
+        }),
+        ('purge chunk for deleted session', {
+            'find': 'messages', 'filter': {'session_id': session_id, 'user_id': user_id},
+            'projection': {'_id': 1}, 'limit': 500
+        }),
+        ('search messages', {
+            'find': 'messages',
+            'filter': {'user_id': user_id, '$text': {'$search': 'benchmark'}, 'session_id': {'$nin': [session_id]}},
+            'projection': {'score': {'$meta': 'textScore'}},
+            'sort': {'score': {'$meta': 'textScore'}, 'timestamp': -1}, 'limit': 21
+        }),
+        ('pending purges for user', {
+            'find': 'session_purges', 'filter': {'user_id': user_id}, 'projection': {'_id': 1}
+        }),
+        ('claim purge job', {
+            'find': 'session_purges', 'filter': {'claimed_until': {'$lt': datetime.now(timezone.utc)}},
+            'sort': {'claimed_until': 1, 'requested_at': 1}, 'limit': 1
+        }),
+    ]
+
+
+def _stages(plan):
+    """Yields every stage name in an explain plan tree."""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+
+def find_collection_scans(db):
+    """Explains every route query and returns the names of those whose winning plan is a COLLSCAN."""
+    scans = []
+    for name, command in route_queries():
+        explanation = db.command('explain', command, verbosity='queryPlanner')
+        if 'COLLSCAN' in _stages(explanation['queryPlanner']['winningPlan']):
+            scans.append(name)
+    return scans
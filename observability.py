@@ -0,0 +1,226 @@
+"""
+Metrics and logging for Phantom_2.o.
+
+Metrics are a small in-process registry rendered in the Prometheus text
+exposition format by the /metrics route in app.py. Counters and histograms are
+updated inline; "callback" metrics read a stats dict (pool, cache, queue) only
+when /metrics is scraped, so those hot paths pay nothing extra. Each gunicorn
+worker keeps its own registry, so scrape every worker (or accept per-worker
+samples) the same way the other per-process stats are reported.
+
+Logging is standard `logging` with one JSON object per line. DEBUG records
+are sampled (LOG_DEBUG_SAMPLE_RATE) so per-request detail can stay enabled in
+production at a bounded cost, and LOG_LEVEL=WARNING switches it off entirely.
+"""
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in self._values.items()]
+
+
+class Histogram:
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, series in self._series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                    cumulative += count
+                    samples.append((f'{self.name}_bucket', key, (('le', _format_value(bound)),), cumulative))
+                samples.append((f'{self.name}_count', key, (), cumulative))
+                samples.append((f'{self.name}_sum', key, (), series[-1]))
+        return samples
+
+
+class _Timer:
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class CallbackMetric:
+    """A gauge or counter whose samples come from `callback()` -> {label values tuple: value} at scrape time."""
+
+    def __init__(self, name, documentation, type_name, labelnames, callback):
+        self.name = name
+        self.documentation = documentation
+        self.type_name = type_name
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def samples(self):
+        return [(self.name, tuple(str(value) for value in key), (), value) for key, value in self.callback().items()]
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge_callback(self, name, documentation, callback, labelnames=()):
+        return self.register(CallbackMetric(name, documentation, 'gauge', labelnames, callback))
+
+    def counter_callback(self, name, documentation, callback, labelnames=()):
+        return self.register(CallbackMetric(name, documentation, 'counter', labelnames, callback))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as error:
+                # One broken source (e.g. the database behind a backlog gauge) shouldn't fail the scrape
+                logging.getLogger(__name__).warning("metric collection failed", extra={'fields': {'metric': metric.name, 'error': str(error)}})
+                continue
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            for sample_name, key, extra, value in samples:
+                lines.append(f'{sample_name}{_format_labels(metric.labelnames, key, extra)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """pymongo command listener that records per-collection command latency."""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self._collections = {}
+
+    @staticmethod
+    def _key(event):
+        return (event.connection_id, event.request_id)
+
+    def started(self, event):
+        # getMore names its collection separately; its command value is the cursor id
+        collection = event.command.get('collection' if event.command_name == 'getMore' else event.command_name)
+        self._collections[self._key(event)] = collection if isinstance(collection, str) else ''
+
+    def _finish(self, event, outcome):
+        collection = self._collections.pop(self._key(event), '')
+        self.histogram.observe(event.duration_micros / 1e6, collection=collection, command=event.command_name, outcome=outcome)
+
+    def succeeded(self, event):
+        self._finish(event, 'ok')
+
+    def failed(self, event):
+        self._finish(event, 'error')
+
+
+# --- Logging ---
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; structured fields go in `extra={'fields': {...}}`."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """Lets through every record at INFO and above, and `rate` of the DEBUG ones."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+def configure_logging(level='INFO', debug_sample_rate=1.0, json_format=True):
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    handler.addFilter(DebugSampler(debug_sample_rate))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
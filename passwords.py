@@ -0,0 +1,186 @@
+"""
+Password hashing off the request thread, plus login attempt throttling.
+
+Hashing and verifying are deliberately CPU-heavy, so PasswordHasher runs them
+on a small process pool and admits at most `max_queue` jobs at once; anything
+beyond that fails fast with HasherBusyError instead of piling up behind a
+login storm. The KDF is a werkzeug method string (e.g. "scrypt:32768:8:1" or
+"pbkdf2:sha256:600000"); hashes made with any other method are reported by
+needs_rehash() so they can be upgraded after a successful login. Methods are
+compared after filling in werkzeug's defaults, the way werkzeug writes them
+into the hash ("pbkdf2:sha256" is stored as "pbkdf2:sha256:1000000"). Logins
+for unknown accounts are checked against a dummy hash, so they take as long
+as a wrong password for a real one.
+
+AttemptThrottle is a per-process sliding-window counter used to turn away
+repeated attempts per IP and per account before any hashing happens.
+"""
+import secrets
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+
+class HasherBusyError(Exception):
+    """Raised when too many hashing jobs are already queued or a job doesn't finish in time."""
+
+
+def normalise_method(method):
+    """The method string werkzeug stores for `method`, with its default parameters filled in."""
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+        return f"scrypt:{n}:{r}:{p}"
+    if name == 'pbkdf2' and len(args) <= 2:
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iterations}"
+    raise ValueError(f"Invalid hash method '{method}'.")
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(password_hash, password):
+    return check_password_hash(password_hash, password)
+
+
+class PasswordHasher:
+
+    def __init__(self, method, workers=2, max_queue=32, timeout=10.0):
+        self.method = method
+        self._stored_method = normalise_method(method)
+        self._dummy_hash = None
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.stats = {"hashed": 0, "verified": 0, "rejected": 0}
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        return self._in_flight
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.stats["rejected"] += 1
+            raise HasherBusyError("Too many password checks are in progress.")
+        with self._lock:
+            self._in_flight += 1
+        executor = self._executor
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException as error:
+            self._job_done()
+            if isinstance(error, BrokenProcessPool):
+                self._replace_executor(executor)
+                raise HasherBusyError("Password hashing pool was restarted.")
+            raise
+        # The slot is held until the job really leaves the pool, not just until this caller gives up
+        future.add_done_callback(self._job_done)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # Drops the job if it hasn't started; one that is already hashing keeps its slot until it ends
+            future.cancel()
+            self.stats["rejected"] += 1
+            raise HasherBusyError("Password check did not finish in time.")
+        except BrokenProcessPool:
+            self._replace_executor(executor)
+            raise HasherBusyError("Password hashing pool was restarted.")
+
+    def _job_done(self, future=None):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _replace_executor(self, broken):
+        """A hashing process died (e.g. OOM-killed): the first caller to notice starts a fresh pool."""
+        with self._lock:
+            if self._executor is not broken:
+                return
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password):
+        result = self._run(_hash, password, self.method)
+        self.stats["hashed"] += 1
+        return result
+
+    def verify(self, password_hash, password):
+        """
+        Checks `password` against `password_hash`. Without a hash (unknown account, Google-only
+        user) it checks against a dummy one instead and returns False, in the same time.
+        """
+        if not password_hash:
+            if self._dummy_hash is None:
+                self._dummy_hash = self._run(_hash, secrets.token_urlsafe(16), self.method)
+            self._run(_verify, self._dummy_hash, password)
+            self.stats["verified"] += 1
+            return False
+        result = self._run(_verify, password_hash, password)
+        self.stats["verified"] += 1
+        return result
+
+    def needs_rehash(self, password_hash):
+        # werkzeug hashes look like "<method>$<salt>$<hash>"
+        try:
+            return normalise_method(password_hash.split('$', 1)[0]) != self._stored_method
+        except ValueError:
+            return True
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AttemptThrottle:
+
+    def __init__(self, max_attempts, window_seconds, max_keys=100000):
+        self.max_attempts = max_attempts
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, key, now):
+        attempts = self._attempts.get(key)
+        if attempts is None:
+            return None
+        while attempts and attempts[0] <= now - self.window_seconds:
+            attempts.popleft()
+        if not attempts:
+            del self._attempts[key]
+            return None
+        return attempts
+
+    def retry_after(self, key):
+        """Seconds until `key` may try again, or 0 if it's under the limit."""
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._prune(key, now)
+            if attempts is None or len(attempts) < self.max_attempts:
+                return 0
+            return max(1, int(attempts[0] + self.window_seconds - now) + 1)
+
+    def record(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._prune(key, now)
+            if len(self._attempts) >= self.max_keys:
+                # Drop keys whose attempts have all aged out so the table can't grow without bound
+                for stale_key in list(self._attempts):
+                    self._prune(stale_key, now)
+            self._attempts.setdefault(key, deque()).append(now)
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
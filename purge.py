@@ -0,0 +1,118 @@
+"""
+Background purge of messages that belong to deleted chat sessions.
+
+Deleting a session removes its chat_sessions document straight away and
+records a job in the `session_purges` collection (keyed by the session id,
+so re-deleting is a no-op). SessionPurger works through that backlog on a
+daemon thread: it claims one job at a time with a lease, so several gunicorn
+workers can share the backlog and a crashed worker's job is picked up again,
+and deletes the session's messages in chunks of `chunk_size` with a pause
+between chunks so a long session never turns into one huge delete_many.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+
+# Jobs that nobody holds have a lease in the past
+UNCLAIMED = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+log = logging.getLogger(__name__)
+
+
+class SessionPurger:
+
+    def __init__(self, messages_collection, jobs_collection, chunk_size=500, pause_seconds=0.05,
+                 lease_seconds=60, poll_seconds=5.0):
+        self.messages_collection = messages_collection
+        self.jobs_collection = jobs_collection
+        self.chunk_size = chunk_size
+        self.pause_seconds = pause_seconds
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.stats = {"sessions_queued": 0, "sessions_purged": 0, "messages_purged": 0, "chunks": 0, "errors": 0}
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def enqueue(self, user_id, session_ids):
+        """Records purge jobs for the given (already owned) session ids."""
+        if not session_ids:
+            return
+        now = datetime.now(timezone.utc)
+        self.jobs_collection.bulk_write([
+            UpdateOne(
+                {'_id': session_id},
+                {'$setOnInsert': {'user_id': user_id, 'requested_at': now, 'claimed_until': UNCLAIMED}},
+                upsert=True
+            )
+            for session_id in session_ids
+        ], ordered=False)
+        self.stats["sessions_queued"] += len(session_ids)
+        self._wakeup.set()
+
+    def backlog(self):
+        """Number of sessions whose messages are still waiting to be purged."""
+        return self.jobs_collection.estimated_document_count()
+
+    def _claim(self):
+        now = datetime.now(timezone.utc)
+        return self.jobs_collection.find_one_and_update(
+            {'claimed_until': {'$lt': now}},
+            {'$set': {'claimed_until': now + timedelta(seconds=self.lease_seconds)}},
+            sort=[('claimed_until', ASCENDING), ('requested_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _purge(self, job):
+        message_filter = {'session_id': job['_id'], 'user_id': job['user_id']}
+        while not self._stopped:
+            chunk = [doc['_id'] for doc in self.messages_collection.find(message_filter, {'_id': 1}).limit(self.chunk_size)]
+            if not chunk:
+                self.jobs_collection.delete_one({'_id': job['_id']})
+                self.stats["sessions_purged"] += 1
+                return
+            result = self.messages_collection.delete_many({'_id': {'$in': chunk}})
+            self.stats["messages_purged"] += result.deleted_count
+            self.stats["chunks"] += 1
+            # Keep the lease while there is work left, then give the database a breather
+            self.jobs_collection.update_one(
+                {'_id': job['_id']},
+                {'$set': {'claimed_until': datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)}}
+            )
+            time.sleep(self.pause_seconds)
+
+    def run_once(self):
+        """Purges one claimed session. Returns False when there was nothing to claim."""
+        job = self._claim()
+        if job is None:
+            return False
+        self._purge(job)
+        return True
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                if self.run_once():
+                    continue
+            except PyMongoError:
+                self.stats["errors"] += 1
+            except Exception:
+                # The thread lives as long as the process; a job that keeps failing is retried
+                # once its lease runs out rather than stopping every other purge
+                self.stats["errors"] += 1
+                log.exception("session purge failed")
+            self._wakeup.wait(self.poll_seconds)
+            self._wakeup.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='session-purger', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
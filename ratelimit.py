@@ -0,0 +1,137 @@
+"""
+Per-user rate limits and concurrency caps for the expensive routes.
+
+Each limited route has a token bucket (`rate_per_minute` sustained, `burst`
+at once) and a cap on how many of the user's requests may be in flight at the
+same time. Two backends share one interface:
+
+- InMemoryLimiter keeps buckets and in-flight counts in this process. Right
+  for a single host; with several gunicorn workers each worker enforces the
+  limits on its own.
+- MongoLimiter keeps them in a MongoDB collection with atomic updates, so all
+  workers and hosts share them. Documents carry an expires_at time, and the
+  TTL index in indexes.py removes idle buckets and slots leaked by a crashed
+  worker.
+
+acquire() returns (slot, retry_after): a slot to release() when the request
+finishes, or None and the number of seconds the caller should wait.
+"""
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class Limit:
+
+    def __init__(self, rate_per_minute, burst, max_concurrent):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+
+
+class InMemoryLimiter:
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> (tokens, updated_at, full_at)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.stats = {"allowed": 0, "rate_limited": 0, "concurrency_limited": 0}
+
+    def _prune(self, now):
+        # A bucket that has refilled completely is the same as no bucket at all
+        for stale_key in [key for key, bucket in self._buckets.items() if bucket[2] <= now]:
+            del self._buckets[stale_key]
+
+    def acquire(self, key, limit):
+        now = time.monotonic()
+        with self._lock:
+            if self._in_flight.get(key, 0) >= limit.max_concurrent:
+                self.stats["concurrency_limited"] += 1
+                # No refill timing to go on here; a request usually finishes within a couple of seconds
+                return None, 1
+            if key not in self._buckets and len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            tokens, updated_at, _ = self._buckets.get(key, (limit.burst, now, now))
+            tokens = min(limit.burst, tokens + (now - updated_at) * limit.rate_per_second)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (limit.burst - tokens) / limit.rate_per_second)
+            if not allowed:
+                self.stats["rate_limited"] += 1
+                return None, math.ceil((1 - tokens) / limit.rate_per_second)
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            self.stats["allowed"] += 1
+        return key, 0
+
+    def release(self, slot):
+        with self._lock:
+            remaining = self._in_flight.get(slot, 0) - 1
+            if remaining > 0:
+                self._in_flight[slot] = remaining
+            else:
+                self._in_flight.pop(slot, None)
+
+
+class MongoLimiter:
+
+    def __init__(self, collection, slot_ttl_seconds=600):
+        self.collection = collection
+        self.slot_ttl_seconds = slot_ttl_seconds
+        self.stats = {"allowed": 0, "rate_limited": 0, "concurrency_limited": 0}
+
+    def _take_token(self, key, limit):
+        now = time.time()
+        refill_seconds = limit.burst / limit.rate_per_second
+        # Refill and spend in a single atomic pipeline update
+        tokens_now = {'$min': [limit.burst, {'$add': [
+            {'$ifNull': ['$tokens', limit.burst]},
+            {'$multiply': [{'$subtract': [now, {'$ifNull': ['$updated', now]}]}, limit.rate_per_second]}
+        ]}]}
+        doc = self.collection.find_one_and_update(
+            {'_id': f'bucket:{key}'},
+            [
+                {'$set': {'tokens': tokens_now, 'updated': now}},
+                {'$set': {'allowed': {'$gte': ['$tokens', 1]}}},
+                {'$set': {
+                    'tokens': {'$cond': ['$allowed', {'$subtract': ['$tokens', 1]}, '$tokens']},
+                    'expires_at': {'$literal': datetime.now(timezone.utc) + timedelta(seconds=refill_seconds)}
+                }}
+            ],
+            projection={'tokens': 1, 'allowed': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if doc['allowed']:
+            return 0
+        return math.ceil((1 - doc['tokens']) / limit.rate_per_second)
+
+    def acquire(self, key, limit):
+        slot = f'inflight:{key}'
+        try:
+            # Matches only while under the cap; at the cap the upsert collides with the existing document.
+            # The expiry is set once, so counts leaked by a crashed worker reset within slot_ttl_seconds.
+            self.collection.update_one(
+                {'_id': slot, 'count': {'$lt': limit.max_concurrent}},
+                {'$inc': {'count': 1},
+                 '$setOnInsert': {'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.slot_ttl_seconds)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            self.stats["concurrency_limited"] += 1
+            return None, 1
+        retry_after = self._take_token(key, limit)
+        if retry_after:
+            self.release(slot)
+            self.stats["rate_limited"] += 1
+            return None, retry_after
+        self.stats["allowed"] += 1
+        return slot, 0
+
+    def release(self, slot):
+        self.collection.update_one({'_id': slot, 'count': {'$gt': 0}}, {'$inc': {'count': -1}})
@@ -0,0 +1,555 @@
+"""
+Pre-warmed sandbox worker pool for /api/run_code.
+
+Each worker is a long-lived `python -I sandbox.py` process that has already
+paid interpreter start-up. For every job it forks a child that drops into
+resource limits (CPU time, address space, file size, no new processes), a
+private network namespace with no interfaces and a private mount namespace
+whose root is a small tmpfs: the system and Python directories are bind
+mounted into it read-only and its /tmp is the only writable place, so the
+app's code, database, attachments and .env are out of reach. A root worker
+then drops to an unprivileged user (`run_as`); any other worker enters a user
+namespace mapped to that one unprivileged id and gives up the capabilities
+it held there. The child runs the code and reports stdout/stderr back over a
+pipe. Workers are recycled after `max_jobs_per_worker` jobs, and the pool
+admits at most `max_queue` waiting requests so a burst of runs can't
+fork-bomb the host.
+
+Workers start with a minimal environment (sandbox_env), so the app's secrets
+are never visible to user code. Isolation fails closed: each worker first
+checks in a throwaway child that it can build the namespaces, drop its
+privileges and no longer see this file, and if it can't, the pool raises
+SandboxUnavailableError instead of running code unconfined. Each worker keeps
+its jobs' scratch directories under one directory of its own, which the pool
+removes when it retires the worker, so a worker killed mid-job leaves nothing
+behind.
+
+Protocol (one JSON object per line on the worker's stdin/stdout):
+    -> {"code": "...", "timeout": 10, "max_output": 65536}
+    <- {"stdout": "...", "stderr": "...", "exit_code": 0, "timed_out": false, "truncated": false}
+A worker's first line is its isolation check: {"ready": true} or {"ready": false, "error": "..."}.
+"""
+import codecs
+import ctypes
+import json
+import os
+import pwd
+import queue
+import resource
+import selectors
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+
+# unshare(2) flags; os.unshare only exists from Python 3.12
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWNET = 0x40000000
+
+# mount(2) flags, and the statvfs flags a read-only remount has to keep
+MS_RDONLY, MS_NOSUID, MS_NODEV, MS_NOEXEC = 0x1, 0x2, 0x4, 0x8
+MS_REMOUNT, MS_BIND, MS_REC, MS_PRIVATE = 0x20, 0x1000, 0x4000, 0x40000
+MS_NOATIME, MS_NODIRATIME, MS_RELATIME = 0x400, 0x800, 0x200000
+LOCKED_MOUNT_FLAGS = {os.ST_NOSUID: MS_NOSUID, os.ST_NODEV: MS_NODEV, os.ST_NOEXEC: MS_NOEXEC,
+                      os.ST_NOATIME: MS_NOATIME, os.ST_NODIRATIME: MS_NODIRATIME, os.ST_RELATIME: MS_RELATIME}
+
+PR_SET_NO_NEW_PRIVS = 38
+LINUX_CAPABILITY_VERSION_3 = 0x20080522
+
+# What a job can see of the host, read-only; the interpreter's own prefixes are added to these
+SYSTEM_DIRS = ('/usr', '/bin', '/sbin', '/lib', '/lib32', '/lib64')
+
+
+class SandboxBusyError(Exception):
+    """Raised when the run queue is full or no worker frees up in time."""
+
+
+class SandboxUnavailableError(Exception):
+    """Raised when workers can't isolate jobs (no network namespace, or no user to drop root to)."""
+
+
+def sandbox_env():
+    """The whole environment of a worker and its jobs: nothing from the app's, so no secrets."""
+    return {'PATH': os.defpath, 'LANG': 'C.UTF-8', 'LC_ALL': 'C.UTF-8', 'HOME': tempfile.gettempdir(),
+            'TMPDIR': tempfile.gettempdir()}
+
+
+class SandboxPool:
+
+    def __init__(self, size=4, max_jobs_per_worker=50, max_queue=16, queue_timeout=5.0,
+                 cpu_seconds=10, memory_mb=256, max_file_mb=1, scratch_mb=16, max_output_bytes=64 * 1024,
+                 run_as='nobody'):
+        self.size = size
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.limits = {"cpu_seconds": cpu_seconds, "memory_mb": memory_mb, "max_file_mb": max_file_mb,
+                       "scratch_mb": scratch_mb, "run_as": run_as}
+        self.max_output_bytes = max_output_bytes
+        self.stats = {"jobs": 0, "rejected": 0, "timeouts": 0, "workers_recycled": 0}
+        self._idle = queue.Queue()
+        self._waiting = 0
+        self._lock = threading.Lock()
+        for _ in range(size):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        # The worker's jobs work under here; it is removed with the worker, finished jobs or not
+        workdir = tempfile.mkdtemp(prefix='phantom-sandbox-')
+        try:
+            worker = subprocess.Popen(
+                [sys.executable, '-I', os.path.abspath(__file__), json.dumps(self.limits), workdir],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                bufsize=1,
+                close_fds=True,
+                env=sandbox_env()
+            )
+        except BaseException:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        worker.workdir = workdir
+        worker.jobs_done = 0
+        try:
+            handshake = self._read_message(worker)
+        except (RuntimeError, ValueError) as error:
+            handshake = {"ready": False, "error": str(error)}
+        if not handshake.get("ready"):
+            self._retire(worker)
+            raise SandboxUnavailableError(f"Sandbox workers can't isolate jobs: {handshake.get('error')}")
+        return worker
+
+    def _retire(self, worker):
+        self.stats["workers_recycled"] += 1
+        try:
+            worker.kill()
+            worker.wait(timeout=1)
+        except Exception:
+            pass
+        shutil.rmtree(worker.workdir, ignore_errors=True)
+
+    @property
+    def queue_depth(self):
+        return self._waiting
+
+    def _acquire(self):
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise SandboxBusyError("Too many code executions are queued.")
+            self._waiting += 1
+        try:
+            worker = self._idle.get(timeout=self.queue_timeout)
+        except queue.Empty:
+            self.stats["rejected"] += 1
+            raise SandboxBusyError("No sandbox worker became available.")
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        if worker.poll() is not None:
+            # Died while idle; replace it with a fresh one
+            worker = self._spawn()
+        return worker
+
+    def _release(self, worker, healthy):
+        if healthy:
+            self._idle.put(worker)
+        else:
+            self._retire(worker)
+            self._idle.put(self._spawn())
+
+    def _submit(self, worker, code, timeout, stream):
+        job = {"code": code, "timeout": timeout, "max_output": self.max_output_bytes, "stream": stream}
+        worker.stdin.write(json.dumps(job) + "\n")
+        worker.stdin.flush()
+
+    def _read_message(self, worker):
+        line = worker.stdout.readline()
+        if not line:
+            raise RuntimeError("Sandbox worker exited unexpectedly.")
+        return json.loads(line)
+
+    def _finish(self, worker, result):
+        worker.jobs_done += 1
+        self.stats["jobs"] += 1
+        if result.get("timed_out"):
+            self.stats["timeouts"] += 1
+        return worker.jobs_done < self.max_jobs_per_worker
+
+    def run(self, code, timeout=10):
+        """Runs `code` on an idle worker and returns the worker's result dict."""
+        worker = self._acquire()
+        healthy = False
+        try:
+            self._submit(worker, code, timeout, stream=False)
+            result = self._read_message(worker)
+            healthy = self._finish(worker, result)
+            return result
+        finally:
+            self._release(worker, healthy)
+
+    def stream(self, code, timeout=10):
+        """
+        Claims a worker now (raising SandboxBusyError straight away) and returns a StreamingJob
+        of messages: {"stream": "stdout"|"stderr", "data": ...} chunks followed by the final
+        {"done": true, "exit_code": ...} result. The caller must close() it when done with it.
+        """
+        return StreamingJob(self, self._acquire(), code, timeout)
+
+    def shutdown(self):
+        while True:
+            try:
+                self._retire(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+class StreamingJob:
+    """
+    Iterable of one streamed job's messages. close() gives the worker back even if iteration
+    never started (the client went away before the response body), so hook it to the response.
+    """
+
+    def __init__(self, pool, worker, code, timeout):
+        self.pool = pool
+        self.worker = worker
+        self.code = code
+        self.timeout = timeout
+        self._submitted = False
+        self._healthy = False
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        try:
+            self._submitted = True
+            self.pool._submit(self.worker, self.code, self.timeout, stream=True)
+            while True:
+                message = self.pool._read_message(self.worker)
+                if message.get("done"):
+                    self._healthy = self.pool._finish(self.worker, message)
+                    yield message
+                    return
+                yield message
+        finally:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        # An untouched worker goes straight back; one left mid-job is still running it, so it is replaced
+        self.pool._release(self.worker, self._healthy or not self._submitted)
+
+
+# --- Worker side (runs in the `python -I sandbox.py` process) ---
+
+def _libc():
+    return ctypes.CDLL(None, use_errno=True)
+
+
+def _check(result, what):
+    if result != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"{what}: {os.strerror(errno)}")
+
+
+def _unshare(flags):
+    if hasattr(os, 'unshare'):
+        os.unshare(flags)
+    else:
+        _check(_libc().unshare(flags), "Can't create namespaces")
+
+
+def _mount(source, target, fstype, flags, data=None):
+    _check(_libc().mount(source and source.encode(), target.encode(), fstype and fstype.encode(),
+                         ctypes.c_ulong(flags), data and data.encode()), f"Can't mount {target}")
+
+
+def _sandbox_ids(user):
+    """(uid, gid) of `user` (a name or uid), the unprivileged identity jobs run as."""
+    if user in (None, ''):
+        raise PermissionError("Refusing to run code without a sandbox user (run_as).")
+    if str(user).isdigit():
+        uid = gid = int(user)
+    else:
+        entry = pwd.getpwnam(user)
+        uid, gid = entry.pw_uid, entry.pw_gid
+    if uid == 0:
+        raise PermissionError(f"Sandbox user {user!r} is root.")
+    return uid, gid
+
+
+def _enter_namespaces(uid, gid):
+    """
+    New network and mount namespaces. Root can create them directly; anyone else needs a user
+    namespace too, in which it appears as the sandbox user and holds capabilities only there.
+    Raises OSError if the kernel refuses: there is no fallback.
+    """
+    if os.geteuid() == 0:
+        _unshare(CLONE_NEWNS | CLONE_NEWNET)
+        return
+    outer_uid, outer_gid = os.geteuid(), os.getegid()
+    _unshare(CLONE_NEWUSER | CLONE_NEWNS | CLONE_NEWNET)
+    for path, text in (('/proc/self/setgroups', 'deny'), ('/proc/self/uid_map', f'{uid} {outer_uid} 1'),
+                       ('/proc/self/gid_map', f'{gid} {outer_gid} 1')):
+        with open(path, 'w') as handle:
+            handle.write(text)
+
+
+def _visible_dirs():
+    """The host directories bind mounted into a job's root: system directories and the interpreter's."""
+    dirs = []
+    candidates = (*SYSTEM_DIRS, sys.prefix, sys.exec_prefix, sys.base_prefix, sys.base_exec_prefix)
+    for path in sorted({os.path.realpath(path) for path in candidates if os.path.isdir(path)}):
+        if not any(path == parent or path.startswith(parent + os.sep) for parent in dirs):
+            dirs.append(path)
+    return dirs
+
+
+def _bind_read_only(source, root):
+    target = os.path.join(root, source.lstrip(os.sep))
+    os.makedirs(target, exist_ok=True)
+    _mount(source, target, None, MS_BIND)
+    # A bind mount starts out writable; the remount has to keep the flags the source mount is locked with
+    locked = os.statvfs(source).f_flag
+    flags = MS_BIND | MS_REMOUNT | MS_RDONLY
+    for st_flag, ms_flag in LOCKED_MOUNT_FLAGS.items():
+        if locked & st_flag:
+            flags |= ms_flag
+    _mount(None, target, None, flags)
+
+
+def _confine_filesystem(root, scratch_mb, owner=None):
+    """
+    Makes a fresh tmpfs at `root` this process's whole filesystem: read-only system and Python
+    directories plus a writable /tmp, which becomes the working directory.
+    """
+    _mount(None, '/', None, MS_REC | MS_PRIVATE)  # Nothing below propagates back to the host
+    _mount('tmpfs', root, 'tmpfs', MS_NOSUID | MS_NODEV, f'size={int(scratch_mb)}m,mode=0755')
+    for path in _visible_dirs():
+        _bind_read_only(path, root)
+    for name in SYSTEM_DIRS:
+        # Merged-/usr hosts have /bin -> usr/bin and so on
+        if os.path.islink(name) and not os.path.lexists(os.path.join(root, name.lstrip(os.sep))):
+            os.symlink(os.readlink(name), os.path.join(root, name.lstrip(os.sep)))
+    scratch = os.path.join(root, 'tmp')
+    os.mkdir(scratch, 0o700)
+    if owner is not None:
+        os.chown(scratch, *owner)
+    os.chroot(root)
+    os.chdir('/tmp')
+
+
+def _drop_capabilities():
+    """Clears every capability (those a user namespace grants included) for good."""
+    header = (ctypes.c_uint32 * 2)(LINUX_CAPABILITY_VERSION_3, 0)
+    data = (ctypes.c_uint32 * 6)()
+    _check(_libc().capset(header, data), "Can't drop capabilities")
+
+
+def _isolate(user, workdir, scratch_mb):
+    """No network, only `workdir` (as /) to write to, then no privileges. All or nothing: any failure raises."""
+    uid, gid = _sandbox_ids(user)
+    root = os.geteuid() == 0
+    _enter_namespaces(uid, gid)
+    _confine_filesystem(workdir, scratch_mb, owner=(uid, gid) if root else None)
+    _check(_libc().prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0), "Can't set no_new_privs")
+    if root:
+        os.setgroups([])
+        os.setgid(gid)
+        os.setuid(uid)
+    else:
+        _drop_capabilities()
+
+
+def _probe_isolation(limits, workdir):
+    """
+    Runs _isolate in a throwaway child and checks that the app is out of sight afterwards.
+    Returns None if it worked, else the reason it didn't.
+    """
+    app_file = os.path.abspath(__file__)
+    probe_dir = tempfile.mkdtemp(dir=workdir)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            _isolate(limits.get("run_as"), probe_dir, limits.get("scratch_mb", 16))
+            if os.path.exists(app_file):
+                raise PermissionError(f"{app_file} is still visible to jobs")
+        except BaseException as error:
+            os.write(write_fd, f"{type(error).__name__}: {error}".encode('utf-8', 'replace')[:1000])
+            os._exit(1)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as pipe:
+        reason = pipe.read().decode('utf-8', 'replace')
+    _, status = os.waitpid(pid, 0)
+    shutil.rmtree(probe_dir, ignore_errors=True)
+    if os.waitstatus_to_exitcode(status) == 0:
+        return None
+    return reason or "isolation check failed"
+
+
+def _die_with_parent():
+    """On Linux, have the kernel SIGKILL this process if the worker that forked it exits."""
+    try:
+        pr_set_pdeathsig = 1
+        _libc().prctl(pr_set_pdeathsig, signal.SIGKILL)
+    except (OSError, AttributeError):
+        pass
+
+
+def _run_child(code, limits, timeout, workdir, stdout_w, stderr_w):
+    """In the forked child: isolate, apply limits, redirect output, run the code and exit."""
+    try:
+        os.setpgid(0, 0)
+        _die_with_parent()
+        # Wall-clock backstop in case the worker itself is killed mid-job
+        signal.alarm(int(timeout) + 2)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(stdout_w, 1)
+        os.dup2(stderr_w, 2)
+        # No descriptor of the worker's (its pipes, directories outside the sandbox) survives into the job
+        os.closerange(3, resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+        # Line-buffered so output printed before a timeout kill still reaches the parent
+        sys.stdout.reconfigure(line_buffering=True)
+        sys.stderr.reconfigure(line_buffering=True)
+
+        _isolate(limits.get("run_as"), workdir, limits.get("scratch_mb", 16))
+        cpu = max(1, int(min(timeout, limits["cpu_seconds"])))
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+        memory = limits["memory_mb"] * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        file_size = limits["max_file_mb"] * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_FSIZE, (file_size, file_size))
+        resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+    except BaseException as error:
+        # Never run the code half-isolated, and never fall back into the worker's loop
+        os.write(2, f"Sandbox error: {error}\n".encode('utf-8', 'replace'))
+        os._exit(1)
+
+    exit_code = 0
+    try:
+        exec(compile(code, '<string>', 'exec'), {'__name__': '__main__', '__builtins__': __builtins__})
+    except SystemExit as exit_request:
+        exit_code = exit_request.code if isinstance(exit_request.code, int) else 1
+    except BaseException as error:
+        # Skip this frame so the traceback reads like `python -c` output
+        traceback.print_exception(type(error), error, error.__traceback__.tb_next)
+        exit_code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+
+def _run_job(job, limits, workdir, emit=None):
+    """
+    Runs one job in a forked child. With `emit`, output is passed on as it arrives
+    (emit(stream_name, text)) instead of being collected into the result.
+    """
+    timeout = job.get("timeout", 10)
+    max_output = job.get("max_output", 64 * 1024)
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    job_dir = tempfile.mkdtemp(dir=workdir)
+
+    pid = os.fork()
+    if pid == 0:
+        _run_child(job["code"], limits, timeout, job_dir, stdout_w, stderr_w)
+    os.close(stdout_w)
+    os.close(stderr_w)
+
+    names = {stdout_r: "stdout", stderr_r: "stderr"}
+    decoders = {fd: codecs.getincrementaldecoder('utf-8')('replace') for fd in names}
+    collected = {fd: [] for fd in names}
+    selector = selectors.DefaultSelector()
+    selector.register(stdout_r, selectors.EVENT_READ)
+    selector.register(stderr_r, selectors.EVENT_READ)
+    deadline = time.monotonic() + timeout
+    output_bytes = 0
+    timed_out = truncated = False
+
+    while selector.get_map() and not truncated:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            timed_out = True
+            break
+        for key, _ in selector.select(remaining):
+            chunk = os.read(key.fd, 8192)
+            if not chunk:
+                selector.unregister(key.fd)
+                continue
+            if output_bytes + len(chunk) > max_output:
+                chunk = chunk[:max_output - output_bytes]
+                truncated = True
+            output_bytes += len(chunk)
+            text = decoders[key.fd].decode(chunk)
+            if not text:
+                continue
+            if emit is not None:
+                emit(names[key.fd], text)
+            else:
+                collected[key.fd].append(text)
+
+    if timed_out or truncated:
+        for kill in (lambda: os.killpg(pid, signal.SIGKILL), lambda: os.kill(pid, signal.SIGKILL)):
+            try:
+                kill()
+            except ProcessLookupError:
+                pass
+    _, status = os.waitpid(pid, 0)
+    selector.close()
+    os.close(stdout_r)
+    os.close(stderr_r)
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+    result = {
+        "exit_code": os.waitstatus_to_exitcode(status),
+        "timed_out": timed_out,
+        "truncated": truncated
+    }
+    if emit is None:
+        result["stdout"] = "".join(collected[stdout_r])
+        result["stderr"] = "".join(collected[stderr_r])
+    return result
+
+
+def _send(message):
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+def worker_main(limits, workdir):
+    reason = _probe_isolation(limits, workdir)
+    _send({"ready": reason is None, "error": reason})
+    if reason is not None:
+        return
+    for line in sys.stdin:
+        job = json.loads(line)
+        emit = (lambda stream, text: _send({"stream": stream, "data": text})) if job.get("stream") else None
+        try:
+            result = _run_job(job, limits, workdir, emit)
+        except Exception as error:
+            result = {"stdout": "", "stderr": f"Sandbox error: {error}", "exit_code": -1,
+                      "timed_out": False, "truncated": False}
+        result["done"] = True
+        _send(result)
+
+
+if __name__ == '__main__':
+    worker_main(json.loads(sys.argv[1]), sys.argv[2])
@@ -0,0 +1,247 @@
+"""
+Fair dispatch of upstream (Gemini) calls.
+
+FairScheduler caps how many calls are in flight at once across the process
+and decides who goes next when that ceiling is reached:
+
+- Priority classes are served strictly in order (PRIORITIES: interactive chat
+  before background work such as summaries).
+- Within a class, users share the slots by start-time fair queuing: each
+  request is tagged max(virtual time, the user's previous tag) + 1 / weight,
+  and the smallest tag goes first. A user with fifty queued requests gets
+  every other slot against a user with one, not the next fifty.
+- A user never holds more than `max_per_user` slots, so one burst can't fill
+  the ceiling while others wait.
+- Every request has a queue deadline. A ticket still waiting when it passes
+  is dropped, since its client has usually given up by then; callers that
+  can notice a disconnect while waiting (SSE keep-alives) release it early.
+
+Coalescer shares one in-flight call among identical concurrent requests.
+
+Queue wait and service time are observed separately (`wait_histogram`,
+`service_histogram`). Like the other per-process state this is per gunicorn
+worker, so the effective upstream ceiling is max_concurrent times workers.
+"""
+import threading
+import time
+from collections import deque
+
+PRIORITIES = ('interactive', 'background')
+
+
+class QueueTimeoutError(Exception):
+    """Raised when a request is still queued at its deadline."""
+
+
+class Ticket:
+
+    def __init__(self, user_id, priority, weight, deadline):
+        self.user_id = user_id
+        self.priority = priority
+        self.weight = weight
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.tag = 0.0
+        self.state = 'queued'  # -> running -> done, or expired / cancelled while queued
+        self._granted = threading.Event()
+
+
+class FairScheduler:
+
+    def __init__(self, max_concurrent, max_per_user, wait_histogram=None, service_histogram=None):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.wait_histogram = wait_histogram
+        self.service_histogram = service_histogram
+        self._queues = {priority: {} for priority in PRIORITIES}  # priority -> user_id -> deque of tickets
+        self._last_tag = {}  # user_id -> tag of the user's latest request
+        self._virtual_time = 0.0
+        self._running = 0
+        self._running_by_user = {}
+        self._lock = threading.Lock()
+        self.stats = {"dispatched": 0, "expired": 0, "cancelled": 0}
+
+    def queued(self):
+        with self._lock:
+            return {priority: sum(len(tickets) for tickets in users.values()) for priority, users in self._queues.items()}
+
+    def running(self):
+        return self._running
+
+    def submit(self, user_id, priority='interactive', weight=1.0, queue_timeout=30.0):
+        """Queues a request and returns its Ticket; wait() on it, then release() it when done."""
+        ticket = Ticket(user_id, priority, weight, time.monotonic() + queue_timeout)
+        with self._lock:
+            ticket.tag = max(self._virtual_time, self._last_tag.get(user_id, 0.0)) + 1.0 / weight
+            self._last_tag[user_id] = ticket.tag
+            self._queues[priority].setdefault(user_id, deque()).append(ticket)
+            self._dispatch()
+        return ticket
+
+    def wait(self, ticket, timeout=None):
+        """
+        True once the ticket holds a slot; False if `timeout` passes first.
+        Raises QueueTimeoutError (and drops the ticket) at its deadline.
+        """
+        remaining = ticket.deadline - time.monotonic()
+        if timeout is not None:
+            remaining = min(remaining, timeout)
+        ticket._granted.wait(max(0.0, remaining))
+        if ticket.state == 'running':
+            return True
+        if time.monotonic() >= ticket.deadline:
+            if self._withdraw(ticket, 'expired'):
+                return True  # Granted between the wait and the withdrawal
+            raise QueueTimeoutError("Timed out waiting for an upstream slot.")
+        return False
+
+    def release(self, ticket):
+        """Frees the ticket's slot, or cancels it if it is still queued. Safe to call more than once."""
+        with self._lock:
+            if ticket.state != 'running':
+                granted = False
+            else:
+                granted = True
+                ticket.state = 'done'
+                self._running -= 1
+                remaining = self._running_by_user[ticket.user_id] - 1
+                if remaining:
+                    self._running_by_user[ticket.user_id] = remaining
+                else:
+                    del self._running_by_user[ticket.user_id]
+                self._dispatch()
+        if granted:
+            if self.service_histogram is not None:
+                self.service_histogram.observe(time.monotonic() - ticket.started_at, priority=ticket.priority)
+        else:
+            self._withdraw(ticket, 'cancelled')
+
+    def slot(self, user_id, priority='interactive', weight=1.0, queue_timeout=30.0):
+        """Context manager form: blocks for a slot (or raises QueueTimeoutError) and releases it on exit."""
+        return _Slot(self, self.submit(user_id, priority, weight, queue_timeout))
+
+    def _withdraw(self, ticket, outcome):
+        # Returns True if the ticket turned out to be running already
+        with self._lock:
+            if ticket.state == 'running':
+                return True
+            if ticket.state == 'queued':
+                user_queue = self._queues[ticket.priority].get(ticket.user_id)
+                if user_queue is not None and ticket in user_queue:
+                    user_queue.remove(ticket)
+                    if not user_queue:
+                        del self._queues[ticket.priority][ticket.user_id]
+            else:
+                return False  # Already done, expired or cancelled
+            ticket.state = outcome
+            self.stats[outcome] += 1
+        self._observe_wait(ticket, outcome)
+        return False
+
+    def _observe_wait(self, ticket, outcome):
+        if self.wait_histogram is not None:
+            self.wait_histogram.observe(time.monotonic() - ticket.enqueued_at, priority=ticket.priority, outcome=outcome)
+
+    def _next_ticket(self, now):
+        for priority in PRIORITIES:
+            users = self._queues[priority]
+            best = None
+            for user_id, user_queue in list(users.items()):
+                # Skip past expired heads; their waiters record the expiry when they wake
+                while user_queue and user_queue[0].deadline <= now:
+                    user_queue.popleft()
+                if not user_queue:
+                    del users[user_id]
+                    continue
+                if self._running_by_user.get(user_id, 0) >= self.max_per_user:
+                    continue
+                if best is None or user_queue[0].tag < best.tag:
+                    best = user_queue[0]
+            if best is not None:
+                user_queue = users[best.user_id]
+                user_queue.popleft()
+                if not user_queue:
+                    del users[best.user_id]
+                return best
+        return None
+
+    def _dispatch(self):
+        # Called with the lock held
+        now = time.monotonic()
+        while self._running < self.max_concurrent:
+            ticket = self._next_ticket(now)
+            if ticket is None:
+                break
+            ticket.state = 'running'
+            ticket.started_at = now
+            self._virtual_time = max(self._virtual_time, ticket.tag - 1.0 / ticket.weight)
+            self._running += 1
+            self._running_by_user[ticket.user_id] = self._running_by_user.get(ticket.user_id, 0) + 1
+            self.stats["dispatched"] += 1
+            self._observe_wait(ticket, 'dispatched')
+            ticket._granted.set()
+        if len(self._last_tag) > 10000:
+            # A tag at or behind the virtual time has no effect on the next one; forget it
+            for user_id in [user for user, tag in self._last_tag.items() if tag <= self._virtual_time]:
+                del self._last_tag[user_id]
+
+
+class _Slot:
+
+    def __init__(self, scheduler, ticket):
+        self.scheduler = scheduler
+        self.ticket = ticket
+
+    def __enter__(self):
+        try:
+            self.scheduler.wait(self.ticket)
+        except BaseException:
+            self.scheduler.release(self.ticket)
+            raise
+        return self.ticket
+
+    def __exit__(self, exc_type, exc, tb):
+        self.scheduler.release(self.ticket)
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Coalescer:
+    """Runs one call per key at a time; identical requests arriving meanwhile get its result."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "followers": 0}
+
+    def run(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats["leaders"] += 1
+            else:
+                self.stats["followers"] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
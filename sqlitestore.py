@@ -0,0 +1,920 @@
+"""
+Embedded SQLite storage, a drop-in for the MongoDB collections.
+
+SQLiteDatabase(path)[name] returns a collection with the part of the pymongo
+Collection API that app.py, writebehind.py, purge.py and transfer.py use:
+find/find_one with sort, skip, limit and projections, inserts, updates with
+the usual operators (and upserts), find_one_and_update, deletes, bulk_write,
+counts and a small aggregate. Results and errors are pymongo's own classes,
+so callers can't tell which backend they are talking to.
+
+Each collection is a table (TABLES). The fields queries filter or sort on are
+real columns with the indexes indexes.py declares for MongoDB; everything else
+is kept as JSON in a `doc` column. ObjectIds are stored as 12-byte blobs and
+datetimes as integer microseconds since the epoch, so both compare and sort
+correctly in SQL, and they come back as ObjectId and naive UTC datetime, as
+pymongo returns them. messages.content is also indexed with FTS5 for $text.
+
+Connections run in WAL mode, so readers never wait for the writer, and are
+pooled: each thread (or greenlet) borrows one per operation, and sqlite3
+keeps every connection's prepared statements cached between calls. Updates,
+upserts and the other read-then-write operations run in BEGIN IMMEDIATE
+transactions, so gunicorn workers sharing the file can't interleave them.
+Tables with an expiry column (web sessions) are swept on write, in place of
+MongoDB's TTL indexes.
+
+Filters, updates and pipeline stages outside the supported subset raise
+OperationFailure, as MongoDB does for a query it can't run, rather than being
+silently misread.
+"""
+import copy
+import functools
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+EPOCH = datetime(1970, 1, 1)
+DUPLICATE_KEY = 11000
+EXPIRE_INTERVAL_SECONDS = 60
+
+# Column kinds: VALUE holds strings, numbers and ObjectIds; DATE holds datetimes;
+# ARRAY holds a JSON list of strings, matched by membership like a MongoDB array field
+VALUE, DATE, ARRAY = 'value', 'date', 'array'
+SQL_TYPES = {VALUE: '', DATE: ' INTEGER', ARRAY: ' TEXT'}  # VALUE has no affinity, so blobs stay blobs
+
+
+class Table:
+
+    def __init__(self, columns, indexes=(), text_column=None, ttl_column=None):
+        self.columns = dict(columns)
+        self.indexes = tuple(indexes)
+        self.text_column = text_column
+        self.ttl_column = ttl_column
+
+
+TABLES = {
+    'users': Table({'email': VALUE, 'google_id': VALUE}, [
+        'CREATE UNIQUE INDEX IF NOT EXISTS users_email_unique ON users (email)',
+        # NULLs never collide in a SQLite unique index, so traditional users need no partial filter
+        'CREATE UNIQUE INDEX IF NOT EXISTS users_google_id_unique ON users (google_id)',
+    ]),
+    'chat_sessions': Table({'user_id': VALUE, 'title': VALUE, 'created_at': DATE, 'last_updated': DATE}, [
+        'CREATE INDEX IF NOT EXISTS chat_sessions_user_last_updated ON chat_sessions (user_id, last_updated DESC, _id DESC)',
+    ]),
+    'messages': Table({'session_id': VALUE, 'user_id': VALUE, 'role': VALUE, 'timestamp': DATE, 'content': VALUE}, [
+        'CREATE INDEX IF NOT EXISTS messages_session_user_timestamp_id ON messages (session_id, user_id, timestamp, _id)',
+    ], text_column='content'),
+    'attachments': Table({'owners': ARRAY}),
+    'session_purges': Table({'user_id': VALUE, 'claimed_until': DATE, 'requested_at': DATE}, [
+        'CREATE INDEX IF NOT EXISTS session_purges_claimable ON session_purges (claimed_until, requested_at)',
+        'CREATE INDEX IF NOT EXISTS session_purges_user ON session_purges (user_id)',
+    ]),
+    'web_sessions': Table({'expires_at': DATE}, [
+        'CREATE INDEX IF NOT EXISTS web_sessions_expires_at ON web_sessions (expires_at)',
+    ], ttl_column='expires_at'),
+}
+
+COMPARISONS = {'$lt': '<', '$lte': '<=', '$gt': '>', '$gte': '>='}
+
+
+# --- Value encoding ---
+
+def _encode(value):
+    """Python value -> what is stored in (and compared against) a column."""
+    if isinstance(value, ObjectId):
+        return value.binary
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return (value - EPOCH) // timedelta(microseconds=1)
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def _decode(kind, value):
+    if kind == DATE:
+        return EPOCH + timedelta(microseconds=value) if isinstance(value, int) else value
+    if kind == ARRAY:
+        return _loads(value)
+    return ObjectId(value) if isinstance(value, bytes) and len(value) == 12 else value
+
+
+def _json_default(value):
+    if isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    if isinstance(value, datetime):
+        return {'$date': _encode(value)}
+    raise TypeError(f"Can't store {type(value).__name__} in a SQLite document")
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1:
+        if '$oid' in obj:
+            return ObjectId(obj['$oid'])
+        if '$date' in obj:
+            return EPOCH + timedelta(microseconds=obj['$date'])
+    return obj
+
+
+def _dumps(value):
+    return json.dumps(value, default=_json_default, ensure_ascii=False, separators=(',', ':'))
+
+
+def _loads(text):
+    return json.loads(text, object_hook=_json_object_hook)
+
+
+def _sort_key(value):
+    # None sorts first, as in MongoDB
+    return (0, 0) if value is None else (1, _encode(value))
+
+
+def _regexp(pattern, value):
+    return value is not None and isinstance(value, str) and re.search(pattern, value) is not None
+
+
+def fts_query(search):
+    """
+    A $search string as an FTS5 query: any of the terms, or all of the "phrases"
+    when there are any, and none of the -negated terms. None if nothing is searchable.
+    """
+    def quote(text):
+        return '"' + text.replace('"', '""') + '"'
+
+    phrases = [phrase for phrase in re.findall(r'"([^"]*)"', search) if re.search(r'\w', phrase)]
+    rest = re.sub(r'"[^"]*"', ' ', search)
+    negated = re.findall(r'(?<![-\w])-(\w+)', rest)
+    terms = re.findall(r'(?<![-\w])\w+', rest)
+    positive = ' AND '.join(quote(phrase) for phrase in phrases) if phrases else ' OR '.join(quote(term) for term in terms)
+    if not positive:
+        return None
+    return f'({positive})' + ''.join(f' NOT {quote(word)}' for word in negated)
+
+
+# --- Updates ---
+
+def _set_path(doc, path, value):
+    *parents, last = path.split('.')
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def _unset_path(doc, path):
+    *parents, last = path.split('.')
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+
+def _apply_update(doc, update, inserting):
+    for operator, fields in update.items():
+        if operator == '$setOnInsert' and not inserting:
+            continue
+        for path, value in fields.items():
+            if operator in ('$set', '$setOnInsert'):
+                _set_path(doc, path, value)
+            elif operator == '$unset':
+                _unset_path(doc, path)
+            elif operator == '$inc':
+                doc[path] = doc.get(path, 0) + value
+            elif operator in ('$max', '$min'):
+                current = doc.get(path)
+                if current is None or (_encode(value) > _encode(current) if operator == '$max' else _encode(value) < _encode(current)):
+                    doc[path] = value
+            elif operator in ('$addToSet', '$push'):
+                values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                items = doc.setdefault(path, [])
+                for item in values:
+                    if operator == '$push' or item not in items:
+                        items.append(item)
+            else:
+                raise OperationFailure(f"Update operator {operator} is not supported by the SQLite backend")
+    return doc
+
+
+def _upsert_seed(query_filter):
+    """The fields an upsert takes from its filter: the plain equality conditions."""
+    return {key: copy.deepcopy(value) for key, value in query_filter.items()
+            if not key.startswith('$') and not (isinstance(value, dict) and any(k.startswith('$') for k in value))}
+
+
+def _check_update(update):
+    if not isinstance(update, dict) or not update or not all(key.startswith('$') for key in update):
+        raise OperationFailure("The SQLite backend only supports operator updates ($set, $inc, ...)")
+
+
+# --- Aggregation (the stages that can't run in SQL) ---
+
+def _expression_value(doc, expression):
+    if isinstance(expression, str) and expression.startswith('$'):
+        value = doc
+        for part in expression[1:].split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        return value
+    if isinstance(expression, dict):
+        raise OperationFailure("Computed expressions are not supported by the SQLite backend")
+    return expression
+
+
+ACCUMULATORS = ('$first', '$last', '$sum', '$max', '$min', '$push')
+
+
+def _group(docs, spec):
+    # Checked up front, so an unsupported accumulator fails even when there is nothing to group
+    for name, accumulator in spec.items():
+        if name != '_id' and next(iter(accumulator)) not in ACCUMULATORS:
+            raise OperationFailure(f"Accumulator {next(iter(accumulator))} is not supported by the SQLite backend")
+    groups = {}
+    for doc in docs:
+        key = _expression_value(doc, spec['_id'])
+        out = groups.get(key)
+        first = out is None
+        if first:
+            out = groups[key] = {'_id': key}
+        for name, accumulator in spec.items():
+            if name == '_id':
+                continue
+            (operator, expression), = accumulator.items()
+            value = _expression_value(doc, expression)
+            if operator == '$first':
+                if first:
+                    out[name] = value
+            elif operator == '$last':
+                out[name] = value
+            elif operator == '$sum':
+                out[name] = out.get(name, 0) + (value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0)
+            elif operator in ('$max', '$min'):
+                current = out.get(name)
+                if value is not None and (current is None or (
+                        _encode(value) > _encode(current) if operator == '$max' else _encode(value) < _encode(current))):
+                    out[name] = value
+                else:
+                    out.setdefault(name, current)
+            elif operator == '$push':
+                out.setdefault(name, []).append(value)
+    return list(groups.values())
+
+
+def _sort_documents(docs, sort):
+    for field, direction in reversed(sort):
+        docs.sort(key=lambda doc: _sort_key(doc.get(field)), reverse=direction == -1)
+    return docs
+
+
+def _normalise_sort(key_or_list, direction=None):
+    if key_or_list is None:
+        return []
+    if isinstance(key_or_list, str):
+        return [(key_or_list, 1 if direction is None else direction)]
+    return list(key_or_list.items() if isinstance(key_or_list, dict) else key_or_list)
+
+
+def _translate_errors(method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except sqlite3.IntegrityError as error:
+            if 'UNIQUE' in str(error):
+                raise DuplicateKeyError(str(error), DUPLICATE_KEY) from error
+            raise OperationFailure(str(error)) from error
+        except sqlite3.Error as error:
+            raise OperationFailure(str(error)) from error
+    return wrapper
+
+
+class SQLiteDatabase:
+
+    def __init__(self, path, pool_size=16, busy_timeout_seconds=5.0):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.pool_size = pool_size
+        self.busy_timeout_seconds = busy_timeout_seconds
+        self.stats = {"connections_opened": 0, "transactions": 0}
+        self._pool = queue.LifoQueue()
+        self._pid = os.getpid()
+        self._schema_ready = False
+        self._lock = threading.Lock()
+        self._collections = {}
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            if name not in TABLES:
+                raise KeyError(f"No SQLite table is defined for the '{name}' collection")
+            collection = self._collections.setdefault(name, SQLiteCollection(self, name, TABLES[name]))
+        return collection
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout_seconds, isolation_level=None,
+                                     check_same_thread=False, cached_statements=256)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')  # Durable across crashes of the app; WAL makes it safe
+        connection.execute('PRAGMA temp_store=MEMORY')
+        connection.create_function('regexp', 2, _regexp, deterministic=True)
+        self.stats["connections_opened"] += 1
+        if not self._schema_ready:
+            with self._lock:
+                if not self._schema_ready:
+                    self._create_schema(connection)
+                    self._schema_ready = True
+        return connection
+
+    @contextmanager
+    def connection(self):
+        """Borrows a pooled connection (opening one if none is free) for the duration of the block."""
+        if self._pid != os.getpid():
+            # A forked child must not share its parent's connections; it starts with an empty pool
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = queue.LifoQueue()
+                    self._pid = os.getpid()
+        pool = self._pool
+        try:
+            connection = pool.get_nowait()
+        except queue.Empty:
+            connection = self._connect()
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+            if pool.qsize() < self.pool_size:
+                pool.put(connection)
+            else:
+                connection.close()
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+            self.stats["transactions"] += 1
+
+    def _create_schema(self, connection):
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for name, table in TABLES.items():
+                columns = ''.join(f', {column}{SQL_TYPES[kind]}' for column, kind in table.columns.items())
+                # seq is the rowid, declared so that VACUUM can't renumber it under the FTS index
+                connection.execute(f'CREATE TABLE IF NOT EXISTS {name} '
+                                   f'(seq INTEGER PRIMARY KEY, _id NOT NULL UNIQUE{columns}, doc TEXT NOT NULL)')
+                for statement in table.indexes:
+                    connection.execute(statement)
+                if table.text_column:
+                    column = table.text_column
+                    connection.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {name}_fts USING fts5"
+                                       f"({column}, content='{name}', content_rowid='seq')")
+                    connection.execute(f'CREATE TRIGGER IF NOT EXISTS {name}_fts_insert AFTER INSERT ON {name} BEGIN '
+                                       f'INSERT INTO {name}_fts (rowid, {column}) VALUES (new.seq, new.{column}); END')
+                    connection.execute(f'CREATE TRIGGER IF NOT EXISTS {name}_fts_delete AFTER DELETE ON {name} BEGIN '
+                                       f"INSERT INTO {name}_fts ({name}_fts, rowid, {column}) VALUES ('delete', old.seq, old.{column}); END")
+                    connection.execute(f'CREATE TRIGGER IF NOT EXISTS {name}_fts_update AFTER UPDATE OF {column} ON {name} BEGIN '
+                                       f"INSERT INTO {name}_fts ({name}_fts, rowid, {column}) VALUES ('delete', old.seq, old.{column}); "
+                                       f'INSERT INTO {name}_fts (rowid, {column}) VALUES (new.seq, new.{column}); END')
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def ensure_schema(self):
+        """Creates any missing tables and indexes. Returns {table: [index names]}."""
+        with self.connection() as connection:
+            rows = connection.execute(
+                "SELECT tbl_name, name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_autoindex%'"
+            ).fetchall()
+        created = {name: [] for name in TABLES}
+        for table_name, index_name in rows:
+            if table_name in created:
+                created[table_name].append(index_name)
+        return created
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class Cursor:
+    """Lazy like a pymongo cursor: the query runs when iteration starts."""
+
+    def __init__(self, collection, query_filter, projection):
+        self.collection = collection
+        self.query_filter = query_filter or {}
+        self.projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._batch_size = 500
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _normalise_sort(key_or_list, direction)
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def batch_size(self, count):
+        self._batch_size = max(1, count)
+        return self
+
+    def __iter__(self):
+        return self.collection._iterate(self)
+
+    def explain(self):
+        """The steps of SQLite's query plan for this cursor."""
+        sql, params, _ = self.collection._select_sql(self.query_filter, self.projection, self._sort, self._skip, self._limit)
+        with self.collection.database.connection() as connection:
+            return [row[3] for row in connection.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+class SQLiteCollection:
+
+    def __init__(self, database, name, table):
+        self.database = database
+        self.name = name
+        self.table = table
+        self._last_expired = 0.0
+
+    # --- SQL building ---
+
+    def _kind(self, field):
+        if field == '_id':
+            return VALUE
+        kind = self.table.columns.get(field)
+        if kind is None:
+            raise OperationFailure(f"'{field}' is not a queryable column of the SQLite {self.name} table")
+        return kind
+
+    def _where(self, query_filter, params):
+        clauses = []
+        for key, condition in query_filter.items():
+            if key in ('$or', '$and'):
+                parts = [f'({self._where(sub_filter, params)})' for sub_filter in condition]
+                clauses.append('(' + (' OR ' if key == '$or' else ' AND ').join(parts) + ')' if parts else '0')
+            elif key == '$text':
+                continue  # Joined against the FTS table by _select_sql
+            elif key.startswith('$'):
+                raise OperationFailure(f"Query operator {key} is not supported by the SQLite backend")
+            else:
+                clauses.append(self._field_condition(key, condition, params))
+        return ' AND '.join(clauses) or '1'
+
+    def _field_condition(self, field, condition, params):
+        kind = self._kind(field)
+        column = f't.{field}'
+        if isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+            operators = condition
+        else:
+            operators = {'$eq': condition}
+        parts = []
+        for operator, operand in operators.items():
+            if operator == '$options':
+                continue
+            if kind == ARRAY:
+                parts.append(self._array_condition(column, operator, operand, params))
+            elif operator == '$eq':
+                if operand is None:
+                    parts.append(f'{column} IS NULL')
+                else:
+                    parts.append(f'{column} = ?')
+                    params.append(_encode(operand))
+            elif operator == '$ne':
+                if operand is None:
+                    parts.append(f'{column} IS NOT NULL')
+                else:
+                    parts.append(f'({column} IS NULL OR {column} != ?)')
+                    params.append(_encode(operand))
+            elif operator in COMPARISONS:
+                parts.append(f'{column} {COMPARISONS[operator]} ?')
+                params.append(_encode(operand))
+            elif operator in ('$in', '$nin'):
+                values = [_encode(value) for value in operand if value is not None]
+                with_null = any(value is None for value in operand)
+                listed = f'{column} IN ({",".join("?" * len(values))})' if values else '0'
+                params.extend(values)
+                if operator == '$in':
+                    parts.append(f'({listed} OR {column} IS NULL)' if with_null else listed)
+                else:
+                    parts.append(f'({column} IS NOT NULL AND NOT {listed})' if with_null else f'({column} IS NULL OR NOT {listed})')
+            elif operator == '$exists':
+                parts.append(f'{column} IS NOT NULL' if operand else f'{column} IS NULL')
+            elif operator == '$regex':
+                flags = operators.get('$options', '')
+                parts.append(f'{column} REGEXP ?')
+                params.append((f'(?{flags})' if flags else '') + (operand.pattern if hasattr(operand, 'pattern') else operand))
+            else:
+                raise OperationFailure(f"Query operator {operator} is not supported by the SQLite backend")
+        return ' AND '.join(parts) or '1'
+
+    def _array_condition(self, column, operator, operand, params):
+        if operator == '$eq':
+            params.append(operand)
+            return f'EXISTS (SELECT 1 FROM json_each({column}) WHERE value = ?)'
+        if operator == '$in':
+            params.extend(operand)
+            return f'EXISTS (SELECT 1 FROM json_each({column}) WHERE value IN ({",".join("?" * len(operand))}))'
+        raise OperationFailure(f"Operator {operator} on an array field is not supported by the SQLite backend")
+
+    def _projected_fields(self, projection):
+        """(fields to return or None for all, include _id, include the text score)."""
+        if projection is None:
+            return None, True, False
+        if isinstance(projection, (list, tuple)):
+            projection = {field: 1 for field in projection}
+        fields, with_score = [], False
+        for field, value in projection.items():
+            if isinstance(value, dict) and value.get('$meta') == 'textScore':
+                with_score = True
+            elif field != '_id':
+                if not value:
+                    raise OperationFailure("Exclusion projections are not supported by the SQLite backend")
+                fields.append(field)
+        return fields, projection.get('_id', 1) not in (0, False), with_score
+
+    def _select_sql(self, query_filter, projection, sort, skip, limit):
+        fields, _, with_score = self._projected_fields(projection)
+        columns = ['_id', *self.table.columns]
+        if fields is not None and all(field in self.table.columns for field in fields):
+            columns = ['_id', *fields]  # Everything asked for is in columns: no JSON to decode
+        else:
+            columns.append('doc')
+        select = [f't.{column}' for column in columns]
+        params = []
+        source = f'{self.name} AS t'
+        where = []
+        text = query_filter.get('$text')
+        if text is not None:
+            if not self.table.text_column:
+                raise OperationFailure(f"The SQLite {self.name} table has no text index")
+            fts = f'{self.name}_fts'
+            source += f' JOIN {fts} ON {fts}.rowid = t.seq'
+            match = fts_query(text.get('$search', ''))
+            where.append(f'{fts} MATCH ?' if match else '0')
+            if match:
+                params.append(match)
+            # bm25 rank is lower for better matches; textScore is higher
+            select.append(f'-{fts}.rank')
+            columns.append('score')
+        where.append(self._where(query_filter, params))
+        sql = f'SELECT {", ".join(select)} FROM {source} WHERE {" AND ".join(where)}'
+        order = []
+        for field, direction in sort or ():
+            if isinstance(direction, dict):
+                if direction.get('$meta') != 'textScore' or text is None:
+                    raise OperationFailure("Only textScore $meta sorts (with $text) are supported by the SQLite backend")
+                order.append(f'{self.name}_fts.rank')
+            else:
+                self._kind(field)
+                order.append(f't.{field} {"DESC" if direction == -1 else "ASC"}')
+        if order:
+            sql += ' ORDER BY ' + ', '.join(order)
+        if limit or skip:
+            sql += ' LIMIT ? OFFSET ?'
+            params.extend((limit or -1, skip))
+        return sql, params, columns
+
+    # --- Rows and documents ---
+
+    def _document(self, columns, row, projection=None):
+        doc = {}
+        for column, value in zip(columns, row):
+            if column == 'doc':
+                doc.update(_loads(value))
+            elif column == 'score':
+                doc['score'] = value
+            elif value is not None:
+                doc[column] = _decode(self._kind(column), value)
+        return doc if projection is None else self._project(doc, projection)
+
+    def _project(self, doc, projection):
+        fields, with_id, with_score = self._projected_fields(projection)
+        projected = {'_id': doc['_id']} if with_id and '_id' in doc else {}
+        projected.update((field, doc[field]) for field in fields if field in doc)
+        if with_score and 'score' in doc:
+            projected['score'] = doc['score']
+        return projected
+
+    def _row(self, doc):
+        values = [_encode(doc['_id'])]
+        for column, kind in self.table.columns.items():
+            value = doc.get(column)
+            values.append(_dumps(value) if kind == ARRAY and value is not None else _encode(value))
+        values.append(_dumps({key: value for key, value in doc.items() if key != '_id' and key not in self.table.columns}))
+        return values
+
+    def _insert_sql(self):
+        columns = ['_id', *self.table.columns, 'doc']
+        return f'INSERT INTO {self.name} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+
+    def _update_sql(self):
+        assignments = ', '.join(f'{column} = ?' for column in ['_id', *self.table.columns, 'doc'])
+        return f'UPDATE {self.name} SET {assignments} WHERE seq = ?'
+
+    def _matches(self, connection, query_filter, sort=None, limit=0):
+        """[(seq, document)] for update and delete, read inside the caller's transaction."""
+        sql, params, columns = self._select_sql(query_filter or {}, None, sort, 0, limit)
+        sql = sql.replace('SELECT ', 'SELECT t.seq, ', 1)
+        return [(row[0], self._document(columns, row[1:])) for row in connection.execute(sql, params)]
+
+    def _expire(self, connection):
+        if self.table.ttl_column is None or time.monotonic() - self._last_expired < EXPIRE_INTERVAL_SECONDS:
+            return
+        self._last_expired = time.monotonic()
+        connection.execute(f'DELETE FROM {self.name} WHERE {self.table.ttl_column} < ?', (_encode(datetime.now(timezone.utc)),))
+
+    def _iterate(self, cursor):
+        sql, params, columns = self._select_sql(cursor.query_filter, cursor.projection, cursor._sort, cursor._skip, cursor._limit)
+        try:
+            with self.database.connection() as connection:
+                rows = connection.execute(sql, params)
+                try:
+                    while True:
+                        batch = rows.fetchmany(cursor._batch_size)
+                        if not batch:
+                            return
+                        for row in batch:
+                            yield self._document(columns, row, cursor.projection)
+                finally:
+                    rows.close()
+        except sqlite3.Error as error:
+            raise OperationFailure(str(error)) from error
+
+    # --- Write steps, run inside a transaction ---
+
+    def _update_in(self, connection, query_filter, update, upsert=False, multi=False, sort=None):
+        """Returns (matched, modified, upserted_id, document before, document after)."""
+        _check_update(update)
+        matched = modified = 0
+        before = after = upserted_id = None
+        for seq, doc in self._matches(connection, query_filter, sort, 0 if multi else 1):
+            before = doc
+            after = _apply_update(copy.deepcopy(doc), update, inserting=False)
+            matched += 1
+            row = self._row(after)
+            if row != self._row(doc):
+                connection.execute(self._update_sql(), row + [seq])
+                modified += 1
+        if not matched and upsert:
+            after = _apply_update(_upsert_seed(query_filter), update, inserting=True)
+            after.setdefault('_id', ObjectId())
+            connection.execute(self._insert_sql(), self._row(after))
+            upserted_id = after['_id']
+        return matched, modified, upserted_id, before, after
+
+    def _replace_in(self, connection, query_filter, replacement, upsert=False):
+        matches = self._matches(connection, query_filter, limit=1)
+        document = dict(replacement)
+        if matches:
+            seq, doc = matches[0]
+            document['_id'] = doc['_id']
+            row = self._row(document)
+            modified = row != self._row(doc)
+            if modified:
+                connection.execute(self._update_sql(), row + [seq])
+            return 1, int(modified), None
+        if not upsert:
+            return 0, 0, None
+        document = {**_upsert_seed(query_filter), **document}
+        document.setdefault('_id', ObjectId())
+        connection.execute(self._insert_sql(), self._row(document))
+        return 0, 0, document['_id']
+
+    def _delete_in(self, connection, query_filter, multi=True):
+        params = []
+        sql = f'SELECT t.seq FROM {self.name} AS t WHERE {self._where(query_filter or {}, params)}'
+        if not multi:
+            sql += ' LIMIT 1'
+        return connection.execute(f'DELETE FROM {self.name} WHERE seq IN ({sql})', params).rowcount
+
+    # --- pymongo Collection API ---
+
+    def find(self, filter=None, projection=None, sort=None, skip=0, limit=0, **kwargs):
+        cursor = Cursor(self, filter, projection)
+        if sort is not None:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        return next(iter(self.find(filter, projection, sort=sort, limit=1)), None)
+
+    @_translate_errors
+    def insert_one(self, document, **kwargs):
+        document.setdefault('_id', ObjectId())  # Like pymongo, on the caller's document
+        with self.database.transaction() as connection:
+            connection.execute(self._insert_sql(), self._row(document))
+            self._expire(connection)
+        return InsertOneResult(document['_id'], True)
+
+    @_translate_errors
+    def insert_many(self, documents, ordered=True, **kwargs):
+        documents = list(documents)
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+        errors = []
+        inserted = []
+        with self.database.transaction() as connection:
+            connection.execute('SAVEPOINT insert_many')
+            try:
+                connection.executemany(self._insert_sql(), [self._row(document) for document in documents])
+                inserted = documents
+            except sqlite3.IntegrityError:
+                # Something collided: redo one by one to find out which, as MongoDB reports it
+                connection.execute('ROLLBACK TO insert_many')
+                for index, document in enumerate(documents):
+                    try:
+                        connection.execute(self._insert_sql(), self._row(document))
+                    except sqlite3.IntegrityError as error:
+                        errors.append({'index': index, 'code': DUPLICATE_KEY if 'UNIQUE' in str(error) else 121,
+                                       'errmsg': str(error), 'op': document})
+                        if ordered:
+                            break
+                    else:
+                        inserted.append(document)
+            connection.execute('RELEASE insert_many')
+            self._expire(connection)
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'writeConcernErrors': [], 'nInserted': len(inserted),
+                                  'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []})
+        return InsertManyResult([document['_id'] for document in inserted], True)
+
+    def _update_result(self, matched, modified, upserted_id):
+        raw = {'n': matched + (1 if upserted_id is not None else 0), 'nModified': modified}
+        if upserted_id is not None:
+            raw['upserted'] = upserted_id
+        return UpdateResult(raw, True)
+
+    @_translate_errors
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        with self.database.transaction() as connection:
+            matched, modified, upserted_id, _, _ = self._update_in(connection, filter, update, upsert)
+            self._expire(connection)
+        return self._update_result(matched, modified, upserted_id)
+
+    @_translate_errors
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        with self.database.transaction() as connection:
+            matched, modified, upserted_id, _, _ = self._update_in(connection, filter, update, upsert, multi=True)
+        return self._update_result(matched, modified, upserted_id)
+
+    @_translate_errors
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        with self.database.transaction() as connection:
+            result = self._replace_in(connection, filter, replacement, upsert)
+            self._expire(connection)
+        return self._update_result(*result)
+
+    @_translate_errors
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        with self.database.transaction() as connection:
+            _, _, _, before, after = self._update_in(connection, filter, update, upsert, sort=_normalise_sort(sort))
+        document = after if return_document == ReturnDocument.AFTER else before
+        if document is None or projection is None:
+            return document
+        return self._project(document, projection)
+
+    @_translate_errors
+    def delete_one(self, filter, **kwargs):
+        with self.database.transaction() as connection:
+            return DeleteResult({'n': self._delete_in(connection, filter, multi=False)}, True)
+
+    @_translate_errors
+    def delete_many(self, filter, **kwargs):
+        with self.database.transaction() as connection:
+            return DeleteResult({'n': self._delete_in(connection, filter)}, True)
+
+    @_translate_errors
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        """InsertOne, UpdateOne/Many, ReplaceOne and DeleteOne/Many, applied in one transaction."""
+        result = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': [],
+                  'writeErrors': [], 'writeConcernErrors': []}
+        with self.database.transaction() as connection:
+            for index, operation in enumerate(requests):
+                kind = type(operation).__name__
+                connection.execute('SAVEPOINT operation')
+                try:
+                    if kind == 'InsertOne':
+                        operation._doc.setdefault('_id', ObjectId())
+                        connection.execute(self._insert_sql(), self._row(operation._doc))
+                        result['nInserted'] += 1
+                        upserted_id = None
+                    elif kind in ('UpdateOne', 'UpdateMany'):
+                        matched, modified, upserted_id, _, _ = self._update_in(
+                            connection, operation._filter, operation._doc, operation._upsert, multi=kind == 'UpdateMany')
+                        result['nMatched'] += matched
+                        result['nModified'] += modified
+                    elif kind == 'ReplaceOne':
+                        matched, modified, upserted_id = self._replace_in(
+                            connection, operation._filter, operation._doc, operation._upsert)
+                        result['nMatched'] += matched
+                        result['nModified'] += modified
+                    elif kind in ('DeleteOne', 'DeleteMany'):
+                        result['nRemoved'] += self._delete_in(connection, operation._filter, multi=kind == 'DeleteMany')
+                        upserted_id = None
+                    else:
+                        raise OperationFailure(f"{kind} is not supported by the SQLite backend")
+                except sqlite3.IntegrityError as error:
+                    connection.execute('ROLLBACK TO operation')
+                    result['writeErrors'].append({'index': index, 'code': DUPLICATE_KEY if 'UNIQUE' in str(error) else 121,
+                                                  'errmsg': str(error)})
+                    if ordered:
+                        break
+                    continue
+                finally:
+                    connection.execute('RELEASE operation')
+                if upserted_id is not None:
+                    result['nUpserted'] += 1
+                    result['upserted'].append({'index': index, '_id': upserted_id})
+            self._expire(connection)
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    @_translate_errors
+    def count_documents(self, filter, skip=0, limit=0, **kwargs):
+        sql, params, _ = self._select_sql(filter, {'_id': 1}, None, skip, limit)
+        with self.database.connection() as connection:
+            return connection.execute(f'SELECT COUNT(*) FROM ({sql})', params).fetchone()[0]
+
+    @_translate_errors
+    def estimated_document_count(self, **kwargs):
+        with self.database.connection() as connection:
+            return connection.execute(f'SELECT COUNT(*) FROM {self.name}').fetchone()[0]
+
+    def aggregate(self, pipeline, **kwargs):
+        """
+        Leading $match, $sort, $skip and $limit stages run in SQL; $group, and $sort, $skip
+        and $limit after it, run here over the results.
+        """
+        stages = list(pipeline)
+        cursor = self.find({})
+        position = 0
+        for name in ('$match', '$sort', '$skip', '$limit'):
+            if position < len(stages) and name in stages[position]:
+                value = stages[position][name]
+                if name == '$match':
+                    cursor.query_filter = value
+                elif name == '$sort':
+                    cursor.sort(value)
+                else:
+                    getattr(cursor, name[1:])(value)
+                position += 1
+        documents = None
+        for stage in stages[position:]:
+            (name, value), = stage.items()
+            documents = list(cursor) if documents is None else documents
+            if name == '$group':
+                documents = _group(documents, value)
+            elif name == '$sort':
+                documents = _sort_documents(documents, _normalise_sort(value))
+            elif name == '$skip':
+                documents = documents[value:]
+            elif name == '$limit':
+                documents = documents[:value]
+            else:
+                raise OperationFailure(f"Pipeline stage {name} is not supported by the SQLite backend")
+        return iter(list(cursor) if documents is None else documents)
+
+
+def find_full_scans(db, queries):
+    """Names of the route queries (in indexes.route_queries() form) whose SQLite plan scans a whole table."""
+    scans = []
+    for name, command in queries:
+        cursor = db[command['find']].find(command.get('filter', {}), command.get('projection'))
+        if command.get('sort'):
+            cursor.sort(command['sort'])
+        if command.get('limit'):
+            cursor.limit(command['limit'])
+        if any(step.startswith('SCAN ') and 'VIRTUAL TABLE' not in step for step in cursor.explain()):
+            scans.append(name)
+    return scans
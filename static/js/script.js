@@ -6,6 +6,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- STATE VARIABLES ---
     let currentSessionId = null;
     let chatHistory = [];
+    let historyHasMore = false; // Older messages exist on the server beyond what is loaded
     let attachedFile = null;
     let activeTool = null;
     let autoSpeak = false;
@@ -199,13 +200,65 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Reads a Server-Sent Events response from a POST request, calling onChunk(text) for each token chunk.
+    // Resolves with { text } once the stream finishes, or { error, text } (the text received so far) if the backend reported one.
+    async function streamApi(endpoint, body, onChunk) {
+        try {
+            const response = await fetch(`${BACKEND_API_BASE_URL}${endpoint}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+                body: JSON.stringify(body)
+            });
+            if (!response.ok || !response.body) {
+                const errorData = await response.json().catch(() => ({ error: `HTTP error! Status: ${response.status}` }));
+                throw new Error(errorData.error?.message || errorData.error || 'An unknown error occurred.');
+            }
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let fullText = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const frame = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    let event = 'message';
+                    let data = '';
+                    frame.split('\n').forEach(line => {
+                        if (line.startsWith('event:')) event = line.slice(6).trim();
+                        else if (line.startsWith('data:')) data += line.slice(5).trim();
+                    });
+                    if (!data) continue;
+                    const parsed = JSON.parse(data);
+                    if (event === 'error') return { error: parsed.message, text: fullText };
+                    if (event === 'done') return { text: parsed.text };
+                    fullText += parsed.text;
+                    if (onChunk) onChunk(parsed.text, fullText);
+                }
+            }
+            return { text: fullText };
+        } catch (error) {
+            console.error(`Streaming API Error on ${endpoint}:`, error);
+            return null;
+        }
+    }
+
     const api = {
-        getAllSessions: () => fetchApi('/api/all_sessions'),
-        getSessionHistory: (sessionId) => fetchApi(`/api/history/${sessionId}`),
+        getAllSessions: (cursor) => fetchApi(cursor ? `/api/all_sessions?cursor=${encodeURIComponent(cursor)}` : '/api/all_sessions'),
+        getSessionHistory: (sessionId, beforeId) => fetchApi(beforeId ? `/api/history/${sessionId}?before=${beforeId}` : `/api/history/${sessionId}`),
         startNewChat: () => fetchApi('/api/new_chat_session', { method: 'POST' }),
         sendMessage: (payload) => fetchApi('/api/chat', { method: 'POST', body: payload }),
+        streamMessage: (payload, onChunk) => streamApi('/api/chat', { ...payload, stream: true }, onChunk),
         renameSession: (sessionId, newTitle) => fetchApi(`/api/session/${sessionId}`, { method: 'PUT', body: { title: newTitle } }),
         deleteSession: (sessionId) => fetchApi(`/api/session/${sessionId}`, { method: 'DELETE' }),
+        uploadAttachment: (formData) => fetch(`${BACKEND_API_BASE_URL}/api/attachments`, {
+            method: 'POST',
+            body: formData // FormData sets its own headers
+        }).then(response => response.ok ? response.json() : null).catch(() => null),
         uploadProfilePicture: (formData) => fetch(`${BACKEND_API_BASE_URL}/api/upload_profile_picture`, {
             method: 'POST',
             body: formData // FormData sets its own headers
@@ -237,11 +290,16 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    function renderChatHistory(sessionsData, activeSessionId) {
+    function renderChatHistory(sessionsData, activeSessionId, append = false) {
         if (!chatHistoryList) return;
-        chatHistoryList.innerHTML = '';
+        if (append) {
+            const loadMoreBtn = chatHistoryList.querySelector('button[data-load-more-cursor]');
+            if (loadMoreBtn) loadMoreBtn.remove();
+        } else {
+            chatHistoryList.innerHTML = '';
+        }
         const actualSessions = sessionsData ? sessionsData.sessions : null;
-        if (!Array.isArray(actualSessions) || actualSessions.length === 0) {
+        if (!append && (!Array.isArray(actualSessions) || actualSessions.length === 0)) {
             chatHistoryList.innerHTML = '<p class="text-center text-gray-500 text-sm p-4">No chat history.</p>';
             return;
         }
@@ -255,8 +313,13 @@ document.addEventListener('DOMContentLoaded', () => {
                     <button title="Delete" data-delete-id="${session.session_id}" class="p-1 text-gray-400 hover:text-white"><svg xmlns="http://www.w3.org/2000/svg" class="h-4 w-4" fill="none" viewBox="0 0 24 24" stroke="currentColor"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M19 7l-.867 12.142A2 2 0 0116.138 21H7.862a2 2 0 01-1.995-1.858L5 7m5 4v6m4-6v6m1-10V4a1 1 0 00-1-1h-4a1 1 0 00-1 1v3M4 7h16" /></svg></button>
                 </div>
             </div>`;
-            chatHistoryList.innerHTML += html;
+            chatHistoryList.insertAdjacentHTML('beforeend', html);
         });
+        // The sidebar is paginated; older sessions are fetched on demand
+        if (sessionsData && sessionsData.next_cursor) {
+            chatHistoryList.insertAdjacentHTML('beforeend',
+                `<button data-load-more-cursor="${sessionsData.next_cursor}" class="w-full px-3 py-2 text-sm text-gray-400 hover:text-white">Load older chats</button>`);
+        }
     }
 
     function renderMessages() {
@@ -307,6 +370,12 @@ document.addEventListener('DOMContentLoaded', () => {
             messagesContainer.insertAdjacentHTML('beforeend', msgHtml);
         });
 
+        // History is paginated; earlier messages are fetched on demand
+        if (historyHasMore) {
+            messagesContainer.insertAdjacentHTML('afterbegin',
+                '<button id="load-earlier-btn" class="w-full py-2 text-sm text-gray-400 hover:text-white">Load earlier messages</button>');
+        }
+
         // Scroll to bottom
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
         checkChatState();
@@ -534,10 +603,15 @@ document.addEventListener('DOMContentLoaded', () => {
             if (messageText === '' && !attachedFile) return;
             messageParts = [];
             if (attachedFile) {
-                const imageBase64 = await convertFileToBase64(attachedFile);
-                messageParts.push({
-                    inlineData: { mimeType: attachedFile.type, data: imageBase64.split(',')[1] }
-                });
+                // Upload the image once; the message only carries its id
+                const formData = new FormData();
+                formData.append('file', attachedFile);
+                const uploaded = await api.uploadAttachment(formData);
+                if (!uploaded) {
+                    alert('Could not upload the image. Please try again.');
+                    return;
+                }
+                messageParts.push({ attachment: { id: uploaded.attachment_id } });
             }
             if (messageText) {
                 messageParts.push({ text: messageText });
@@ -563,19 +637,41 @@ document.addEventListener('DOMContentLoaded', () => {
         removeAttachedFile();
         selectTool(null);
 
-        const payload = { contents: chatHistory, session_id: currentSessionId };
+        // Only the new turn is sent; the server rebuilds earlier context from the session history
+        const payload = { message: { role: "user", parts: messageParts }, session_id: currentSessionId };
         if(loadingIndicator) loadingIndicator.style.display = 'block';
-        const result = await api.sendMessage(payload);
+
+        // Show the model reply as it streams in, updating only the last bubble
+        const modelMessage = { role: "model", parts: [{ text: "" }], timestamp: new Date().toISOString() };
+        let bubbleRendered = false;
+        const result = await api.streamMessage(payload, (chunk, fullText) => {
+            modelMessage.parts[0].text = fullText;
+            if (!bubbleRendered) {
+                if(loadingIndicator) loadingIndicator.style.display = 'none';
+                chatHistory.push(modelMessage);
+                renderMessages();
+                bubbleRendered = true;
+                return;
+            }
+            const bubbles = messagesContainer ? messagesContainer.querySelectorAll('.message-content') : [];
+            const lastBubble = bubbles[bubbles.length - 1];
+            if (lastBubble) {
+                lastBubble.innerText = fullText;
+                messagesContainer.scrollTop = messagesContainer.scrollHeight;
+            }
+        });
         if(loadingIndicator) loadingIndicator.style.display = 'none';
         
         let modelResponseText = "Sorry, something went wrong.";
-        if (result && result.candidates && result.candidates[0]?.content?.parts[0]?.text) {
-            modelResponseText = result.candidates[0].content.parts[0].text;
-        } else if (result && result.error?.message) {
-            modelResponseText = result.error.message;
+        if (result && result.error) {
+            // Keep what arrived before the failure, but show that the answer was cut short
+            modelResponseText = result.text ? `${result.text}\n\n[${result.error}]` : result.error;
+        } else if (result && result.text) {
+            modelResponseText = result.text;
         }
         
-        chatHistory.push({ role: "model", parts: [{ text: modelResponseText }], timestamp: new Date().toISOString() });
+        modelMessage.parts[0].text = modelResponseText;
+        if (!bubbleRendered) chatHistory.push(modelMessage);
         renderMessages();
         if (autoSpeak) speakText(modelResponseText);
         
@@ -590,6 +686,7 @@ document.addEventListener('DOMContentLoaded', () => {
         
         const data = await api.getSessionHistory(sessionId);
         chatHistory = data ? data.history : [];
+        historyHasMore = data ? Boolean(data.has_more) : false;
         currentSessionId = sessionId;
 
         loadingIndicator.style.display = 'none';
@@ -603,11 +700,25 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    async function loadEarlierMessages() {
+        const oldest = chatHistory.find(msg => msg.db_id);
+        if (!currentSessionId || !oldest) return;
+        const data = await api.getSessionHistory(currentSessionId, oldest.db_id);
+        if (!data) return;
+        const previousHeight = messagesContainer.scrollHeight;
+        chatHistory = [...data.history, ...chatHistory];
+        historyHasMore = Boolean(data.has_more);
+        renderMessages();
+        // Keep the viewport on the message the user was reading
+        messagesContainer.scrollTop = messagesContainer.scrollHeight - previousHeight;
+    }
+
     async function handleNewChat() {
         const data = await api.startNewChat();
         if (data && data.session_id) {
             currentSessionId = data.session_id;
             chatHistory = [];
+            historyHasMore = false;
             renderMessages();
             renderSuggestionPrompts();
             if (chatTitle) chatTitle.textContent = "New Chat";
@@ -671,7 +782,7 @@ document.addEventListener('DOMContentLoaded', () => {
         geminiOutput.textContent = 'Summarizing...';
         const conversationText = chatHistory.map(msg => `${msg.role}: ${msg.parts[0].text}`).join('\n');
         const prompt = `Please summarize the following conversation:\n\n${conversationText}`;
-        const payload = { contents: [{ role: "user", parts: [{ text: prompt }] }], session_id: currentSessionId };
+        const payload = { message: { role: "user", parts: [{ text: prompt }] }, session_id: currentSessionId };
         const result = await api.sendMessage(payload);
         if (result && result.candidates && result.candidates[0]?.content?.parts[0]?.text) {
             geminiOutput.textContent = result.candidates[0].content.parts[0].text;
@@ -746,15 +857,6 @@ document.addEventListener('DOMContentLoaded', () => {
         checkChatState();
     }
     
-    function convertFileToBase64(file) {
-        return new Promise((resolve, reject) => {
-            const reader = new FileReader();
-            reader.onloadend = () => resolve(reader.result);
-            reader.onerror = reject;
-            reader.readAsDataURL(file);
-        });
-    }
-
     // =====================================================================
     // --- VIRTUAL ENVIRONMENT FUNCTIONS ---
     // =====================================================================
@@ -775,8 +877,15 @@ document.addEventListener('DOMContentLoaded', () => {
             const link = e.target.closest('a[data-chat-id]');
             const renameBtn = e.target.closest('button[data-rename-id]');
             const deleteBtn = e.target.closest('button[data-delete-id]');
+            const loadMoreBtn = e.target.closest('button[data-load-more-cursor]');
 
-            if (link) { e.preventDefault(); loadChat(link.dataset.chatId); } 
+            if (loadMoreBtn) {
+                e.preventDefault();
+                api.getAllSessions(loadMoreBtn.dataset.loadMoreCursor).then(older => {
+                    if (older) renderChatHistory(older, currentSessionId, true);
+                });
+            }
+            else if (link) { e.preventDefault(); loadChat(link.dataset.chatId); } 
             else if (renameBtn) { e.preventDefault(); handleRenameSession(renameBtn.dataset.renameId, renameBtn.dataset.currentTitle); } 
             else if (deleteBtn) { e.preventDefault(); handleDeleteSession(deleteBtn.dataset.deleteId); }
         });
@@ -792,6 +901,11 @@ document.addEventListener('DOMContentLoaded', () => {
     
     if (messagesContainer) {
         messagesContainer.addEventListener('click', async (e) => {
+            if (e.target.closest('#load-earlier-btn')) {
+                e.preventDefault();
+                await loadEarlierMessages();
+                return;
+            }
             const btn = e.target.closest('.action-btn');
             if (!btn) return;
             const contentEl = btn.closest('.message-bubble')?.querySelector('.message-content');
@@ -884,13 +998,13 @@ document.addEventListener('DOMContentLoaded', () => {
 
         const payload = {
             session_id: currentSessionId,
-            contents: {
+            message: {
                 role: "user",
                 parts: [{ text: promptText }]
             }
         };
 
-        addMessageToUI(payload.contents);
+        addMessageToUI(payload.message);
         setLoading(true);
 
         try {
@@ -0,0 +1,31 @@
+import os
+import uuid
+
+import pytest
+
+import indexes
+import sqlitestore
+
+
+def test_sqlite_route_queries_use_indexes(tmp_path):
+    db = sqlitestore.SQLiteDatabase(str(tmp_path / 'store.db'))
+    try:
+        db.ensure_schema()
+        assert sqlitestore.find_full_scans(db, indexes.route_queries()) == []
+    finally:
+        db.close()
+
+
+@pytest.mark.skipif(not os.getenv('MONGO_URI'), reason="needs a MongoDB server (set MONGO_URI)")
+def test_mongo_route_queries_use_indexes():
+    from pymongo import MongoClient
+
+    client = MongoClient(os.environ['MONGO_URI'], serverSelectionTimeoutMS=5000)
+    name = f'phantom_index_test_{uuid.uuid4().hex[:8]}'
+    try:
+        db = client[name]
+        indexes.ensure_indexes(db)
+        assert indexes.find_collection_scans(db) == []
+    finally:
+        client.drop_database(name)
+        client.close()
@@ -0,0 +1,87 @@
+import time
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+import passwords
+
+
+@pytest.fixture
+def hasher():
+    hasher = passwords.PasswordHasher('pbkdf2:sha256:1000', workers=1)
+    yield hasher
+    hasher.shutdown()
+
+
+@pytest.mark.parametrize('method, stored', [
+    ('scrypt', 'scrypt:32768:8:1'),
+    ('scrypt:16384:8:1', 'scrypt:16384:8:1'),
+    ('pbkdf2', 'pbkdf2:sha256:1000000'),
+    ('pbkdf2:sha512', 'pbkdf2:sha512:1000000'),
+    ('pbkdf2:sha256:600000', 'pbkdf2:sha256:600000'),
+])
+def test_normalise_method_matches_werkzeug(method, stored):
+    assert passwords.normalise_method(method) == stored
+    assert generate_password_hash('x', method=method).startswith(stored + '$')
+
+
+def test_needs_rehash_compares_normalised_methods():
+    hasher = passwords.PasswordHasher('pbkdf2:sha256', workers=1)
+    try:
+        assert not hasher.needs_rehash(generate_password_hash('x', method='pbkdf2:sha256'))
+        assert hasher.needs_rehash(generate_password_hash('x', method='pbkdf2:sha256:1000'))
+        assert hasher.needs_rehash(generate_password_hash('x', method='scrypt'))
+        assert hasher.needs_rehash('md5$salt$hash')
+    finally:
+        hasher.shutdown()
+
+
+def test_verify(hasher):
+    password_hash = hasher.hash('secret')
+    assert hasher.verify(password_hash, 'secret')
+    assert not hasher.verify(password_hash, 'wrong')
+
+
+def test_verify_without_hash_checks_a_dummy(hasher):
+    assert not hasher.verify(None, 'secret')
+    assert not hasher.verify('', '')
+    assert hasher.stats['verified'] == 2
+
+
+def test_attempt_throttle():
+    throttle = passwords.AttemptThrottle(max_attempts=2, window_seconds=60)
+    throttle.record('key')
+    assert throttle.retry_after('key') == 0
+    throttle.record('key')
+    assert throttle.retry_after('key') > 0
+    throttle.reset('key')
+    assert throttle.retry_after('key') == 0
+
+
+def test_timed_out_jobs_keep_their_slot_until_they_finish():
+    hasher = passwords.PasswordHasher('pbkdf2:sha256:1000', workers=1, max_queue=2, timeout=0.05)
+    try:
+        for _ in range(2):
+            with pytest.raises(passwords.HasherBusyError):
+                hasher._run(time.sleep, 0.5)
+        # Both jobs are still in the pool, so nothing more is admitted
+        assert hasher.queue_depth == 2
+        with pytest.raises(passwords.HasherBusyError, match="in progress"):
+            hasher._run(time.sleep, 0)
+        deadline = time.monotonic() + 5
+        while hasher.queue_depth and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert hasher.queue_depth == 0
+        hasher.timeout = 5
+        assert hasher.verify(hasher.hash('secret'), 'secret')
+    finally:
+        hasher.shutdown()
+
+
+def test_broken_pool_is_replaced_once(hasher):
+    broken = hasher._executor
+    hasher._replace_executor(broken)
+    fresh = hasher._executor
+    hasher._replace_executor(broken)
+    assert fresh is not broken
+    assert hasher._executor is fresh
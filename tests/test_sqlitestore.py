@@ -0,0 +1,230 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from sqlitestore import SQLiteDatabase
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = SQLiteDatabase(str(tmp_path / 'store.db'))
+    database.ensure_schema()
+    yield database
+    database.close()
+
+
+def add_messages(db, session_id, contents, user_id='u1'):
+    start = datetime(2024, 1, 1)
+    db['messages'].insert_many([
+        {'session_id': session_id, 'user_id': user_id, 'role': 'user', 'content': content,
+         'timestamp': start + timedelta(minutes=index), 'parts': [{'text': content}]}
+        for index, content in enumerate(contents)
+    ])
+
+
+def test_documents_round_trip(db):
+    session_id = ObjectId()
+    when = datetime(2024, 5, 6, 7, 8, 9, 123000)
+    inserted = db['chat_sessions'].insert_one({'_id': session_id, 'user_id': 'u1', 'title': 'Hi', 'last_updated': when,
+                                               'extra': {'nested': [1, 'two']}})
+    assert inserted.inserted_id == session_id
+
+    doc = db['chat_sessions'].find_one({'_id': session_id})
+    assert doc == {'_id': session_id, 'user_id': 'u1', 'title': 'Hi', 'last_updated': when, 'extra': {'nested': [1, 'two']}}
+    assert db['chat_sessions'].find_one(session_id)['title'] == 'Hi'
+
+
+def test_find_sort_skip_limit(db):
+    session_id = ObjectId()
+    add_messages(db, session_id, ['a', 'b', 'c', 'd'])
+    add_messages(db, ObjectId(), ['other'])
+
+    query = {'session_id': session_id, 'user_id': 'u1'}
+    assert [m['content'] for m in db['messages'].find(query).sort('timestamp', DESCENDING).limit(2)] == ['d', 'c']
+    assert [m['content'] for m in db['messages'].find(query).sort([('timestamp', ASCENDING)]).skip(1).limit(2)] == ['b', 'c']
+    assert [m['content'] for m in db['messages'].find({**query, 'content': {'$in': ['a', 'd']}})] == ['a', 'd']
+    assert db['messages'].count_documents(query) == 4
+
+
+def test_projection(db):
+    session_id = ObjectId()
+    add_messages(db, session_id, ['a'])
+
+    doc = db['messages'].find_one({'session_id': session_id}, {'content': 1, 'parts': 1})
+    assert set(doc) == {'_id', 'content', 'parts'}
+    assert db['messages'].find_one({'session_id': session_id}, {'_id': 0, 'role': 1}) == {'role': 'user'}
+
+
+def test_update_operators(db):
+    sessions = db['chat_sessions']
+    sessions.insert_one({'_id': 's1', 'user_id': 'u1', 'last_updated': datetime(2024, 1, 2)})
+
+    sessions.update_one({'_id': 's1'}, {'$set': {'title': 'New', 'meta.source': 'web'}})
+    sessions.update_one({'_id': 's1'}, {'$max': {'last_updated': datetime(2024, 1, 1)}})
+    assert sessions.find_one({'_id': 's1'})['last_updated'] == datetime(2024, 1, 2)
+    sessions.update_one({'_id': 's1'}, {'$max': {'last_updated': datetime(2024, 1, 3)}})
+    sessions.update_one({'_id': 's1'}, {'$inc': {'turns': 2}})
+    sessions.update_one({'_id': 's1'}, {'$inc': {'turns': 1}})
+    sessions.update_one({'_id': 's1'}, {'$push': {'tags': 'a'}})
+    sessions.update_one({'_id': 's1'}, {'$push': {'tags': {'$each': ['b', 'a']}}})
+
+    doc = sessions.find_one({'_id': 's1'})
+    assert doc['title'] == 'New'
+    assert doc['meta'] == {'source': 'web'}
+    assert doc['last_updated'] == datetime(2024, 1, 3)
+    assert doc['turns'] == 3
+    assert doc['tags'] == ['a', 'b', 'a']
+    assert sessions.find({'title': 'New', 'last_updated': {'$gte': datetime(2024, 1, 3)}}).limit(1).explain()
+
+
+def test_update_result_counts(db):
+    db['chat_sessions'].insert_one({'_id': 's1', 'user_id': 'u1', 'title': 'Same'})
+    result = db['chat_sessions'].update_one({'_id': 's1'}, {'$set': {'title': 'Same'}})
+    assert (result.matched_count, result.modified_count) == (1, 0)
+    result = db['chat_sessions'].update_one({'_id': 'missing'}, {'$set': {'title': 'x'}})
+    assert (result.matched_count, result.upserted_id) == (0, None)
+
+
+def test_upsert_seeds_from_filter(db):
+    result = db['session_purges'].update_one(
+        {'_id': 's1'}, {'$setOnInsert': {'user_id': 'u1', 'requested_at': datetime(2024, 1, 1)}}, upsert=True)
+    assert result.upserted_id == 's1'
+    db['session_purges'].update_one({'_id': 's1'}, {'$setOnInsert': {'user_id': 'u2'}}, upsert=True)
+    assert db['session_purges'].find_one({'_id': 's1'})['user_id'] == 'u1'
+
+
+def test_find_one_and_update_with_sort(db):
+    jobs = db['session_purges']
+    epoch = datetime(1970, 1, 1)
+    for name, requested in (('late', 3), ('early', 1), ('middle', 2)):
+        jobs.insert_one({'_id': name, 'user_id': 'u1', 'claimed_until': epoch, 'requested_at': datetime(2024, 1, requested)})
+
+    lease = datetime(2030, 1, 1)
+    claimed = jobs.find_one_and_update(
+        {'claimed_until': {'$lt': datetime(2025, 1, 1)}}, {'$set': {'claimed_until': lease}},
+        sort=[('claimed_until', ASCENDING), ('requested_at', ASCENDING)], return_document=ReturnDocument.AFTER)
+    assert claimed['_id'] == 'early'
+    assert claimed['claimed_until'] == lease
+
+    before = jobs.find_one_and_update({'_id': 'middle'}, {'$set': {'claimed_until': lease}})
+    assert before['claimed_until'] == epoch
+    assert jobs.find_one_and_update({'_id': 'missing'}, {'$set': {'claimed_until': lease}}) is None
+
+
+def test_find_one_and_update_upsert(db):
+    doc = db['users'].find_one_and_update({'email': 'a@example.com'}, {'$set': {'name': 'A'}}, upsert=True,
+                                          return_document=ReturnDocument.AFTER)
+    assert doc['email'] == 'a@example.com'
+    assert doc['name'] == 'A'
+    assert db['users'].count_documents({}) == 1
+
+
+def test_duplicate_keys(db):
+    db['users'].insert_one({'email': 'a@example.com'})
+    with pytest.raises(DuplicateKeyError):
+        db['users'].insert_one({'email': 'a@example.com'})
+
+    first = {'_id': ObjectId(), 'session_id': 's', 'user_id': 'u1', 'content': 'one'}
+    db['messages'].insert_one(dict(first))
+    with pytest.raises(BulkWriteError) as raised:
+        db['messages'].insert_many([dict(first), {'session_id': 's', 'user_id': 'u1', 'content': 'two'}], ordered=False)
+    assert [error['code'] for error in raised.value.details['writeErrors']] == [11000]
+    assert raised.value.details['nInserted'] == 1
+    assert db['messages'].count_documents({'session_id': 's'}) == 2
+
+
+def test_bulk_write(db):
+    sessions = db['chat_sessions']
+    sessions.insert_one({'_id': 's1', 'user_id': 'u1', 'last_updated': datetime(2024, 1, 1)})
+    result = sessions.bulk_write([
+        UpdateOne({'_id': 's1', 'user_id': 'u1'}, {'$max': {'last_updated': datetime(2024, 2, 1)}}),
+        UpdateOne({'_id': 's1', 'user_id': 'u1', 'title': None}, {'$set': {'title': 'First'}}),
+        UpdateOne({'_id': 's2'}, {'$setOnInsert': {'user_id': 'u1'}}, upsert=True),
+        InsertOne({'_id': 's3', 'user_id': 'u2'}),
+    ], ordered=True)
+
+    assert (result.matched_count, result.modified_count, result.upserted_count, result.inserted_count) == (2, 2, 1, 1)
+    doc = sessions.find_one({'_id': 's1'})
+    assert (doc['title'], doc['last_updated']) == ('First', datetime(2024, 2, 1))
+    assert sessions.count_documents({'user_id': 'u1'}) == 2
+
+
+def test_bulk_write_reports_duplicates(db):
+    db['users'].insert_one({'_id': 'a', 'email': 'a@example.com'})
+    with pytest.raises(BulkWriteError) as raised:
+        db['users'].bulk_write([InsertOne({'email': 'a@example.com'}), InsertOne({'email': 'b@example.com'})], ordered=False)
+    assert raised.value.details['writeErrors'][0]['index'] == 0
+    assert db['users'].find_one({'email': 'b@example.com'}) is not None
+
+
+def test_delete(db):
+    add_messages(db, 's1', ['a', 'b', 'c'])
+    assert db['messages'].delete_one({'session_id': 's1'}).deleted_count == 1
+    assert db['messages'].delete_many({'session_id': 's1', 'user_id': 'u1'}).deleted_count == 2
+    assert db['messages'].estimated_document_count() == 0
+
+
+def test_text_search(db):
+    add_messages(db, 's1', ['the benchmark results', 'lunch plans', 'another Benchmark run'])
+    add_messages(db, 's2', ['benchmark for someone else'], user_id='u2')
+    add_messages(db, 's3', ['benchmark in a deleted session'])
+
+    results = list(db['messages'].find(
+        {'user_id': 'u1', '$text': {'$search': 'benchmark'}, 'session_id': {'$nin': ['s3']}},
+        {'content': 1, 'score': {'$meta': 'textScore'}},
+    ).sort([('score', {'$meta': 'textScore'}), ('timestamp', -1)]).limit(10))
+
+    assert sorted(doc['content'] for doc in results) == ['another Benchmark run', 'the benchmark results']
+    assert all(doc['score'] > 0 for doc in results)
+    assert list(db['messages'].find({'user_id': 'u1', '$text': {'$search': '"lunch plans"'}}))[0]['content'] == 'lunch plans'
+    assert list(db['messages'].find({'user_id': 'u1', '$text': {'$search': ''}})) == []
+
+
+def test_text_index_follows_updates_and_deletes(db):
+    add_messages(db, 's1', ['alpha'])
+    db['messages'].update_one({'session_id': 's1'}, {'$set': {'content': 'beta'}})
+    assert list(db['messages'].find({'user_id': 'u1', '$text': {'$search': 'alpha'}})) == []
+    assert len(list(db['messages'].find({'user_id': 'u1', '$text': {'$search': 'beta'}}))) == 1
+    db['messages'].delete_many({'session_id': 's1'})
+    assert list(db['messages'].find({'user_id': 'u1', '$text': {'$search': 'beta'}})) == []
+
+
+def test_array_membership(db):
+    db['attachments'].insert_one({'_id': 'img1', 'owners': ['u1', 'u2']})
+    db['attachments'].insert_one({'_id': 'img2', 'owners': ['u3']})
+    assert [doc['_id'] for doc in db['attachments'].find({'_id': {'$in': ['img1', 'img2']}, 'owners': 'u1'})] == ['img1']
+    db['attachments'].update_one({'_id': 'img2'}, {'$addToSet': {'owners': 'u1'}})
+    db['attachments'].update_one({'_id': 'img2'}, {'$addToSet': {'owners': 'u1'}})
+    assert db['attachments'].find_one({'_id': 'img2'})['owners'] == ['u3', 'u1']
+
+
+def test_aggregate_group(db):
+    for email in ('a@example.com', 'b@example.com'):
+        db['users'].insert_one({'email': email})
+    groups = list(db['users'].aggregate([
+        {'$match': {'email': {'$exists': True}}},
+        {'$group': {'_id': '$email', 'count': {'$sum': 1}}},
+        {'$sort': {'_id': 1}},
+    ]))
+    assert groups == [{'_id': 'a@example.com', 'count': 1}, {'_id': 'b@example.com', 'count': 1}]
+
+
+@pytest.mark.parametrize('call', [
+    lambda db: list(db['messages'].find({'$where': 'true'})),
+    lambda db: list(db['messages'].find({'session_id': {'$elemMatch': {}}})),
+    lambda db: list(db['messages'].find({'not_a_column': 1})),
+    lambda db: list(db['messages'].find({}, {'content': 0})),
+    lambda db: list(db['chat_sessions'].find({'$text': {'$search': 'x'}})),
+    lambda db: db['messages'].find_one({'user_id': 'u1'}, sort=[('not_a_column', 1)]),
+    lambda db: db['chat_sessions'].update_one({'_id': 's1'}, {'$rename': {'a': 'b'}}, upsert=True),
+    lambda db: db['chat_sessions'].update_one({'_id': 's1'}, {'title': 'replacement'}),
+    lambda db: db['chat_sessions'].count_documents({'$nor': []}),
+    lambda db: list(db['users'].aggregate([{'$lookup': {}}])),
+    lambda db: list(db['users'].aggregate([{'$group': {'_id': None, 'n': {'$stdDevPop': 1}}}])),
+])
+def test_unsupported_operations_raise_operation_failure(db, call):
+    with pytest.raises(OperationFailure):
+        call(db)
@@ -0,0 +1,118 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import mongomock
+import pytest
+from pymongo.errors import AutoReconnect
+
+from writebehind import WriteBehindWriter
+
+
+class Collection:
+    """A mongomock collection whose writes can be made to fail."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.outages = 0  # the next `outages` writes raise AutoReconnect
+        self.poison = None  # writes touching a document with this content raise TypeError
+
+    def _check(self, documents):
+        if self.outages:
+            self.outages -= 1
+            raise AutoReconnect("connection lost")
+        if any(document.get('content') == self.poison for document in documents):
+            raise TypeError("cannot encode object")
+
+    def insert_many(self, documents, ordered=True):
+        self._check(documents)
+        return self.collection.insert_many(documents, ordered=ordered)
+
+    def bulk_write(self, operations, ordered=True):
+        # mongomock's bulk_write doesn't accept the operations of current pymongo releases
+        self._check([])
+        for operation in operations:
+            self.collection.update_one(operation._filter, operation._doc, upsert=operation._upsert)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().db
+
+
+@pytest.fixture
+def writer(db):
+    writer = WriteBehindWriter(Collection(db.messages), Collection(db.chat_sessions),
+                               flush_interval=0.01, retry_backoff=0.01)
+    yield writer
+    writer.close(timeout=1)
+
+
+def message(session_id, content):
+    return {'session_id': session_id, 'user_id': 'u1', 'role': 'user', 'content': content,
+            'timestamp': datetime.now(timezone.utc)}
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_flush_writes_messages_and_coalesces_touches(db, writer):
+    db.chat_sessions.insert_one({'_id': 's1', 'user_id': 'u1', 'last_updated': datetime(2020, 1, 1)})
+    later = datetime(2030, 1, 1)
+    writer.add_message(message('s1', 'hello'))
+    writer.touch_session('s1', 'u1', later - timedelta(days=1))
+    writer.touch_session('s1', 'u1', later)
+    assert writer.flush_session('s1', 'u1')
+
+    assert [doc['content'] for doc in db.messages.find()] == ['hello']
+    assert db.chat_sessions.find_one({'_id': 's1'})['last_updated'] == later
+    assert writer.pending == 0
+
+
+def test_database_error_requeues_the_batch(db, writer):
+    writer.messages_collection.outages = 1
+    writer.add_message(message('s1', 'one'))
+    assert not writer.flush()
+    assert writer.stats["failed_batches"] == 1
+    assert writer.pending == 1
+
+    assert writer.flush()
+    assert [doc['content'] for doc in db.messages.find()] == ['one']
+
+
+def test_retried_batch_does_not_duplicate_messages(db, writer):
+    first = message('s1', 'one')
+    writer.add_message(first)
+    db.messages.insert_one(dict(first))  # landed before the connection dropped
+    writer.add_message(message('s1', 'two'))
+    assert writer.flush()
+
+    assert sorted(doc['content'] for doc in db.messages.find()) == ['one', 'two']
+    assert writer.stats["duplicates"] == 1
+
+
+def test_unwritable_message_is_dropped_and_the_rest_written(db, writer):
+    writer.messages_collection.poison = 'bad'
+    for content in ('one', 'bad', 'two'):
+        writer.add_message(message('s1', content))
+    assert writer.flush()
+
+    assert sorted(doc['content'] for doc in db.messages.find()) == ['one', 'two']
+    assert writer.stats["dropped_messages"] == 1
+    assert writer.pending == 0
+
+
+def test_flusher_thread_survives_unexpected_errors(db, writer):
+    writer.messages_collection.poison = 'bad'
+    writer.add_message(message('s1', 'bad'))
+    wait_for(lambda: writer.stats["dropped_messages"] == 1)
+
+    writer.add_message(message('s1', 'after'))
+    wait_for(lambda: db.messages.count_documents({}) == 1)
+    assert writer._thread.is_alive()
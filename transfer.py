@@ -0,0 +1,254 @@
+"""
+Streaming export and batched import of conversations as NDJSON.
+
+An export is one JSON object per line: an "export" header, then each session
+followed by its messages in timestamp order. Sessions and messages are read
+from MongoDB cursors and written out in chunks of about `chunk_bytes`
+(gzip-compressed on the fly if asked), so memory use doesn't depend on how
+much history a user has.
+
+Imports read the same format line by line (plain or gzip) and insert it with
+batched, unordered insert_many calls. Every imported session and message gets
+a new id; messages are attached to their session through the old-to-new id
+map, so a file can be imported into any account, or twice, without clashes.
+"""
+import gzip
+import io
+import json
+import zlib
+from datetime import datetime, timezone
+
+from bson.objectid import ObjectId
+
+FORMAT_VERSION = 1
+MAX_LINE_BYTES = 16 * 1024 * 1024
+MAX_REPORTED_ERRORS = 20
+ROLES = ('user', 'model')
+
+
+class ImportFormatError(Exception):
+    """Raised for a line that isn't a valid export record."""
+
+
+def _isoformat(value):
+    # Stored datetimes come back naive but are UTC
+    return value.replace(tzinfo=timezone.utc).isoformat() if isinstance(value, datetime) else None
+
+
+def _parse_time(value, default):
+    if value is None:
+        return default
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        raise ImportFormatError(f"Invalid timestamp: {value!r}")
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def export_records(sessions_collection, messages_collection, user_id, session_ids=None, before_session=None,
+                   batch_size=500):
+    """
+    Yields the export as dicts. `session_ids` limits it to those sessions; `before_session(id)`
+    runs before each session's messages are read (app.py flushes queued writes there).
+    """
+    yield {"type": "export", "version": FORMAT_VERSION, "exported_at": datetime.now(timezone.utc).isoformat()}
+    query_filter = {'user_id': user_id}
+    if session_ids is not None:
+        query_filter['_id'] = {'$in': session_ids}
+    sessions = sessions_collection.find(
+        query_filter, {'title': 1, 'created_at': 1, 'last_updated': 1, 'summary': 1, 'summary_until': 1}
+    ).sort([('last_updated', -1), ('_id', -1)]).batch_size(batch_size)
+    for session_doc in sessions:
+        record = {
+            "type": "session",
+            "id": str(session_doc['_id']),
+            "title": session_doc.get('title'),
+            "created_at": _isoformat(session_doc.get('created_at')),
+            "last_updated": _isoformat(session_doc.get('last_updated')),
+        }
+        if session_doc.get('summary'):
+            record["summary"] = session_doc['summary']
+            record["summary_until"] = _isoformat(session_doc.get('summary_until'))
+        yield record
+
+        if before_session is not None:
+            before_session(session_doc['_id'])
+        messages = messages_collection.find(
+            {'session_id': session_doc['_id'], 'user_id': user_id},
+            {'role': 1, 'content': 1, 'timestamp': 1, 'attachments': 1}
+        ).sort([('timestamp', 1), ('_id', 1)]).batch_size(batch_size)
+        for message in messages:
+            message_record = {
+                "type": "message",
+                "session": record["id"],
+                "id": str(message['_id']),
+                "role": message.get('role'),
+                "content": message.get('content', ''),
+                "timestamp": _isoformat(message.get('timestamp')),
+            }
+            if message.get('attachments'):
+                message_record["attachments"] = message['attachments']
+            yield message_record
+
+
+def encode_ndjson(records, compress=False, chunk_bytes=64 * 1024):
+    """Serialises records to NDJSON, yielding byte chunks (a gzip stream if `compress`)."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31: gzip container
+    pending = []
+    pending_bytes = 0
+    for record in records:
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+        pending.append(line)
+        pending_bytes += len(line)
+        if pending_bytes >= chunk_bytes:
+            data = b''.join(pending)
+            pending, pending_bytes = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = b''.join(pending)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def open_upload(stream, content_encoding=None):
+    """Wraps an uploaded body for line reading, un-gzipping it if it is gzip (by header or magic bytes)."""
+    buffered = io.BufferedReader(stream) if not hasattr(stream, 'peek') else stream
+    if (content_encoding or '').lower() == 'gzip' or buffered.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=buffered, mode='rb')
+    return buffered
+
+
+class ConversationImporter:
+    """Turns export lines into new sessions and messages for `user_id`, inserted in batches."""
+
+    def __init__(self, sessions_collection, messages_collection, user_id, attachments_collection=None,
+                 batch_size=1000):
+        self.sessions_collection = sessions_collection
+        self.messages_collection = messages_collection
+        self.attachments_collection = attachments_collection
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.session_map = {}  # id in the file -> new ObjectId
+        self.stats = {"sessions": 0, "messages": 0, "skipped": 0, "batches": 0}
+        self.errors = []
+        self._sessions = []
+        self._messages = []
+
+    def _session_doc(self, record):
+        now = datetime.now(timezone.utc)
+        source_id = record.get('id')
+        if not isinstance(source_id, str) or not source_id:
+            raise ImportFormatError("Session record without an id.")
+        if source_id in self.session_map:
+            raise ImportFormatError(f"Duplicate session id {source_id!r}.")
+        created_at = _parse_time(record.get('created_at'), now)
+        doc = {
+            '_id': ObjectId(),
+            'user_id': self.user_id,
+            'title': str(record.get('title') or 'Imported Chat')[:200],
+            'created_at': created_at,
+            'last_updated': _parse_time(record.get('last_updated'), created_at),
+        }
+        if record.get('summary'):
+            doc['summary'] = str(record['summary'])
+            doc['summary_until'] = _parse_time(record.get('summary_until'), created_at)
+        self.session_map[source_id] = doc['_id']
+        return doc
+
+    def _message_doc(self, record):
+        source_session = record.get('session')
+        session_id = self.session_map.get(source_session) if isinstance(source_session, str) else None
+        if session_id is None:
+            raise ImportFormatError(f"Message for unknown session {record.get('session')!r}; sessions must come first.")
+        if record.get('role') not in ROLES:
+            raise ImportFormatError(f"Invalid role {record.get('role')!r}.")
+        if not isinstance(record.get('content'), str):
+            raise ImportFormatError("Message content must be a string.")
+        doc = {
+            'session_id': session_id,
+            'user_id': self.user_id,
+            'role': record['role'],
+            'content': record['content'],
+            'timestamp': _parse_time(record.get('timestamp'), datetime.now(timezone.utc)),
+            'type': 'text',
+        }
+        attachments = record.get('attachments')
+        if isinstance(attachments, list) and attachments:
+            doc['attachments'] = [str(attachment_id) for attachment_id in attachments]
+        return doc
+
+    def feed(self, line_number, line):
+        """Parses one line. Bad lines are counted and reported, not fatal."""
+        line = line.strip()
+        if not line:
+            return
+        try:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ImportFormatError("Not valid JSON.")
+            if not isinstance(record, dict):
+                raise ImportFormatError("Each line must be a JSON object.")
+            record_type = record.get('type')
+            if record_type == 'export':
+                version = record.get('version', FORMAT_VERSION)
+                if not isinstance(version, int) or version > FORMAT_VERSION:
+                    raise ImportFormatError(f"Unsupported export format version {version!r}.")
+                return
+            if record_type == 'session':
+                self._sessions.append(self._session_doc(record))
+            elif record_type == 'message':
+                self._messages.append(self._message_doc(record))
+            else:
+                raise ImportFormatError(f"Unknown record type {record_type!r}.")
+        except ImportFormatError as error:
+            self.stats["skipped"] += 1
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append({"line": line_number, "error": str(error)})
+            return
+        if len(self._sessions) + len(self._messages) >= self.batch_size:
+            self.flush()
+
+    def _owned_attachments(self, documents):
+        referenced = {attachment_id for doc in documents for attachment_id in doc.get('attachments', ())}
+        if not referenced or self.attachments_collection is None:
+            return set()
+        return {doc['_id'] for doc in self.attachments_collection.find(
+            {'_id': {'$in': list(referenced)}, 'owners': self.user_id}, {'_id': 1}
+        )}
+
+    def flush(self):
+        # Sessions first, so no batch of messages is ever written without its session
+        if self._sessions:
+            self.sessions_collection.insert_many(self._sessions, ordered=False)
+            self.stats["sessions"] += len(self._sessions)
+            self._sessions = []
+        if self._messages:
+            # References to images this user doesn't have are dropped, not imported
+            owned = self._owned_attachments(self._messages)
+            for doc in self._messages:
+                if 'attachments' in doc:
+                    doc['attachments'] = [attachment_id for attachment_id in doc['attachments'] if attachment_id in owned]
+                    if not doc['attachments']:
+                        del doc['attachments']
+            self.messages_collection.insert_many(self._messages, ordered=False)
+            self.stats["messages"] += len(self._messages)
+            self._messages = []
+        self.stats["batches"] += 1
+
+    def run(self, lines):
+        """Feeds every line of a binary file-like object, then writes what is left."""
+        line_number = 0
+        while True:
+            line = lines.readline(MAX_LINE_BYTES + 1)
+            if not line:
+                break
+            line_number += 1
+            if len(line) > MAX_LINE_BYTES and not line.endswith(b'\n'):
+                raise ImportFormatError(f"Line {line_number} is longer than {MAX_LINE_BYTES // (1024 * 1024)}MB.")
+            self.feed(line_number, line.decode('utf-8', 'replace'))
+        self.flush()
+        return self.stats
@@ -0,0 +1,246 @@
+"""
+Write-behind persistence for chat traffic.
+
+/api/chat used to wait on three MongoDB writes per turn (session last_updated,
+user message, model message). WriteBehindWriter queues them instead and a
+background thread flushes them in batches: messages with one unordered
+insert_many, session updates with one bulk_write.
+
+- Every message gets its ObjectId when it is queued, so a batch that is retried
+  after a partial failure hits duplicate-key errors for the documents that did
+  land instead of writing them twice (at-least-once, idempotent).
+- last_updated touches are coalesced per session with $max.
+- Readers that need their own writes call flush_session() first; it writes only
+  that session's pending operations and is free when nothing is queued.
+- Memory is bounded: once `max_pending` messages are queued, new writes go
+  straight to the database on the caller's thread.
+- close() (registered with atexit by app.py) flushes whatever is left.
+- A batch that fails with a database error is requeued and retried. One that
+  fails any other way (a document the driver can't encode, an operation the
+  storage backend doesn't support) would fail forever, so it is written one
+  operation at a time and only what still fails is dropped, logged and
+  counted. Either way the flusher thread keeps running.
+"""
+import logging
+import threading
+import time
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+DUPLICATE_KEY = 11000
+
+log = logging.getLogger(__name__)
+
+
+class _PendingSession:
+    __slots__ = ('messages', 'touch', 'updates')
+
+    def __init__(self):
+        self.messages = []
+        self.touch = None
+        self.updates = []
+
+
+class WriteBehindWriter:
+
+    def __init__(self, messages_collection, sessions_collection, flush_interval=0.1,
+                 batch_size=500, max_pending=10000, retry_backoff=1.0):
+        self.messages_collection = messages_collection
+        self.sessions_collection = sessions_collection
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.retry_backoff = retry_backoff
+        self.stats = {"queued": 0, "written": 0, "duplicates": 0, "batches": 0,
+                      "failed_batches": 0, "overflow_writes": 0, "dropped_messages": 0, "dropped_session_updates": 0}
+        self._pending = {}  # (session_id, user_id) -> _PendingSession, in arrival order
+        self._pending_messages = 0
+        self._lock = threading.Lock()
+        # Held while a batch is being written, so flush_session() can't overtake an in-flight batch
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+
+    @property
+    def pending(self):
+        return self._pending_messages
+
+    def _ensure_thread(self):
+        # Started on first use, so each gunicorn worker runs its own flusher
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                    self._thread.start()
+
+    def _slot(self, session_id, user_id):
+        return self._pending.setdefault((session_id, user_id), _PendingSession())
+
+    def add_message(self, document):
+        """Queues a message document. Assigns its _id (if missing) and returns it."""
+        document.setdefault('_id', ObjectId())
+        with self._lock:
+            overflow = self._closed or self._pending_messages >= self.max_pending
+            if not overflow:
+                self._slot(document['session_id'], document['user_id']).messages.append(document)
+                self._pending_messages += 1
+                self.stats["queued"] += 1
+        if overflow:
+            self.stats["overflow_writes"] += 1
+            self._insert_messages([document])
+            return document['_id']
+        self._ensure_thread()
+        if self._pending_messages >= self.batch_size:
+            self._wakeup.set()
+        return document['_id']
+
+    def touch_session(self, session_id, user_id, when):
+        """Queues a last_updated bump; several bumps for one session become a single $max."""
+        with self._lock:
+            slot = self._slot(session_id, user_id)
+            slot.touch = when if slot.touch is None else max(slot.touch, when)
+        self._queued_session_write(session_id, user_id)
+
+    def update_session(self, session_id, user_id, filter_extra, update):
+        """Queues an arbitrary update on the user's session document (e.g. setting the first title)."""
+        with self._lock:
+            self._slot(session_id, user_id).updates.append(({'_id': session_id, 'user_id': user_id, **filter_extra}, update))
+        self._queued_session_write(session_id, user_id)
+
+    def _queued_session_write(self, session_id, user_id):
+        if self._closed:
+            # Nothing will flush after close(), so write it now
+            self._flush([(session_id, user_id)])
+        else:
+            self._ensure_thread()
+
+    def _take(self, keys=None):
+        with self._lock:
+            if keys is None:
+                taken = self._pending
+                self._pending = {}
+            else:
+                taken = {key: self._pending.pop(key) for key in keys if key in self._pending}
+            self._pending_messages -= sum(len(slot.messages) for slot in taken.values())
+        return taken
+
+    def _requeue(self, taken):
+        """Puts a failed batch back in front of anything queued since."""
+        with self._lock:
+            for key, slot in self._pending.items():
+                if key in taken:
+                    earlier = taken[key]
+                    earlier.messages.extend(slot.messages)
+                    earlier.updates.extend(slot.updates)
+                    if slot.touch is not None:
+                        earlier.touch = slot.touch if earlier.touch is None else max(earlier.touch, slot.touch)
+                else:
+                    taken[key] = slot
+            self._pending = taken
+            self._pending_messages = sum(len(slot.messages) for slot in taken.values())
+
+    def _insert_messages(self, documents):
+        try:
+            self.messages_collection.insert_many(documents, ordered=False)
+            self.stats["written"] += len(documents)
+        except BulkWriteError as error:
+            write_errors = error.details.get('writeErrors', [])
+            if any(item.get('code') != DUPLICATE_KEY for item in write_errors) or error.details.get('writeConcernErrors'):
+                raise
+            # These were written by an earlier attempt of the same batch
+            self.stats["duplicates"] += len(write_errors)
+            self.stats["written"] += len(documents) - len(write_errors)
+
+    def _session_ops(self, taken):
+        session_ops = []
+        for (session_id, user_id), slot in taken.items():
+            if slot.touch is not None:
+                session_ops.append(UpdateOne({'_id': session_id, 'user_id': user_id}, {'$max': {'last_updated': slot.touch}}))
+            session_ops.extend(UpdateOne(query, update) for query, update in slot.updates)
+        return session_ops
+
+    def _write(self, taken):
+        documents = [document for slot in taken.values() for document in slot.messages]
+        for start in range(0, len(documents), self.batch_size):
+            self._insert_messages(documents[start:start + self.batch_size])
+
+        session_ops = self._session_ops(taken)
+        if session_ops:
+            self.sessions_collection.bulk_write(session_ops, ordered=True)
+        self.stats["batches"] += 1
+
+    def _write_each(self, taken):
+        """Writes a batch that can't be written whole one operation at a time, dropping the ones that fail."""
+        for document in (document for slot in taken.values() for document in slot.messages):
+            try:
+                self._insert_messages([document])
+            except Exception as error:
+                self.stats["dropped_messages"] += 1
+                log.error("write-behind dropped a message", extra={'fields': {
+                    'session_id': str(document.get('session_id')), 'error': repr(error)}})
+        for operation in self._session_ops(taken):
+            try:
+                self.sessions_collection.bulk_write([operation], ordered=True)
+            except Exception as error:
+                self.stats["dropped_session_updates"] += 1
+                log.error("write-behind dropped a session update", extra={'fields': {'error': repr(error)}})
+
+    def _flush(self, keys=None):
+        with self._flush_lock:
+            taken = self._take(keys)
+            if not taken:
+                return True
+            try:
+                self._write(taken)
+                return True
+            except PyMongoError:
+                self.stats["failed_batches"] += 1
+                self._requeue(taken)
+                return False
+            except Exception:
+                # Not an outage: something in the batch can't be written at all, so retrying it is pointless
+                self.stats["failed_batches"] += 1
+                log.exception("write-behind batch failed; writing it one operation at a time")
+                self._write_each(taken)
+                return True
+
+    def flush(self):
+        """Writes everything queued so far. Returns False if the database rejected the batch."""
+        return self._flush()
+
+    def flush_session(self, session_id, user_id):
+        """Read-your-writes: makes this session's queued writes visible before it is read."""
+        if (session_id, user_id) not in self._pending:
+            # An in-flight batch may still hold this session; wait for it by taking the flush lock
+            with self._flush_lock:
+                return True
+        return self._flush([(session_id, user_id)])
+
+    def discard_session(self, session_id, user_id):
+        """Drops queued writes for a session that is being deleted."""
+        with self._flush_lock:
+            self._take([(session_id, user_id)])
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                flushed = self._flush()
+            except Exception:
+                # _flush handles batch errors itself; whatever gets here must not end the thread
+                log.exception("write-behind flush failed")
+                flushed = False
+            if not flushed:
+                time.sleep(self.retry_backoff)
+
+    def close(self, timeout=10.0):
+        """Stops the flusher and writes what is left, retrying until `timeout`."""
+        self._closed = True
+        self._wakeup.set()
+        deadline = time.monotonic() + timeout
+        while not self._flush() and time.monotonic() < deadline:
+            time.sleep(min(self.retry_backoff, max(0.0, deadline - time.monotonic())))